@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.db.models import Q
+
+from allauth.account.auth_backends import AuthenticationBackend as AllAuthAuthenticationBackend
+from allauth.account.models import EmailAddress
+from allauth.account.utils import filter_users_by_username
+from allauth.account import app_settings
+from allauth.utils import get_user_model
+
+from allauth_api.settings import allauth_api_settings
+from allauth_api.account import hashing, identifiers
+
+try:
+    from django.db.models import Exists, OuterRef
+except ImportError:
+    # Django < 1.11, the verification status is queried at login
+    Exists = OuterRef = None
+
+# Set on the users returned by AuthenticationBackend
+VERIFIED_EMAIL_ATTRIBUTE = 'allauth_api_verified_email'
+
+
+def get_login_queryset(queryset):
+    """
+    Annotates users with whether they have a verified email address and, with LOGIN_JOIN_TOKEN,
+    joins their rest_framework token, so logging in needs no further queries
+    """
+    if Exists is not None:
+        verified = EmailAddress.objects.filter(user=OuterRef('pk'), verified=True)
+        queryset = queryset.annotate(**{VERIFIED_EMAIL_ATTRIBUTE: Exists(verified)})
+    if allauth_api_settings.LOGIN_JOIN_TOKEN and 'rest_framework.authtoken' in settings.INSTALLED_APPS:
+        queryset = queryset.select_related('auth_token')
+    return queryset
+
+
+def filter_users_by_email(email):
+    """
+    Like allauth's filter_users_by_email, the users having email as an EmailAddress or as their
+    email field, but in a single query
+    """
+    condition = Q(pk__in=EmailAddress.objects.filter(email__iexact=email).values('user_id'))
+    if app_settings.USER_MODEL_EMAIL_FIELD:
+        condition |= Q(**{app_settings.USER_MODEL_EMAIL_FIELD + '__iexact': email})
+    return get_user_model().objects.filter(condition)
+
+
+class AuthenticationBackend(AllAuthAuthenticationBackend):
+    """
+    allauth's authentication backend, but checking passwords on the hashing executor (see
+    PASSWORD_HASHING_EXECUTOR).  Use it instead of both ModelBackend and allauth's backend, since
+    those would check the password again in the request thread after this one rejects it.
+
+    Users are looked up in a single query that also fetches whether they have a verified email
+    address and their token (see get_login_queryset), which perform_login and TokenLogin use
+    """
+
+    def _authenticate_by_username(self, **credentials):
+        username_field = app_settings.USER_MODEL_USERNAME_FIELD
+        username = credentials.get('username')
+        password = credentials.get('password')
+
+        User = get_user_model()
+
+        if not username_field or username is None or password is None:
+            return None
+        try:
+            # Username query is case insensitive
+            if identifiers.is_enabled():
+                users = identifiers.filter_users_by_username(username)
+            else:
+                users = filter_users_by_username(username)
+            user = get_login_queryset(users).get()
+        except User.DoesNotExist:
+            return None
+        if hashing.check_password(user, password):
+            return user
+        return None
+
+    def _authenticate_by_email(self, **credentials):
+        # Like allauth, fall back on username since not every app passes `email`
+        email = credentials.get('email', credentials.get('username'))
+        password = credentials.get('password')
+        # A username can't match any email, don't query for it
+        if email and '@' in email and password is not None:
+            for user in get_login_queryset(filter_users_by_email(email)):
+                if hashing.check_password(user, password):
+                    return user
+        return None
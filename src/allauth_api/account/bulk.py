@@ -0,0 +1,249 @@
+"""
+Bulk user registration, for importing batches of accounts (e.g. from a partner).
+
+`register_users()` takes a list of rows (dicts with a username, an email and optionally a password,
+first_name, last_name and verified flag) and returns an iterator over one result per row, in order:
+
+    {"row": 0, "status": "created", "id": 42}
+    {"row": 1, "status": "rejected", "errors": {"email": ["..."]}}
+    {"row": 2, "status": "failed", "errors": {"__all__": ["..."]}}
+
+Rows are validated one by one without touching the database (passwords with the adapter's
+clean_password, so AUTH_PASSWORD_VALIDATORS apply), then duplicates within the batch and
+clashes with registered users are found with set-based queries (see find_registered_values).  This
+happens before register_users() returns.  The accepted rows are inserted as the results are
+consumed, BULK_REGISTER_CHUNK_SIZE at a time, users and their email addresses with bulk_create, one
+transaction per chunk; if a chunk fails (e.g. a user registered concurrently) its rows are reported
+as failed and the next chunks go on.  Confirmation mails for the unverified email
+addresses of each chunk are handed to the outbox together.
+
+Passwords are hashed on the PASSWORD_HASHING_EXECUTOR, if there is one, as each chunk is
+inserted.  Users without a password get an unusable one.  bulk_create doesn't send post_save or user_signed_up,
+the normalized identifiers and identifier filter are updated directly.
+"""
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext as _
+
+from allauth.account import app_settings
+from allauth.account.adapter import get_adapter
+from allauth.account.models import EmailAddress, EmailConfirmationHMAC
+from allauth.account.utils import user_email, user_field, user_username
+from allauth.utils import get_user_model
+
+from allauth_api.settings import allauth_api_settings
+from allauth_api.account import hashing, identifiers, identifier_filter, outbox
+from allauth_api.account.rest_framework.utils import find_registered_values
+
+import logging
+logger = logging.getLogger(__name__)
+
+CREATED = 'created'
+REJECTED = 'rejected'
+FAILED = 'failed'
+
+STRING_FIELDS = ('username', 'email', 'password', 'first_name', 'last_name')
+
+
+def normalize_username(username):
+    return username.lower() if allauth_api_settings.CASE_INSENSITIVE_IDS else username
+
+
+def clean_row(row, adapter):
+    """
+    Returns the cleaned (username, email, password) of a row and its errors
+    """
+    errors = {}
+    for field in STRING_FIELDS:
+        if row.get(field) is not None and not isinstance(row[field], six.string_types):
+            errors[field] = [_("Must be a string.")]
+    username, email, password = (row.get(field) if field not in errors else None
+                                 for field in ('username', 'email', 'password'))
+    username = username or None
+    email = (email or '').strip() or None
+    password = password or None
+
+    if app_settings.USER_MODEL_USERNAME_FIELD and 'username' not in errors:
+        if not username:
+            errors['username'] = [_("This field is required.")]
+        else:
+            try:
+                username = adapter.clean_username(username, shallow=True)
+            except ValidationError as e:
+                errors['username'] = e.messages
+    if email:
+        try:
+            validate_email(email)
+            email = adapter.clean_email(email)
+        except ValidationError as e:
+            errors['email'] = e.messages
+    elif app_settings.EMAIL_REQUIRED and 'email' not in errors:
+        errors['email'] = [_("This field is required.")]
+    if password:
+        # Validated like RegisterView does, against the user for the similarity validator
+        try:
+            adapter.clean_password(password, user=new_user(row, username, email, adapter, None))
+        except ValidationError as e:
+            errors['password'] = e.messages
+    return username, email, password, errors
+
+
+def find_registered_emails(emails):
+    """
+    Returns which of the (lowercased) emails are registered, as a user's email or an EmailAddress
+    """
+    registered = find_registered_values('email', emails) if app_settings.USER_MODEL_EMAIL_FIELD else set()
+    chunk_size = allauth_api_settings.REGISTRATIONS_QUERY_CHUNK_SIZE
+    addresses = EmailAddress.objects.annotate(_normalized_email=Lower('email'))
+    for i in range(0, len(emails), chunk_size):
+        registered.update(addresses.filter(_normalized_email__in=emails[i:i + chunk_size])
+                          .values_list('_normalized_email', flat=True))
+    return registered
+
+
+def validate_rows(rows):
+    """
+    Returns the (username, email, password, errors) of each row
+    """
+    adapter = get_adapter()
+    cleaned = []
+    usernames = {}
+    emails = {}
+    for i, row in enumerate(rows):
+        username, email, password, errors = clean_row(row, adapter)
+        cleaned.append((username, email, password, errors))
+        if not errors:
+            if username:
+                usernames.setdefault(normalize_username(username), []).append(i)
+            if email:
+                emails.setdefault(email.lower(), []).append(i)
+
+    # Duplicates within the batch: the first row wins
+    for values, field in ((usernames, 'username'), (emails, 'email')):
+        for indexes in values.values():
+            for i in indexes[1:]:
+                cleaned[i][3].setdefault(field, []).append(_("Duplicated in this batch."))
+
+    registered_usernames = find_registered_values(get_user_model().USERNAME_FIELD, list(usernames)) \
+        if app_settings.USER_MODEL_USERNAME_FIELD else set()
+    for username in registered_usernames:
+        cleaned[usernames[username][0]][3].setdefault('username', []).append(adapter.get_username_taken_message())
+    if app_settings.UNIQUE_EMAIL:
+        for email in find_registered_emails(list(emails)):
+            cleaned[emails[email][0]][3].setdefault('email', []).append(adapter.error_messages['email_taken'])
+    return cleaned
+
+
+def new_user(row, username, email, adapter, request):
+    user = adapter.new_user(request)
+    if username:
+        user_username(user, username)
+    if email:
+        user_email(user, email)
+    for field in ('first_name', 'last_name'):
+        if isinstance(row.get(field), six.string_types) and row[field]:
+            user_field(user, field, row[field])
+    return user
+
+
+def build_user(row, username, email, password, adapter, request):
+    user = new_user(row, username, email, adapter, request)
+    if password:
+        # On the PASSWORD_HASHING_EXECUTOR, if there is one
+        hashing.set_password(user, password)
+    else:
+        user.set_unusable_password()
+    return user
+
+
+def insert_users(users, verified):
+    """
+    Inserts the users and their email addresses.  Returns the unverified addresses
+    """
+    User = get_user_model()
+    User.objects.bulk_create(users)
+    if any(user.pk is None for user in users):
+        # Only some databases return the ids of bulk inserts
+        key = User.USERNAME_FIELD
+        pks = dict(User.objects.filter(**{key + '__in': [getattr(user, key) for user in users]})
+                   .values_list(key, 'pk'))
+        for user in users:
+            user.pk = pks[getattr(user, key)]
+
+    addresses = [EmailAddress(user=user, email=user_email(user), primary=True, verified=is_verified)
+                 for user, is_verified in zip(users, verified) if user_email(user)]
+    EmailAddress.objects.bulk_create(addresses)
+    if identifiers.is_enabled():
+        identifiers.sync_new_users(users)
+
+    unverified = dict((address.user_id, address) for address in addresses if not address.verified)
+    if not unverified:
+        return []
+    users_by_pk = dict((user.pk, user) for user in users)
+    # For the ids
+    addresses = list(EmailAddress.objects.filter(user__in=list(unverified), verified=False))
+    for address in addresses:
+        address.user = users_by_pk[address.user_id]
+    return addresses
+
+
+def send_confirmations(addresses, request):
+    with outbox.batch():
+        for address in addresses:
+            EmailConfirmationHMAC(address).send(request, signup=True)
+
+
+def register_users(rows, request=None, send_confirmation=True, chunk_size=None):
+    """
+    Validates rows and returns an iterator registering the accepted users chunk by chunk, yielding
+    the result of each row (see above)
+    """
+    if chunk_size is None:
+        chunk_size = allauth_api_settings.BULK_REGISTER_CHUNK_SIZE
+    cleaned = validate_rows(rows)
+    return insert_chunks(rows, cleaned, request, send_confirmation, chunk_size)
+
+
+def insert_chunks(rows, cleaned, request, send_confirmation, chunk_size):
+    adapter = get_adapter(request)
+    for start in range(0, len(rows), chunk_size):
+        results = {}
+        indexes = []
+        for i in range(start, min(start + chunk_size, len(rows))):
+            username, email, password, errors = cleaned[i]
+            if errors:
+                errors = dict((field, [force_text(message) for message in messages])
+                              for field, messages in errors.items())
+                results[i] = {'row': i, 'status': REJECTED, 'errors': errors}
+            else:
+                indexes.append(i)
+
+        if indexes:
+            try:
+                users = []
+                for i in indexes:
+                    username, email, password, errors = cleaned[i]
+                    users.append(build_user(rows[i], username, email, password, adapter, request))
+                verified = [rows[i].get('verified') in (True, 'true', 'True', '1', 1) for i in indexes]
+                with transaction.atomic():
+                    addresses = insert_users(users, verified)
+            except Exception as e:
+                # Any error only fails this chunk, e.g. a user registered (or renamed) concurrently or
+                # a full password hashing queue
+                logger.exception("Failed to insert users %d to %d", indexes[0], indexes[-1])
+                for i in indexes:
+                    results[i] = {'row': i, 'status': FAILED,
+                                  'errors': {'__all__': ["%s: %s" % (e.__class__.__name__, force_text(e))]}}
+            else:
+                identifier_filter.add_users(users)
+                for i, user in zip(indexes, users):
+                    results[i] = {'row': i, 'status': CREATED, 'id': user.pk}
+                if send_confirmation and app_settings.EMAIL_VERIFICATION != app_settings.EmailVerificationMethod.NONE:
+                    send_confirmations(addresses, request)
+
+        for i in sorted(results):
+            yield results[i]
@@ -0,0 +1,17 @@
+from django import forms
+from django.utils.translation import ugettext_lazy as _
+
+from allauth.account.forms import ChangePasswordForm as AllAuthChangePasswordForm
+
+from allauth_api.account import hashing
+
+
+class ChangePasswordForm(AllAuthChangePasswordForm):
+    """
+    allauth's ChangePasswordForm, checking the current password on the hashing executor
+    """
+
+    def clean_oldpassword(self):
+        if not hashing.check_password(self.user, self.cleaned_data.get("oldpassword")):
+            raise forms.ValidationError(_("Please type your current password."))
+        return self.cleaned_data["oldpassword"]
@@ -0,0 +1,161 @@
+"""
+Optional bounded executor for password hashing.
+
+Checking and setting passwords runs a deliberately slow hash (PBKDF2, bcrypt...) which, during a
+credential stuffing burst, can tie up every worker.  With PASSWORD_HASHING_EXECUTOR set to 'thread'
+or 'process', hashing is handed to a pool of PASSWORD_HASHING_WORKERS workers instead.  At most
+PASSWORD_HASHING_QUEUE_DEPTH jobs may wait for a free worker; beyond that HashingUnavailable is
+raised straight away so that the API can answer with a 503 and a Retry-After header instead of
+piling up requests.
+
+Threads are usually enough since hashlib's PBKDF2 releases the GIL.  The process pool relies on
+forked workers inheriting the configured Django settings.
+
+The Django and Django REST framework versions supported here have no async views, so serving many
+mostly-waiting requests per process means running under a cooperative (gevent) worker.  There a
+monkey-patched thread is just another greenlet and a hash run on it would stall the whole worker,
+so the 'thread' executor uses gevent's pool of native threads instead, which requests wait on
+without blocking each other.
+
+Passwords are only checked through the executor by allauth_api.account.auth_backends.AuthenticationBackend,
+so it must replace the default authentication backends.
+"""
+import logging
+import threading
+
+from django.contrib.auth import hashers
+
+from allauth_api.settings import allauth_api_settings
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def threading_is_patched():
+    """
+    Returns True if gevent has replaced threads with greenlets
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class HashingUnavailable(Exception):
+    """
+    Raised when the hashing queue is full
+    """
+
+    def __init__(self, retry_after):
+        super(HashingUnavailable, self).__init__("Password hashing queue is full")
+        self.retry_after = retry_after
+
+
+class HashingExecutor(object):
+    """
+    A pool of hashing workers with a bounded queue
+    """
+
+    def __init__(self, kind, workers, queue_depth, timeout=None, retry_after=1):
+        # concurrent.futures pulls in multiprocessing, only import it when hashing is offloaded
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        if kind == 'process':
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        elif threading_is_patched():
+            from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+            self.pool = NativeThreadPoolExecutor(max_workers=workers)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+    def run(self, func, *args):
+        from concurrent.futures import TimeoutError
+        if not self.slots.acquire(False):
+            raise HashingUnavailable(self.retry_after)
+        try:
+            future = self.pool.submit(func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HashingUnavailable(self.retry_after)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+def get_executor():
+    """
+    Returns the shared HashingExecutor, or None if hashing happens in the request thread
+    """
+    global _executor
+    kind = allauth_api_settings.PASSWORD_HASHING_EXECUTOR
+    if not kind:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = HashingExecutor(kind,
+                                        allauth_api_settings.PASSWORD_HASHING_WORKERS,
+                                        allauth_api_settings.PASSWORD_HASHING_QUEUE_DEPTH,
+                                        timeout=allauth_api_settings.PASSWORD_HASHING_TIMEOUT,
+                                        retry_after=allauth_api_settings.PASSWORD_HASHING_RETRY_AFTER)
+        return _executor
+
+
+def shutdown(wait=True):
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def check_password(user, raw_password):
+    """
+    Like user.check_password(), but runs the hash on the executor.  Passwords stored with an
+    outdated hasher are upgraded like Django does
+    """
+    executor = get_executor()
+    if executor is None:
+        return user.check_password(raw_password)
+
+    encoded = user.password
+    if raw_password is None or not hashers.is_password_usable(encoded):
+        return False
+    valid = executor.run(hashers.check_password, raw_password, encoded)
+    if valid:
+        preferred = hashers.get_hasher('default')
+        hasher = hashers.identify_hasher(encoded)
+        if hasher.algorithm != preferred.algorithm or preferred.must_update(encoded):
+            user.password = executor.run(hashers.make_password, raw_password)
+            user.save(update_fields=['password'])
+    return valid
+
+
+def make_password(raw_password):
+    """
+    Like django.contrib.auth.hashers.make_password(), but runs the hash on the executor
+    """
+    executor = get_executor()
+    if executor is None:
+        return hashers.make_password(raw_password)
+    return executor.run(hashers.make_password, raw_password)
+
+
+def set_password(user, raw_password):
+    """
+    Like user.set_password(), but runs the hash on the executor
+    """
+    if get_executor() is None:
+        user.set_password(raw_password)
+    else:
+        user.password = make_password(raw_password)
+        user._password = raw_password
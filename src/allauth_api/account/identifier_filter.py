@@ -0,0 +1,286 @@
+"""
+Negative lookup filter for user identifiers.
+
+Most registration checks and username availability checks are for identifiers that don't exist
+(signup forms checking as the user types, enumeration scripts).  With IDENTIFIER_FILTER on, a Bloom
+filter of every (lowercased) username and email is consulted first: when it says an identifier is
+definitely not registered, no query is run.  Only possible matches, about
+IDENTIFIER_FILTER_ERROR_RATE of the misses plus the actual hits, go to the database.
+
+A miss can only be trusted if every process registering users updates the same filter, so the
+filter needs IDENTIFIER_FILTER_PATH: it's kept in a memory-mapped file that every process on the
+host reads and updates, built by streaming the user table once, by whichever process needs it
+first, and updated as users are saved.  Delete the file while the workers are stopped to rebuild
+it.  Only turn the filter on when every process writing users runs on that host and creates them
+through save() or add_users(), otherwise the filter would claim that their users don't exist and
+uniqueness checks would be skipped.
+
+A Bloom filter can't forget, so deleted users and changed identifiers stay in it as false
+positives, which only cost the query they would have cost anyway.
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.encoding import force_bytes
+
+from allauth.account import app_settings
+from allauth.utils import get_user_model
+
+from allauth_api.settings import allauth_api_settings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+USERNAME = 'username'
+EMAIL = 'email'
+
+FILE_MAGIC = b'AAPIBLM1'
+# magic, number of bits, number of hashes, build time
+FILE_HEADER = struct.Struct('<8sQId')
+FILE_HEADER_SIZE = 32
+
+_filter = None
+_filter_lock = threading.Lock()
+
+
+def is_enabled():
+    return allauth_api_settings.IDENTIFIER_FILTER
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of num_bits bits and num_hashes hash functions, stored in buffer (a bytearray by
+    default, or any writable buffer such as an mmap)
+    """
+
+    def __init__(self, num_bits, num_hashes, buffer=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = buffer if buffer is not None else bytearray((num_bits + 7) // 8)
+
+    @classmethod
+    def get_parameters(cls, capacity, error_rate):
+        """
+        Returns the (num_bits, num_hashes) giving error_rate false positives with capacity items
+        """
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(int(round(num_bits / float(capacity) * math.log(2))), 1)
+        return num_bits, num_hashes
+
+    def positions(self, item):
+        # Double hashing: the k positions are h1 + i * h2
+        digest = hashlib.sha1(force_bytes(item)).digest()
+        h1, h2 = struct.unpack('<QQ', digest[:16])
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        bits = self.bits
+        for position in self.positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+
+def get_key(kind, identifier):
+    return "%s:%s" % (kind, identifier.lower())
+
+
+def get_user_keys(user):
+    keys = []
+    for kind, field in get_fields():
+        value = getattr(user, field, None)
+        if value:
+            keys.append(get_key(kind, value))
+    return keys
+
+
+def get_fields():
+    """
+    Returns the (kind, user model field) pairs stored in the filter
+    """
+    fields = []
+    for field in (app_settings.USER_MODEL_USERNAME_FIELD, get_user_model().USERNAME_FIELD):
+        if field and (USERNAME, field) not in fields:
+            fields.append((USERNAME, field))
+    if app_settings.USER_MODEL_EMAIL_FIELD:
+        fields.append((EMAIL, app_settings.USER_MODEL_EMAIL_FIELD))
+    return fields
+
+
+def scan_users(bloom):
+    """
+    Adds every user to the filter, streaming the user table
+    """
+    fields = get_fields()
+    users = get_user_model().objects.order_by().values_list(*[field for kind, field in fields]).iterator()
+    count = 0
+    for values in users:
+        for (kind, field), value in zip(fields, values):
+            if value:
+                bloom.add(get_key(kind, value))
+        count += 1
+    return count
+
+
+class IdentifierFilter(object):
+    """
+    The identifier filter of this process, backed by the file at path (see above)
+    """
+
+    def __init__(self, capacity, error_rate, path):
+        self.num_bits, self.num_hashes = BloomFilter.get_parameters(capacity, error_rate)
+        self.path = path
+        self.bloom = None
+        self.built_at = None
+        self.file = None
+        self.lock = threading.RLock()
+
+    def contains(self, kind, identifier):
+        bloom = self.get_bloom()
+        return get_key(kind, identifier) in bloom
+
+    def get_bloom(self):
+        if self.bloom is None:
+            with self.lock:
+                if self.bloom is None:
+                    self.open_file()
+        return self.bloom
+
+    def open_file(self):
+        size = FILE_HEADER_SIZE + (self.num_bits + 7) // 8
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.file = os.fdopen(fd, 'r+b')
+        with self.file_lock():
+            header = self.file.read(FILE_HEADER.size)
+            built = False
+            if len(header) == FILE_HEADER.size and os.fstat(fd).st_size == size:
+                magic, num_bits, num_hashes, built_at = FILE_HEADER.unpack(header)
+                built = (magic, num_bits, num_hashes) == (FILE_MAGIC, self.num_bits, self.num_hashes) and built_at
+            if not built:
+                # Missing, or built with other parameters
+                self.file.truncate(0)
+                self.file.truncate(size)
+            data = mmap.mmap(self.file.fileno(), size)
+            bloom = BloomFilter(self.num_bits, self.num_hashes, memoryview(data)[FILE_HEADER_SIZE:])
+            if built:
+                self.built_at = built_at
+            else:
+                self.built_at = time.time()
+                count = scan_users(bloom)
+                data[:FILE_HEADER.size] = FILE_HEADER.pack(FILE_MAGIC, self.num_bits, self.num_hashes, self.built_at)
+                data.flush()
+                logger.info("Built the identifier filter of %d users in %s", count, self.path)
+            self.bloom = bloom
+
+    def file_lock(self):
+        return FileLock(self.file if fcntl is not None else None)
+
+    def add_user(self, user):
+        keys = get_user_keys(user)
+        with self.lock:
+            # The file is never scanned again, the user must go in now
+            bloom = self.get_bloom()
+            with self.file_lock():
+                for key in keys:
+                    bloom.add(key)
+
+    def close(self):
+        with self.lock:
+            self.bloom = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class FileLock(object):
+    """
+    Exclusive lock on the filter file, so that processes don't overwrite each other's bits
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+
+def get_filter():
+    global _filter
+    if _filter is None:
+        with _filter_lock:
+            if _filter is None:
+                _filter = IdentifierFilter(allauth_api_settings.IDENTIFIER_FILTER_CAPACITY,
+                                           allauth_api_settings.IDENTIFIER_FILTER_ERROR_RATE,
+                                           allauth_api_settings.IDENTIFIER_FILTER_PATH)
+    return _filter
+
+
+def reset():
+    """
+    Drops the filter of this process, it will be built again with the current settings
+    """
+    global _filter
+    with _filter_lock:
+        if _filter is not None:
+            _filter.close()
+        _filter = None
+
+
+def might_be_registered(kind, identifier):
+    """
+    Returns False if no user has the identifier (a username or an email, depending on kind), True if
+    one may have it or IDENTIFIER_FILTER is off
+    """
+    if not is_enabled():
+        return True
+    return get_filter().contains(kind, identifier)
+
+
+def get_filter_to_update():
+    """
+    Returns the filter that saved users must be added to, or None.  Even if this process hasn't used
+    the filter yet, the other ones may have
+    """
+    return get_filter() if is_enabled() else None
+
+
+def add_users(users):
+    """
+    Adds users created without post_save signals (bulk_create) to the filter
+    """
+    id_filter = get_filter_to_update()
+    if id_filter is None:
+        return
+    for user in users:
+        id_filter.add_user(user)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_saved_handler(sender, instance, update_fields=None, **kwargs):
+    id_filter = get_filter_to_update()
+    if id_filter is None:
+        return
+    if update_fields is not None:
+        watched = set(field for kind, field in get_fields())
+        if not watched.intersection(update_fields):
+            return
+    id_filter.add_user(instance)
@@ -0,0 +1,139 @@
+"""
+Normalized user identifiers.
+
+With CASE_INSENSITIVE_IDS, looking users up with __iexact can't use the unique index on the
+username column, so every check scans the user table.  Turning NORMALIZED_IDS on as well keeps a
+lowercased copy of each user's username and email in the NormalizedIdentifier table, where
+usernames are covered by a unique index and emails by a plain one, and rewrites the lookups as
+exact matches on it.
+
+The table is kept up to date when users are saved; fill it for existing users with the
+rebuild_normalized_identifiers management command.  Usernames are kept unique regardless of case:
+saving a user whose username is taken in another case raises UsernameTaken (an IntegrityError)
+before the user is written.  The unique index catches concurrent saves that get past that check;
+inside a transaction UsernameTaken is raised so the user is rolled back with it, otherwise the user
+is already committed and is stored without a normalized username (it can't log in by username) and
+a warning is logged.
+"""
+import logging
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models.signals import pre_save, post_save
+from django.dispatch import receiver
+
+from allauth.account import app_settings
+from allauth.utils import get_user_model
+
+from allauth_api.settings import allauth_api_settings
+
+logger = logging.getLogger(__name__)
+
+
+class UsernameTaken(IntegrityError):
+    """
+    Raised when saving a user whose username another user has in a different case
+    """
+    pass
+
+
+def is_enabled():
+    return allauth_api_settings.CASE_INSENSITIVE_IDS and allauth_api_settings.NORMALIZED_IDS
+
+
+def normalize(identifier):
+    return identifier.lower() if identifier else identifier
+
+
+def get_identifier_values(user):
+    """
+    Returns the normalized (username, email) of a user
+    """
+    username_field = app_settings.USER_MODEL_USERNAME_FIELD
+    email_field = app_settings.USER_MODEL_EMAIL_FIELD
+    username = getattr(user, username_field, None) if username_field else None
+    email = getattr(user, email_field, None) if email_field else None
+    return normalize(username) or None, normalize(email) or ''
+
+
+def sync_user(user):
+    """
+    Stores the normalized identifiers of a user.  Raises UsernameTaken if another user already
+    has the same normalized username
+    """
+    from allauth_api.models import NormalizedIdentifier
+
+    username, email = get_identifier_values(user)
+    try:
+        with transaction.atomic():
+            if not NormalizedIdentifier.objects.filter(user=user).update(username=username, email=email):
+                NormalizedIdentifier.objects.create(user=user, username=username, email=email)
+    except IntegrityError:
+        raise UsernameTaken("Username '%s' is taken in another case" % username)
+
+
+def sync_new_users(users):
+    """
+    Stores the normalized identifiers of users created without post_save signals (bulk_create)
+    """
+    from allauth_api.models import NormalizedIdentifier
+
+    NormalizedIdentifier.objects.bulk_create([
+        NormalizedIdentifier(user_id=user.pk, username=username, email=email)
+        for user, (username, email) in ((user, get_identifier_values(user)) for user in users)])
+
+
+def filter_users_by_username(*usernames):
+    return get_user_model().objects.filter(
+        normalized_identifier__username__in=[normalize(u) for u in usernames])
+
+
+def find_registered(field, values):
+    """
+    Returns which of the (normalized) values of field ('username' or 'email') are registered
+    """
+    from allauth_api.models import NormalizedIdentifier
+
+    return set(NormalizedIdentifier.objects.filter(**{field + '__in': values}).values_list(field, flat=True))
+
+
+def is_watched(update_fields):
+    if update_fields is None:
+        return True
+    watched = set(filter(None, [app_settings.USER_MODEL_USERNAME_FIELD, app_settings.USER_MODEL_EMAIL_FIELD]))
+    # e.g. save(update_fields=['last_login']) on every login
+    return bool(watched.intersection(update_fields))
+
+
+def in_transaction():
+    return connection.in_atomic_block
+
+
+@receiver(pre_save, sender=get_user_model())
+def user_saving_handler(sender, instance, update_fields=None, raw=False, **kwargs):
+    from allauth_api.models import NormalizedIdentifier
+
+    if raw or not is_enabled() or not is_watched(update_fields):
+        return
+    username, email = get_identifier_values(instance)
+    if username and NormalizedIdentifier.objects.filter(username=username).exclude(user_id=instance.pk).exists():
+        raise UsernameTaken("Username '%s' is taken in another case" % username)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_saved_handler(sender, instance, update_fields=None, raw=False, **kwargs):
+    from allauth_api.models import NormalizedIdentifier
+
+    if raw or not is_enabled() or not is_watched(update_fields):
+        return
+    try:
+        sync_user(instance)
+    except UsernameTaken:
+        if in_transaction():
+            # Rolled back with the user
+            raise
+        # The user is committed already, keep its email lookups working
+        logger.warning("User %s was saved with a username taken by another user in a different case, "
+                       "it won't be found by username", instance.pk)
+        username, email = get_identifier_values(instance)
+        if not NormalizedIdentifier.objects.filter(user=instance).update(username=None, email=email):
+            NormalizedIdentifier.objects.create(user=instance, username=None, email=email)
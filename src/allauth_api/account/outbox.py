@@ -0,0 +1,256 @@
+"""
+Outbox backends for the emails sent by the account views (email confirmations, password resets).
+
+The outbox class is selected with the EMAIL_OUTBOX_CLASS setting:
+
+ImmediateOutbox - sends the message inline, in the request thread (the default)
+DatabaseOutbox - stores the message in the OutboxMessage table.  Messages are delivered by the
+                 `process_email_outbox` management command
+ThreadedOutbox - stores the message like DatabaseOutbox and hands it to an in-process thread pool
+                 once the surrounding transaction commits, so the request returns immediately
+
+Messages sent inside a `batch()` block are collected and handed to the outbox together when the
+block ends, which the database outboxes store with one bulk insert.
+
+A failed delivery is retried after EMAIL_OUTBOX_RETRY_DELAY seconds, doubling on each attempt up
+to EMAIL_OUTBOX_MAX_RETRY_DELAY.  After EMAIL_OUTBOX_MAX_ATTEMPTS the message is left FAILED.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.core.mail import get_connection
+from django.db import connection as db_connection, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from allauth_api.settings import allauth_api_settings
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_outbox():
+    messages = getattr(_local, 'batch', None)
+    if messages is not None:
+        return CollectingOutbox(messages)
+    return allauth_api_settings.EMAIL_OUTBOX_CLASS()
+
+
+@contextmanager
+def batch():
+    """
+    Collects the messages enqueued (in this thread) inside the block, and enqueues them all at once
+    at the end.  Messages are dropped if the block raises
+    """
+    previous = getattr(_local, 'batch', None)
+    _local.batch = messages = []
+    try:
+        yield
+    finally:
+        _local.batch = previous
+    if messages:
+        get_outbox().enqueue_many(messages)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(max_workers=allauth_api_settings.EMAIL_OUTBOX_WORKERS)
+        return _executor
+
+
+def shutdown(wait=True):
+    """
+    Stops the in-process drainer, waiting for queued deliveries if `wait` is True.  A new pool is
+    created on the next enqueue.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def on_commit(func):
+    # transaction.on_commit is only available in Django 1.9+
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func)
+    else:
+        func()
+
+
+class BaseOutbox(object):
+    """
+    Base class for outbox backends
+    """
+
+    def enqueue(self, message):
+        raise NotImplementedError("subclass and implement")
+
+    def enqueue_many(self, messages):
+        for message in messages:
+            self.enqueue(message)
+
+
+class CollectingOutbox(BaseOutbox):
+    """
+    Collects messages for batch()
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def enqueue(self, message):
+        self.messages.append(message)
+
+
+class ImmediateOutbox(BaseOutbox):
+    """
+    Sends messages right away
+    """
+
+    def enqueue(self, message):
+        message.send()
+
+
+class DatabaseOutbox(BaseOutbox):
+    """
+    Stores messages in the database to be delivered by a worker
+    """
+
+    def enqueue(self, message):
+        from allauth_api.models import OutboxMessage
+        entry = OutboxMessage()
+        entry.set_message(message)
+        entry.save()
+        return entry
+
+    def enqueue_many(self, messages):
+        from allauth_api.models import OutboxMessage
+        entries = []
+        for message in messages:
+            entry = OutboxMessage()
+            entry.set_message(message)
+            entries.append(entry)
+        return OutboxMessage.objects.bulk_create(entries, batch_size=allauth_api_settings.EMAIL_OUTBOX_BATCH_SIZE)
+
+    def get_queryset(self):
+        from allauth_api.models import OutboxMessage
+        return OutboxMessage.objects.filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now()),
+                                            status=OutboxMessage.PENDING)
+
+    def release_stale(self, timeout):
+        """
+        Puts messages claimed by a worker that died more than `timeout` seconds ago back in the queue
+        """
+        from allauth_api.models import OutboxMessage
+        cutoff = now() - timedelta(seconds=timeout)
+        return OutboxMessage.objects.filter(status=OutboxMessage.SENDING,
+                                            updated__lt=cutoff).update(status=OutboxMessage.PENDING)
+
+    def drain(self, limit=None, ids=None):
+        """
+        Delivers pending messages over a single mail connection.  Returns a (sent, failed) tuple
+        """
+        if limit is None:
+            limit = allauth_api_settings.EMAIL_OUTBOX_BATCH_SIZE
+        queryset = self.get_queryset()
+        if ids is not None:
+            queryset = queryset.filter(pk__in=ids)
+        entries = list(queryset[:limit])
+        if not entries:
+            return (0, 0)
+
+        sent = failed = 0
+        connection = get_connection()
+        try:
+            connection.open()
+            for entry in entries:
+                if not self.claim(entry):
+                    continue
+                if self.deliver(entry, connection):
+                    sent += 1
+                else:
+                    failed += 1
+        finally:
+            connection.close()
+        return (sent, failed)
+
+    def claim(self, entry):
+        """
+        Marks the entry as being sent.  Returns False if another worker got to it first
+        """
+        from allauth_api.models import OutboxMessage
+        claimed = OutboxMessage.objects.filter(pk=entry.pk, status=OutboxMessage.PENDING).update(
+            status=OutboxMessage.SENDING, updated=now())
+        return claimed == 1
+
+    def deliver(self, entry, connection):
+        from allauth_api.models import OutboxMessage
+        entry.attempts += 1
+        try:
+            message = entry.get_message()
+            message.connection = connection
+            message.send()
+        except Exception as e:
+            logger.exception("Failed to deliver outbox message %s", entry.pk)
+            entry.last_error = "%s: %s" % (e.__class__.__name__, e)
+            if entry.attempts >= allauth_api_settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+                entry.status = OutboxMessage.FAILED
+                entry.next_attempt_at = None
+            else:
+                entry.status = OutboxMessage.PENDING
+                entry.next_attempt_at = now() + timedelta(seconds=self.get_retry_delay(entry.attempts))
+            entry.save(update_fields=['status', 'attempts', 'next_attempt_at', 'last_error', 'updated'])
+            return False
+        entry.status = OutboxMessage.SENT
+        entry.sent = now()
+        entry.next_attempt_at = None
+        entry.save(update_fields=['status', 'attempts', 'next_attempt_at', 'sent', 'updated'])
+        return True
+
+    def get_retry_delay(self, attempts):
+        """
+        Seconds to wait before retrying a message that failed `attempts` times
+        """
+        delay = allauth_api_settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+        return min(delay, allauth_api_settings.EMAIL_OUTBOX_MAX_RETRY_DELAY)
+
+
+class ThreadedOutbox(DatabaseOutbox):
+    """
+    Stores messages in the database and delivers them from an in-process thread pool.  Messages
+    that are not delivered (e.g. the process exits first) are left for the management command
+    """
+
+    def enqueue(self, message):
+        entry = super(ThreadedOutbox, self).enqueue(message)
+        on_commit(lambda: self.submit([entry.pk]))
+        return entry
+
+    def enqueue_many(self, messages):
+        entries = super(ThreadedOutbox, self).enqueue_many(messages)
+        ids = [entry.pk for entry in entries]
+        batch_size = allauth_api_settings.EMAIL_OUTBOX_BATCH_SIZE
+        if None in ids:
+            # The database doesn't return the ids of bulk inserts, drain the queue instead
+            on_commit(lambda: [self.submit(None) for i in range(0, len(ids), batch_size)])
+        else:
+            on_commit(lambda: [self.submit(ids[i:i + batch_size]) for i in range(0, len(ids), batch_size)])
+        return entries
+
+    def submit(self, ids):
+        return get_executor().submit(self.drain_in_thread, ids)
+
+    def drain_in_thread(self, ids):
+        try:
+            return self.drain(ids=ids)
+        finally:
+            db_connection.close()
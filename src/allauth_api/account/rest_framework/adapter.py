@@ -9,12 +9,16 @@ from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
 
-from PIL import Image
-
 from allauth.account import app_settings
 from allauth.utils import get_user_model
 
 from allauth_api.settings import allauth_api_settings
+from allauth_api.account.outbox import get_outbox
+from allauth_api.account.utils import read_png_text, InvalidImageKey
+from allauth_api.account import hashing, identifiers, identifier_filter
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class AccountAdapterMixin(object):
@@ -45,23 +49,60 @@ class AccountAdapterMixin(object):
             raise forms.ValidationError(
                 self.error_messages['username_blacklisted'])
         # Skipping database lookups when shallow is True, needed for unique
-        # username generation.
-        if not shallow:
+        # username generation.  With NORMALIZED_IDS the unique index does the checking when the
+        # user is saved, and usernames the identifier filter has never seen are free
+        if not shallow and not identifiers.is_enabled() and identifier_filter.might_be_registered(
+                identifier_filter.USERNAME, username):
             from .utils import filter_users_by_username
             if filter_users_by_username(username).exists():
-                user_model = get_user_model()
-                username_field = app_settings.USER_MODEL_USERNAME_FIELD
-                error_message = user_model._meta.get_field(
-                    username_field).error_messages.get('unique')
-                if not error_message:
-                    error_message = self.error_messages['username_taken']
-                raise forms.ValidationError(error_message)
+                raise forms.ValidationError(self.get_username_taken_message())
         return username
 
+    def get_username_taken_message(self):
+        user_model = get_user_model()
+        username_field = app_settings.USER_MODEL_USERNAME_FIELD
+        error_message = user_model._meta.get_field(
+            username_field).error_messages.get('unique')
+        if not error_message:
+            error_message = self.error_messages['username_taken']
+        return error_message
+
     def login(self, request, user):
         super(AccountAdapterMixin, self).login(request, user)
         return {'detail': 'User logged in.'}
 
+    def save_user(self, request, user, form, commit=True):
+        """
+        Hashes the new user's password on the hashing executor (see PASSWORD_HASHING_EXECUTOR)
+        """
+        if hashing.get_executor() is None:
+            return super(AccountAdapterMixin, self).save_user(request, user, form, commit)
+
+        data = form.cleaned_data
+        password = data.pop('password1', None)
+        try:
+            user = super(AccountAdapterMixin, self).save_user(request, user, form, commit=False)
+        finally:
+            if password is not None:
+                data['password1'] = password
+        if password is not None:
+            hashing.set_password(user, password)
+        if commit:
+            user.save()
+        return user
+
+    def set_password(self, user, password):
+        hashing.set_password(user, password)
+        user.save()
+
+    def send_mail(self, template_prefix, email, context):
+        """
+        Hands the rendered message to the configured outbox (see EMAIL_OUTBOX_CLASS) instead of
+        sending it inline
+        """
+        msg = self.render_mail(template_prefix, email, context)
+        get_outbox().enqueue(msg)
+
     def add_message(self, request, level, message_template, message_context=None, extra_tags=''):
         if allauth_api_settings.USE_DJANGO_MESSAGES:
             super(AccountAdapterMixin, self).add_message(request, level, message_template, message_context, extra_tags)
@@ -147,28 +188,27 @@ class ImageKeyMixin(object):
             'password1': request.data.get('password1', None),
             'password2': request.data.get('password2', None),
         }
-        key_image = request.data.get('key', None)
-        if key_image:
-            try:
-                image = Image.open(key_image)
-                key_text = image.text.get('key', None)
-                image.close()
-            except:
-                key_text = key_image  # Fall back on single text key
-            if key_text:
-                i = key_text.index('-')
-                data['uidb36'] = key_text[0:i]
-                data['key'] = key_text[i + 1:]
+        key_text = self.read_image_key(request.data.get('key', None))
+        if key_text and '-' in key_text:
+            i = key_text.index('-')
+            data['uidb36'] = key_text[0:i]
+            data['key'] = key_text[i + 1:]
 
         return data
 
     def email_confirmation_key(self, request):
-        key = None
-        key_image = request.data.get('key', None)
-        if key_image:
-            try:
-                key = Image.open(key_image).text.get('key', None)
-                key_image.close()
-            except:
-                key = key_image  # Fall back on text key
-        return key
+        return self.read_image_key(request.data.get('key', None))
+
+    def read_image_key(self, key_image):
+        """
+        Returns the key embedded in an uploaded image, or key_image itself if it is plain text
+        """
+        if not key_image or not hasattr(key_image, 'read'):
+            return key_image or None  # Fall back on text key
+        try:
+            return read_png_text(key_image)
+        except InvalidImageKey as e:
+            logger.info("Invalid image key: %s", e)
+            return None
+        finally:
+            key_image.close()
@@ -1,13 +1,20 @@
-from django.contrib.auth import logout as auth_logout
+import django
+from django.contrib.auth import get_user_model, logout as auth_logout
+from django.utils.functional import SimpleLazyObject
 
 from rest_framework.status import HTTP_401_UNAUTHORIZED, HTTP_204_NO_CONTENT
 from rest_framework.response import Response
-from rest_framework.authentication import BaseAuthentication, BasicAuthentication
+from rest_framework.authentication import (BaseAuthentication, BasicAuthentication, TokenAuthentication,
+                                           get_authorization_header)
 from rest_framework.exceptions import AuthenticationFailed
 
 from allauth.account import app_settings
 
-from .utils import perform_login, RestFrameworkTokenGenerator, serializer_error_string
+from allauth_api.account.auth_backends import VERIFIED_EMAIL_ATTRIBUTE
+from allauth_api.instrumentation import phase
+
+from .utils import (perform_login, RestFrameworkTokenGenerator, DeviceTokenGenerator, SignedTokenGenerator,
+                    InvalidSignedToken, serializer_error_string)
 from .serializers import UserPassSerializer
 
 
@@ -62,9 +69,97 @@ class UserPassAuthentication(BaseAuthentication):
         return result
 
 
+class DeviceTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication for the tokens issued by DeviceTokenLogin, passed in the "Authorization"
+    header prepended with "Device ", so that they don't clash with rest_framework's TokenAuthentication.
+    The token is looked up by its primary key and is available as request.auth
+    """
+    keyword = 'Device'
+
+    @property
+    def model(self):
+        from allauth_api.models import DeviceToken
+        return DeviceToken
+
+
+if django.VERSION < (1, 10):
+    def _authenticated():
+        return True
+
+    def _anonymous():
+        return False
+else:
+    try:
+        from django.utils.deprecation import CallableTrue as _authenticated, CallableFalse as _anonymous
+    except ImportError:
+        _authenticated, _anonymous = True, False
+
+
+class LazyTokenUser(SimpleLazyObject):
+    """
+    The user of a signed token.  The id (pk) and authentication status are known from the token, the
+    user itself is only loaded from the database when any other attribute is accessed
+    """
+
+    def __init__(self, user_id):
+        super(LazyTokenUser, self).__init__(lambda: get_user_model()._default_manager.get(pk=user_id))
+        self.__dict__['pk'] = self.__dict__['id'] = user_id
+
+    @property
+    def is_authenticated(self):
+        return _authenticated
+
+    @property
+    def is_anonymous(self):
+        return _anonymous
+
+    def __bool__(self):
+        return True
+    __nonzero__ = __bool__
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """
+    Authenticates the stateless tokens issued by SignedTokenLogin, passed in the "Authorization" header
+    prepended with "Bearer ".  Verifying a token is pure CPU work plus one cache lookup for revocations,
+    request.user is a LazyTokenUser and request.auth holds the token's claims.
+
+    Note that because the user isn't loaded, deactivated users keep access until their tokens expire
+    unless their tokens are revoked with SignedTokenGenerator.revoke_all_tokens()
+
+    Bearer tokens that aren't signed tokens (e.g. OAuth2 access tokens) are left to the other
+    authentication classes
+    """
+    keyword = 'Bearer'
+    token_generator_class = SignedTokenGenerator
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode() or len(auth) != 2:
+            return None
+
+        generator = self.token_generator_class()
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            return None
+        if not generator.is_signed_token(key):
+            return None
+        try:
+            claims = generator.verify(key)
+        except InvalidSignedToken as e:
+            raise AuthenticationFailed(str(e) or 'Invalid token.')
+        return (LazyTokenUser(claims['uid']), claims)
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
 class BaseLogin(object):
     """
-    Base class for a login handler.  All Login handlers should subclass this class
+    Base class for a login handler.  All Login handlers should subclass this class.  A single
+    instance of each handler serves every request, so handlers must not keep per-request state
     """
 
     auth_class = BaseAuthentication
@@ -73,14 +168,20 @@ class BaseLogin(object):
         logger.debug("BaseLogin")
         user = None
         try:
-            user, _ = self.authenticate(request)
+            with phase('authenticate'):
+                user, _ = self.authenticate(request)
         except AuthenticationFailed as err:
             return Response({'detail': err.detail}, err.status_code)
 
         if user is not None:
-            return perform_login(request, user, email_verification=app_settings.EMAIL_VERIFICATION,
-                                 return_data=self.get_return_data(request, user),
-                                 signal_kwargs=self.get_signal_kwargs(request, user))
+            with phase('login'):
+                response = perform_login(request, user, email_verification=app_settings.EMAIL_VERIFICATION,
+                                         return_data=self.get_return_data(request, user),
+                                         signal_kwargs=self.get_signal_kwargs(request, user),
+                                         verified=getattr(user, VERIFIED_EMAIL_ATTRIBUTE, None))
+            # The authenticated user, even if perform_login turned them away
+            response.login_user = user
+            return response
         return Response({'detail': 'User authentication failed'}, HTTP_401_UNAUTHORIZED)
 
     def logout(self, request, **kwargs):
@@ -114,12 +215,48 @@ class TokenLogin(BasicLogin):
     token_generator_class = RestFrameworkTokenGenerator
 
     def get_return_data(self, request, user):
-        return {'token': self.token_generator_class().get_token(user).key}
+        return {'token': self.token_generator_class().get_token(user, **self.get_token_kwargs(request)).key}
+
+    def get_token_kwargs(self, request):
+        return {}
 
     def logout(self, request, **kwargs):
-        self.token_generator_class().revoke_token(request)
+        generator = self.token_generator_class()
+        if self.revoke_all_requested(request):
+            generator.revoke_all_tokens(request.user)
+        else:
+            generator.revoke_token(request)
         return Response(None, HTTP_204_NO_CONTENT)
 
+    def revoke_all_requested(self, request):
+        return request.data.get('all_devices') in (True, 'true', 'True', '1', 1)
+
+
+class DeviceTokenLogin(TokenLogin):
+    """
+    A login class like TokenLogin, but that issues a new token for every login.  Clients may send
+    a `device` label with the credentials.  Logging out revokes only the token used for the request,
+    unless `all_devices` is sent, in which case all of the user's tokens are revoked.  Requests must
+    be authenticated with DeviceTokenAuthentication ("Authorization: Device <token>")
+    """
+    token_generator_class = DeviceTokenGenerator
+
+    def get_token_kwargs(self, request):
+        return {'device': request.data.get('device', '')}
+
+
+class SignedTokenLogin(TokenLogin):
+    """
+    A login class that returns a stateless signed token (see SignedTokenGenerator) and its expiry
+    time.  Requests must be authenticated with SignedTokenAuthentication.  Logging out revokes the
+    token used for the request, or all of the user's tokens if `all_devices` is sent
+    """
+    token_generator_class = SignedTokenGenerator
+
+    def get_return_data(self, request, user):
+        token = self.token_generator_class().get_token(user, **self.get_token_kwargs(request))
+        return {'token': token.key, 'expires': token.claims['exp']}
+
 
 # class OAuth2Login(BaseLogin):
 #     """
@@ -1,16 +1,22 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 
-from allauth.account.models import EmailAddress
-from allauth.account.utils import send_email_confirmation
+from django.utils.translation import ugettext_lazy as _
 
 from allauth_api.settings import allauth_api_settings
+from allauth_api.account.verification import has_verified_email, send_email_confirmation
 
 
 class EmailVerified(BasePermission):
     def has_permission(self, request, view):
-        if not EmailAddress.objects.filter(user=request.user, verified=True).exists():
+        if not has_verified_email(request.user):
             if allauth_api_settings.AUTO_SEND_EMAIL_CONFIRMATION:
-                send_email_confirmation(request, request.user)
+                # Duplicate sends inside the resend interval are skipped by the ledger
+                sent, next_allowed = send_email_confirmation(request, request.user)
+                if next_allowed is not None:
+                    self.message = {
+                        'detail': _("Email address not verified."),
+                        'next_send_allowed': next_allowed.isoformat(),
+                    }
             return False
         return True
 
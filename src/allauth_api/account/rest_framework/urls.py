@@ -1,18 +1,27 @@
+from django.conf import settings
 from django.conf.urls import url
 
 from . import views
-from oauth2_provider.views.base import TokenView, RevokeTokenView
 
 urlpatterns = [
     url(r"^register/$", views.register, name="account_api_register"),
+    url(r"^register/bulk/$", views.bulk_register, name="account_api_bulk_register"),
+    url(r"^registrations/$", views.check_registrations, name="account_api_check_registrations"),
     url(r"^registrations/(?P<user_id>[^/]+)/$", views.check_registration, name="account_api_check_registration"),
     url(r"^send-email-confirmation/$", views.send_email_confirmation, name="account_api_send_email_confirmation"),
     url(r"^confirm-email/$", views.confirm_email, name="account_api_confirm_email"),
     url(r"^login/$", views.login, name="account_api_login"),
-    url(r"^oauth-login/$", TokenView.as_view(), name="account_api_oauth2_login"),
     url(r"^logout/$", views.logout, name="account_api_logout"),
-    url(r"^oauth-logout/$", RevokeTokenView, name="account_api_oauth2_logout"),
     url(r"^password/$", views.change_password, name="account_api_change_password"),
     url(r"^password/reset/$", views.reset_password, name="account_api_reset_password"),
     url(r"^password/reset/confirm/$", views.confirm_reset_password, name="account_api_reset_password_confirm"),
 ]
+
+# django-oauth-toolkit (and oauthlib behind it) is only imported when it is installed
+if 'oauth2_provider' in settings.INSTALLED_APPS:
+    from oauth2_provider.views.base import TokenView, RevokeTokenView
+
+    urlpatterns += [
+        url(r"^oauth-login/$", TokenView.as_view(), name="account_api_oauth2_login"),
+        url(r"^oauth-logout/$", RevokeTokenView.as_view(), name="account_api_oauth2_logout"),
+    ]
@@ -1,14 +1,26 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import namedtuple
 from io import BytesIO
 from django.core.handlers.wsgi import WSGIRequest
 from django.conf import settings
+from django.utils.encoding import force_bytes, force_text
 from django.db.models import Q
+from django.db.models.functions import Lower
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ImproperlyConfigured
 from allauth.account import app_settings
-from allauth.account.utils import send_email_confirmation, get_adapter, messages, signals
+from allauth.account.utils import get_adapter, messages, signals
 from rest_framework.response import Response
 from rest_framework.status import (HTTP_200_OK, HTTP_201_CREATED, HTTP_403_FORBIDDEN, HTTP_401_UNAUTHORIZED)
 from allauth_api.settings import allauth_api_settings
+from allauth_api.account.verification import has_verified_email, send_email_confirmation
+from allauth_api.account import identifiers, identifier_filter
 
 
 class BaseTokenGenerator(object):
@@ -22,6 +34,9 @@ class BaseTokenGenerator(object):
     def revoke_token(self, user):
         raise NotImplementedError("subclass and implement")
 
+    def revoke_all_tokens(self, user):
+        raise NotImplementedError("subclass and implement")
+
 
 class RestFrameworkTokenGenerator(BaseTokenGenerator):
     """
@@ -34,7 +49,9 @@ class RestFrameworkTokenGenerator(BaseTokenGenerator):
 
     def get_token(self, user):
         from rest_framework.authtoken.models import Token
-        token, _ = Token.objects.get_or_create(user=user)
+        token = get_joined_token(user)
+        if token is None:
+            token, _ = Token.objects.get_or_create(user=user)
         return token
 
     def revoke_token(self, request):
@@ -47,29 +64,193 @@ class RestFrameworkTokenGenerator(BaseTokenGenerator):
         if token is not None:
             token.delete()
 
+    def revoke_all_tokens(self, user):
+        from rest_framework.authtoken.models import Token
+        Token.objects.filter(user=user).delete()
+
+
+def get_joined_token(user):
+    """
+    Returns the rest_framework token fetched along with the user (see
+    auth_backends.get_login_queryset), or None
+    """
+    descriptor = getattr(type(user), 'auth_token', None)
+    if descriptor is None:
+        return None
+    related = descriptor.related
+    if hasattr(related, 'is_cached'):
+        # Django >= 2.0
+        return related.get_cached_value(user) if related.is_cached(user) else None
+    return getattr(user, descriptor.cache_name, None)
+
+
+class DeviceTokenGenerator(BaseTokenGenerator):
+    """
+    Class that issues allauth_api.models.DeviceToken tokens, one per login, so a user can be logged in
+    on several devices at once
+    """
+
+    def get_token(self, user, device=''):
+        from allauth_api.models import DeviceToken
+        # A fresh key never collides, so this is a single INSERT
+        return DeviceToken.objects.create(user=user, device=(device or '')[:64])
+
+    def revoke_token(self, request):
+        from allauth_api.models import DeviceToken
+        token = request.auth
+        if isinstance(token, DeviceToken):
+            DeviceToken.objects.filter(pk=token.pk).delete()
+
+    def revoke_all_tokens(self, user):
+        from allauth_api.models import DeviceToken
+        DeviceToken.objects.filter(user=user).delete()
+
+
+SignedToken = namedtuple('SignedToken', ['key', 'claims'])
+
+
+class InvalidSignedToken(Exception):
+    pass
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64decode(data):
+    data = force_bytes(data)
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class SignedTokenGenerator(BaseTokenGenerator):
+    """
+    Class that issues stateless, HMAC-SHA256 signed tokens of the form <key id>.<claims>.<signature>
+
+    The claims carry the user id (uid), a unique token id (jti), the issue time (iat) and the expiry
+    (exp), so a token can be verified without touching the database.  Signing keys are configured
+    in SIGNED_TOKEN_KEYS ({key id: secret}, defaulting to SECRET_KEY) and new tokens are signed with
+    the SIGNED_TOKEN_KEY_ID key, so keys can be rotated by adding a new one, switching to it and
+    dropping the old one once SIGNED_TOKEN_LIFETIME has passed.
+
+    Revoked tokens are kept in the cache until they would have expired anyway.  The cache is the only
+    record of revocations: if it is flushed or evicts them, revoked tokens are valid again until
+    they expire, so use a persistent cache (see CACHE_ALIAS) and a short SIGNED_TOKEN_LIFETIME.
+    """
+    revoked_token_key = 'allauth_api:revoked_token:%s'
+    revoked_user_key = 'allauth_api:revoked_user:%s'
+
+    def get_keys(self):
+        keys = allauth_api_settings.SIGNED_TOKEN_KEYS or {'default': settings.SECRET_KEY}
+        return dict((kid, hashlib.sha256(force_bytes('allauth_api.signed_token' + secret)).digest())
+                    for kid, secret in keys.items())
+
+    def get_signing_key_id(self):
+        return allauth_api_settings.SIGNED_TOKEN_KEY_ID or sorted(self.get_keys())[-1]
+
+    def get_claims(self, user):
+        """
+        Hook for adding claims to the token
+        """
+        return {}
+
+    def sign(self, kid, payload):
+        signing_input = force_bytes(kid) + b'.' + payload
+        return hmac.new(self.get_keys()[kid], signing_input, hashlib.sha256).digest()
+
+    def get_token(self, user):
+        now = time.time()
+        claims = self.get_claims(user)
+        claims.update({
+            'uid': user.pk,
+            'jti': binascii.hexlify(os.urandom(12)).decode(),
+            # With sub-second precision, so tokens issued right after revoke_all_tokens() are valid
+            'iat': round(now, 6),
+            'exp': int(now) + allauth_api_settings.SIGNED_TOKEN_LIFETIME,
+        })
+        kid = self.get_signing_key_id()
+        payload = b64encode(force_bytes(json.dumps(claims, separators=(',', ':')))).encode('ascii')
+        key = "%s.%s.%s" % (kid, payload.decode('ascii'), b64encode(self.sign(kid, payload)))
+        return SignedToken(key, claims)
+
+    def is_signed_token(self, key):
+        """
+        Returns True if key looks like one of these tokens, signed with a known key
+        """
+        parts = key.split('.')
+        return len(parts) == 3 and parts[0] in self.get_keys()
+
+    def verify(self, key):
+        """
+        Returns the claims of a valid token.  Raises InvalidSignedToken otherwise
+        """
+        try:
+            kid, payload, signature = key.split('.')
+            expected = self.sign(kid, payload.encode('ascii'))
+            valid = hmac.compare_digest(expected, b64decode(signature))
+        except (ValueError, KeyError, TypeError, binascii.Error, UnicodeError):
+            raise InvalidSignedToken('Invalid token.')
+        if not valid:
+            raise InvalidSignedToken('Invalid token.')
+
+        claims = json.loads(b64decode(payload).decode('utf-8'))
+        if claims.get('exp', 0) <= time.time():
+            raise InvalidSignedToken('Token has expired.')
+        if self.is_revoked(claims):
+            raise InvalidSignedToken('Token has been revoked.')
+        return claims
+
+    def is_revoked(self, claims):
+        from allauth_api.account.verification import get_cache
+        token_key = self.revoked_token_key % claims['jti']
+        user_key = self.revoked_user_key % claims['uid']
+        revoked = get_cache().get_many([token_key, user_key])
+        return token_key in revoked or revoked.get(user_key, 0) > claims['iat']
+
+    def revoke_token(self, request):
+        from allauth_api.account.verification import get_cache
+        claims = request.auth
+        if isinstance(claims, dict) and 'jti' in claims:
+            ttl = int(claims['exp'] - time.time()) + 1
+            if ttl > 0:
+                get_cache().set(self.revoked_token_key % claims['jti'], 1, ttl)
+
+    def revoke_all_tokens(self, user):
+        """
+        Revokes every token issued to the user up to now
+        """
+        from allauth_api.account.verification import get_cache
+        get_cache().set(self.revoked_user_key % user.pk, round(time.time(), 6), allauth_api_settings.SIGNED_TOKEN_LIFETIME)
+
 
 def perform_login(request, user, email_verification, return_data=None, signal_kwargs={},
-                  signup=False):
+                  signup=False, verified=None):
     """
     Keyword arguments:
 
     signup -- Indicates whether or not sending the
     email is essential (during signup), or if it can be skipped (e.g. in
     case email verification is optional and we are only logging in).
+    verified -- Whether the user has a verified email address, if already
+    known (e.g. fetched with the user by the authentication backend).
     """
-    from allauth.account.models import EmailAddress
-    has_verified_email = EmailAddress.objects.filter(user=user,
-                                                     verified=True).exists()
+    if verified is None:
+        verified = has_verified_email(user)
     if email_verification == app_settings.EmailVerificationMethod.NONE:
         pass
     elif email_verification == app_settings.EmailVerificationMethod.OPTIONAL:
         # In case of OPTIONAL verification: send on signup.
-        if not has_verified_email and signup:
+        if not verified and signup:
             send_email_confirmation(request, user, signup=signup)
     elif email_verification == app_settings.EmailVerificationMethod.MANDATORY:
-        if not has_verified_email:
-            send_email_confirmation(request, user, signup=signup)
-            return Response({'message': 'Account email verification sent'}, HTTP_401_UNAUTHORIZED)
+        if not verified:
+            sent, next_allowed = send_email_confirmation(request, user, signup=signup)
+            if sent:
+                return_data = {'message': 'Account email verification sent'}
+            else:
+                return_data = {'message': 'Account email verification pending'}
+            if next_allowed is not None:
+                return_data['next_send_allowed'] = next_allowed.isoformat()
+            return Response(return_data, HTTP_401_UNAUTHORIZED)
     # Local users are stopped due to form validation checking
     # is_active, yet, adapter methods could toy with is_active in a
     # `user_signed_up` signal. Furthermore, social users should be
@@ -126,6 +307,9 @@ def serializer_error_string(errors):
 
 
 def filter_users_by_username(*username):
+    if identifiers.is_enabled():
+        return identifiers.filter_users_by_username(*username)
+
     lookup = ''
     if allauth_api_settings.CASE_INSENSITIVE_IDS:
         lookup = '__iexact'
@@ -138,6 +322,74 @@ def filter_users_by_username(*username):
     return ret
 
 
+def identifier_taken_errors(error):
+    """
+    Returns the form errors for an IntegrityError raised while saving a new user if it's about the
+    username or email being taken (e.g. by a concurrent registration), or None if it's about some
+    other constraint
+    """
+    adapter = get_adapter()
+    message = force_text(error).lower()
+    username_field = app_settings.USER_MODEL_USERNAME_FIELD
+    if isinstance(error, identifiers.UsernameTaken) or (username_field and username_field.lower() in message):
+        return {'username': [adapter.get_username_taken_message()]}
+    if 'email' in message:
+        return {'email': [adapter.error_messages['email_taken']]}
+    return None
+
+
+def find_registered_identifiers(user_ids):
+    """
+    Returns the subset of identifiers (usernames, or emails if they contain an @) that belong to a
+    registered user, running one values_list query per field and REGISTRATIONS_QUERY_CHUNK_SIZE
+    identifiers.  Honors CASE_INSENSITIVE_IDS.  Identifiers ruled out by the identifier filter aren't
+    queried at all
+    """
+    User = get_user_model()
+    case_insensitive = allauth_api_settings.CASE_INSENSITIVE_IDS
+
+    by_field = {}
+    for identifier in user_ids:
+        field = 'email' if '@' in identifier else User.USERNAME_FIELD
+        value = identifier.lower() if case_insensitive else identifier
+        by_field.setdefault(field, {}).setdefault(value, []).append(identifier)
+
+    registered = set()
+    for field, values in by_field.items():
+        for found in find_registered_values(field, list(values)):
+            registered.update(values[found])
+    return registered
+
+
+def find_registered_values(field, values):
+    """
+    Returns which of the values of a user field (USERNAME_FIELD or 'email') are registered, running
+    one query per REGISTRATIONS_QUERY_CHUNK_SIZE values.  With CASE_INSENSITIVE_IDS the values must be
+    lowercased
+    """
+    User = get_user_model()
+    kind = identifier_filter.EMAIL if field == 'email' else identifier_filter.USERNAME
+    values = [value for value in values if identifier_filter.might_be_registered(kind, value)]
+    chunk_size = allauth_api_settings.REGISTRATIONS_QUERY_CHUNK_SIZE
+
+    if identifiers.is_enabled():
+        field = 'email' if field == 'email' else 'username'
+        find = identifiers.find_registered
+    else:
+        queryset = User.objects.all()
+        if allauth_api_settings.CASE_INSENSITIVE_IDS:
+            queryset = queryset.annotate(_normalized_id=Lower(field))
+            field = '_normalized_id'
+
+        def find(field, values):
+            return queryset.filter(**{field + '__in': values}).values_list(field, flat=True)
+
+    registered = set()
+    for i in range(0, len(values), chunk_size):
+        registered.update(find(field, values[i:i + chunk_size]))
+    return registered
+
+
 def clone_request(request, data):
     environ_clone = request.environ.copy()
     environ_clone['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
@@ -1,18 +1,34 @@
-from django.utils.translation import ugettext as _
+import base64
+import json
+import math
+import time
+
+from django.utils.translation import ugettext as _, ugettext_lazy
 from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
 
+from rest_framework import HTTP_HEADER_ENCODING
+from rest_framework.authentication import get_authorization_header
+from rest_framework.exceptions import APIException, PermissionDenied, Throttled
 from rest_framework.response import Response
 from rest_framework.status import (HTTP_304_NOT_MODIFIED, HTTP_400_BAD_REQUEST, HTTP_204_NO_CONTENT,
-                                   HTTP_404_NOT_FOUND, HTTP_403_FORBIDDEN, HTTP_200_OK)
+                                   HTTP_404_NOT_FOUND, HTTP_200_OK, HTTP_429_TOO_MANY_REQUESTS,
+                                   HTTP_503_SERVICE_UNAVAILABLE)
 from allauth.utils import get_user_model, get_form_class
 from allauth.account import app_settings, signals
-import allauth.account.utils as allauth_utils
-from allauth.account.models import EmailConfirmation, EmailAddress, EmailConfirmationHMAC
-from allauth.account.forms import (SignupForm, ChangePasswordForm, ResetPasswordForm, ResetPasswordKeyForm, UserTokenForm)
+from allauth.account.models import EmailConfirmation, EmailConfirmationHMAC
+from allauth.account.forms import SignupForm, ResetPasswordForm, ResetPasswordKeyForm, UserTokenForm
 from allauth.account.adapter import get_adapter
 
 from allauth_api.settings import allauth_api_settings
+from allauth_api.instrumentation import QueryBudgetMixin, phase
+from allauth_api.account import bulk, identifiers, identifier_filter
+from allauth_api.account.forms import ChangePasswordForm
+from allauth_api.account.hashing import HashingUnavailable
+from allauth_api.account.throttling import LoginThrottle
 from allauth_api.account.rest_framework import utils
+from allauth_api.account.verification import has_verified_email, send_email_confirmation as send_confirmation
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,6 +38,26 @@ User = get_user_model()
 APIView = allauth_api_settings.DRF_API_VIEW
 
 
+class ServiceUnavailable(APIException):
+    status_code = HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = ugettext_lazy("Service temporarily unavailable, try again later.")
+
+    def __init__(self, wait=None, detail=None):
+        super(ServiceUnavailable, self).__init__(detail)
+        self.wait = wait
+
+
+class HashingBackpressureMixin(object):
+    """
+    Turns a full password hashing queue into a 503 response with a Retry-After header
+    """
+
+    def handle_exception(self, exc):
+        if isinstance(exc, HashingUnavailable):
+            exc = ServiceUnavailable(wait=exc.retry_after)
+        return super(HashingBackpressureMixin, self).handle_exception(exc)
+
+
 class AlreadyLoggedInMixin(object):
     """
     Returns a 304 NOT MODIFIED response if the user is already authenticated
@@ -39,44 +75,71 @@ class AlreadyLoggedInMixin(object):
         return response
 
 
+def get_login_identifier(request):
+    """
+    Returns the username or email a login request is for, from the request data or a basic
+    authorization header
+    """
+    identifier = None
+    if hasattr(request.data, 'get'):
+        identifier = request.data.get('username') or request.data.get('email')
+    if not identifier:
+        auth = get_authorization_header(request).split()
+        if len(auth) == 2 and auth[0].lower() == b'basic':
+            try:
+                identifier = base64.b64decode(auth[1]).decode(HTTP_HEADER_ENCODING).partition(':')[0]
+            except (TypeError, ValueError):
+                pass
+    return identifier or None
+
+
 class LoginHandlerMixin(object):
     """
     Mixin providing common functionality to set login(out) handler
     """
+    # Whether to throttle failed attempts (see allauth_api.account.throttling)
+    throttle_logins = False
 
     def post(self, request, *args, **kwargs):
         self.login_handler = None
+        self.login_throttle = None
+        if self.throttle_logins:
+            self.login_throttle = LoginThrottle(get_login_identifier(request),
+                                                request.META.get(allauth_api_settings.LOGIN_THROTTLE_IP_META_KEY))
+            wait = self.login_throttle.check()
+            if wait:
+                raise Throttled(wait=int(math.ceil(wait)))
+
         login_type = request.data.get('login_type',
                                       allauth_api_settings.DRF_LOGIN_TYPE)
-        login_class = allauth_api_settings.DRF_LOGIN_CLASSES[login_type]
+        # Handlers are created once, when the settings are compiled
+        self.login_handler = allauth_api_settings.login_handlers.get(login_type)
 
-        if not login_class:
+        if self.login_handler is None:
             return Response({"error": "invalid login type: %s" % login_type}, HTTP_400_BAD_REQUEST)
 
-        self.login_handler = login_class()
         return self.handle_login_logout(request, *args, **kwargs)
 
 
 class CloseableSignupMixin(object):
+    """
+    Rejects the request with a 403 if signup is closed.  Checked in initial(), once the request is
+    parsed and authenticated, so is_open() can use request.data
+    """
 
-    def dispatch(self, request, *args, **kwargs):
-        # WORKAROUND: https://code.djangoproject.com/ticket/19316
-        self.request = request
-        # (end WORKAROUND)
+    def initial(self, request, *args, **kwargs):
+        super(CloseableSignupMixin, self).initial(request, *args, **kwargs)
         if not self.is_open():
-            return self.closed()
-        return super(CloseableSignupMixin, self).dispatch(request,
-                                                          *args,
-                                                          **kwargs)
+            self.closed()
 
     def is_open(self):
         return get_adapter().is_open_for_signup(self.request)
 
     def closed(self):
-        return Response({"detail": _("Registration is closed")}, HTTP_403_FORBIDDEN)
+        raise PermissionDenied(_("Registration is closed"))
 
 
-class LoginView(AlreadyLoggedInMixin, LoginHandlerMixin, APIView):
+class LoginView(QueryBudgetMixin, HashingBackpressureMixin, AlreadyLoggedInMixin, LoginHandlerMixin, APIView):
     """
     Logs a user in.  The requirements and response will depend on the specific authentication
     mechanism specified in the login_type parameter. Defaults are as follows
@@ -91,22 +154,30 @@ class LoginView(AlreadyLoggedInMixin, LoginHandlerMixin, APIView):
     """
 
     permission_classes = allauth_api_settings.DRF_LOGIN_VIEW_PERMISSIONS
+    query_budget = 10
+    throttle_logins = True
 
     def handle_login_logout(self, request, *args, **kwargs):
         if self.login_handler is None:
             return Response({"detail": _("No login handler found")}, HTTP_400_BAD_REQUEST)
-        return self.login_handler.login(request, *args, **kwargs)
+        response = self.login_handler.login(request, *args, **kwargs)
+        if getattr(response, 'login_user', None) is None:
+            self.login_throttle.failure()
+        else:
+            self.login_throttle.success()
+        return response
 
 
 login = LoginView.as_view()
 
 
-class LogoutView(LoginHandlerMixin, APIView):
+class LogoutView(QueryBudgetMixin, LoginHandlerMixin, APIView):
     """
     Logs a user out.
     """
 
     permission_classes = allauth_api_settings.DRF_LOGOUT_VIEW_PERMISSIONS
+    query_budget = 4
 
     def handle_login_logout(self, request, *args, **kwargs):
         if self.login_handler is None:
@@ -117,12 +188,13 @@ class LogoutView(LoginHandlerMixin, APIView):
 logout = LogoutView.as_view()
 
 
-class RegisterView(CloseableSignupMixin, APIView):
+class RegisterView(QueryBudgetMixin, HashingBackpressureMixin, CloseableSignupMixin, APIView):
     """
     Registers a new user
     """
 
     permission_classes = allauth_api_settings.DRF_REGISTER_VIEW_PERMISSIONS
+    query_budget = 18
     form_class = SignupForm
 
     def get_form_class(self):
@@ -132,30 +204,49 @@ class RegisterView(CloseableSignupMixin, APIView):
         fc = self.get_form_class()
         data = request.data
         form = fc(data=data, files=data)
-        if form.is_valid():
-            user = form.save(request)
-            return utils.complete_signup(self.request, user, app_settings.EMAIL_VERIFICATION)
+        with phase('validate'):
+            valid = form.is_valid()
+        if valid:
+            with phase('save'):
+                if identifiers.is_enabled() or identifier_filter.is_enabled():
+                    try:
+                        with transaction.atomic():
+                            user = form.save(request)
+                    except IntegrityError as e:
+                        # e.g. a username differing only by case, or registered by another process
+                        # the identifier filter hadn't seen yet
+                        errors = utils.identifier_taken_errors(e)
+                        if errors is None:
+                            raise
+                        return Response(errors, HTTP_400_BAD_REQUEST)
+                else:
+                    user = form.save(request)
+            with phase('complete_signup'):
+                return utils.complete_signup(self.request, user, app_settings.EMAIL_VERIFICATION)
         return Response(form.errors, HTTP_400_BAD_REQUEST)
 
 
 register = RegisterView.as_view()
 
 
-class ConfirmEmailView(APIView):
+class ConfirmEmailView(QueryBudgetMixin, APIView):
     """
     Confirms an email address
     """
     permission_classes = allauth_api_settings.DRF_REGISTER_VIEW_PERMISSIONS
+    query_budget = 4
 
     def post(self, *args, **kwargs):
-        confirmation = self.get_object()
+        with phase('lookup'):
+            confirmation = self.get_object()
         if not confirmation:
             return Response({"detail": _("Email confirmation key could not be found")}, HTTP_400_BAD_REQUEST)
 
         if confirmation.email_address.verified:
             return Response(None, HTTP_304_NOT_MODIFIED)
 
-        confirmation.confirm(self.request)
+        with phase('confirm'):
+            confirmation.confirm(self.request)
         get_adapter().add_message(self.request,
                                   messages.SUCCESS,
                                   'account/messages/email_confirmed.txt',
@@ -165,6 +256,8 @@ class ConfirmEmailView(APIView):
 
     def get_object(self, queryset=None):
         key = get_adapter().email_confirmation_key(self.request)
+        if not key:
+            return None
         emailconfirmation = EmailConfirmationHMAC.from_key(key)
         if not emailconfirmation:
             if queryset is None:
@@ -184,34 +277,46 @@ class ConfirmEmailView(APIView):
 confirm_email = ConfirmEmailView.as_view()
 
 
-class SendEmailConfirmationView(APIView):
+class SendEmailConfirmationView(QueryBudgetMixin, APIView):
     """
     Resends the email confirmation message to a user
     """
     permission_classes = allauth_api_settings.DRF_SEND_EMAIL_CONFIRMATION_PERMISSIONS
+    query_budget = 4
 
     def post(self, *args, **kwargs):
         # if the email address is already verified, do nothing
         user = self.request.user
-        has_verified_email = EmailAddress.objects.filter(user=user, verified=True).exists()
-        if has_verified_email:
+        with phase('verification'):
+            verified = has_verified_email(user)
+        if verified:
             return Response(None, HTTP_204_NO_CONTENT)
 
-        # otherwise, send the confirmation email
-        print("sending email confirmation...")
-        allauth_utils.send_email_confirmation(self.request, user)
-        return Response({'message': 'Account email verification sent'}, HTTP_200_OK)
+        # otherwise, send the confirmation email unless one was sent recently
+        with phase('send'):
+            sent, next_allowed = send_confirmation(self.request, user)
+        if not sent:
+            retry_after = int(math.ceil(next_allowed.timestamp() - time.time()))
+            return Response({'detail': _("Email confirmation already sent"),
+                             'next_send_allowed': next_allowed.isoformat()},
+                            HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': '%d' % max(retry_after, 1)})
+
+        return_data = {'message': 'Account email verification sent'}
+        if next_allowed is not None:
+            return_data['next_send_allowed'] = next_allowed.isoformat()
+        return Response(return_data, HTTP_200_OK)
 
 
 send_email_confirmation = SendEmailConfirmationView.as_view()
 
 
-class ChangePasswordView(APIView):
+class ChangePasswordView(QueryBudgetMixin, HashingBackpressureMixin, APIView):
     """
     Sets a user's password
     """
 
     permission_classes = allauth_api_settings.DRF_PASSWORD_VIEW_PERMISSIONS
+    query_budget = 3
     form_class = ChangePasswordForm
 
     def get_form_class(self):
@@ -220,8 +325,11 @@ class ChangePasswordView(APIView):
     def post(self, request, format=None):
         fc = self.get_form_class()
         form = fc(data=request.data, user=request.user)
-        if form.is_valid():
-            form.save()
+        with phase('validate'):
+            valid = form.is_valid()
+        if valid:
+            with phase('save'):
+                form.save()
             get_adapter().add_message(self.request,
                                       messages.SUCCESS,
                                       'account/messages/password_changed.txt')
@@ -235,12 +343,13 @@ class ChangePasswordView(APIView):
 change_password = ChangePasswordView.as_view()
 
 
-class ResetPasswordView(APIView):
+class ResetPasswordView(QueryBudgetMixin, APIView):
     """
     Initiates password reset
     """
 
     permission_classes = allauth_api_settings.DRF_PASSWORD_RESET_PERMISSIONS
+    query_budget = 4
     form_class = ResetPasswordForm
 
     def get_form_class(self):
@@ -249,8 +358,11 @@ class ResetPasswordView(APIView):
     def post(self, request, format=None):
         fc = self.get_form_class()
         form = fc(data=request.data)
-        if form.is_valid():
-            form.save(request)
+        with phase('validate'):
+            valid = form.is_valid()
+        if valid:
+            with phase('save'):
+                form.save(request)
             return Response(None, HTTP_204_NO_CONTENT)
         return Response(form.errors, HTTP_400_BAD_REQUEST)
 
@@ -258,12 +370,13 @@ class ResetPasswordView(APIView):
 reset_password = ResetPasswordView.as_view()
 
 
-class ConfirmResetPasswordView(APIView):
+class ConfirmResetPasswordView(QueryBudgetMixin, HashingBackpressureMixin, APIView):
     """
     Confirms a password reset request
     """
 
     permission_classes = allauth_api_settings.DRF_PASSWORD_RESET_PERMISSIONS
+    query_budget = 2
     form_class = ResetPasswordKeyForm
 
     def get_form_class(self):
@@ -274,15 +387,20 @@ class ConfirmResetPasswordView(APIView):
         self.key = data.get('key', None)
         token_form = UserTokenForm(data=data)
 
-        if not token_form.is_valid():
+        with phase('token'):
+            valid = token_form.is_valid()
+        if not valid:
             return Response(token_form.errors, HTTP_400_BAD_REQUEST)
 
         self.reset_user = token_form.reset_user
         form_kwargs = self.get_form_kwargs()
         fc = self.get_form_class()
         password_form = fc(data=data, **form_kwargs)
-        if password_form.is_valid():
-            password_form.save()
+        with phase('validate'):
+            valid = password_form.is_valid()
+        if valid:
+            with phase('save'):
+                password_form.save()
             get_adapter().add_message(self.request,
                                       messages.SUCCESS,
                                       'account/messages/password_changed.txt')
@@ -303,14 +421,25 @@ class ConfirmResetPasswordView(APIView):
 confirm_reset_password = ConfirmResetPasswordView.as_view()
 
 
-class RegistrationCheckView(APIView):
+class RegistrationCheckView(QueryBudgetMixin, APIView):
     """
     Check if the given user identifier belongs to a registered user
     """
 
     permission_classes = allauth_api_settings.DRF_REGISTRATIONS_VIEW_PERMISSIONS
+    query_budget = 1
 
     def get(self, request, user_id):
+        kind = identifier_filter.EMAIL if '@' in user_id else identifier_filter.USERNAME
+        if not identifier_filter.might_be_registered(kind, user_id):
+            return Response(None, HTTP_404_NOT_FOUND)
+
+        if identifiers.is_enabled():
+            field = 'email' if '@' in user_id else 'username'
+            if identifiers.find_registered(field, [identifiers.normalize(user_id)]):
+                return Response(None, HTTP_204_NO_CONTENT)
+            return Response(None, HTTP_404_NOT_FOUND)
+
         field_lookup = User.USERNAME_FIELD
         if '@' in user_id:
             field_lookup = 'email'
@@ -327,3 +456,67 @@ class RegistrationCheckView(APIView):
 
 
 check_registration = RegistrationCheckView.as_view()
+
+
+class RegistrationBatchCheckView(QueryBudgetMixin, APIView):
+    """
+    Checks which of a list of user identifiers belong to registered users.  Expects an
+    `identifiers` list of at most REGISTRATIONS_BATCH_MAX usernames and emails and returns a map of
+    each of them to true or false.  Use DRF_REGISTRATIONS_VIEW_THROTTLES (e.g. ScopedRateThrottle with
+    an `allauth_api_registrations` rate) to rate limit it
+    """
+
+    permission_classes = allauth_api_settings.DRF_REGISTRATIONS_VIEW_PERMISSIONS
+    throttle_classes = allauth_api_settings.DRF_REGISTRATIONS_VIEW_THROTTLES
+    throttle_scope = 'allauth_api_registrations'
+    # One query per identifier type, unless the batch is split into chunks
+    query_budget = 2
+
+    def post(self, request):
+        if hasattr(request.data, 'getlist'):
+            identifiers = request.data.getlist('identifiers')
+        else:
+            identifiers = request.data.get('identifiers') if isinstance(request.data, dict) else None
+
+        if not isinstance(identifiers, list) or not all(isinstance(i, str) and i for i in identifiers):
+            return Response({"identifiers": [_("A list of user identifiers is required")]}, HTTP_400_BAD_REQUEST)
+        max_identifiers = allauth_api_settings.REGISTRATIONS_BATCH_MAX
+        if len(identifiers) > max_identifiers:
+            return Response({"identifiers": [_("At most %d identifiers can be checked at once") % max_identifiers]},
+                            HTTP_400_BAD_REQUEST)
+
+        registered = utils.find_registered_identifiers(identifiers)
+        return Response(dict((identifier, identifier in registered) for identifier in identifiers), HTTP_200_OK)
+
+
+check_registrations = RegistrationBatchCheckView.as_view()
+
+
+class BulkRegisterView(APIView):
+    """
+    Registers a batch of users at once, for admins importing accounts.  Expects a `users` list of
+    at most BULK_REGISTER_MAX objects with a username, an email and optionally a password, first_name,
+    last_name and verified flag, and `send_confirmation` (true by default) to send confirmation mails
+    to the unverified addresses.  The rows are validated before responding, then the response streams
+    the result of each user as a line of JSON (see allauth_api.account.bulk) while the batch is inserted.
+    It has no query budget: the inserts run while streaming, after the view returns
+    """
+
+    permission_classes = allauth_api_settings.DRF_BULK_REGISTER_PERMISSIONS
+
+    def post(self, request):
+        rows = request.data.get('users') if isinstance(request.data, dict) else None
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return Response({"users": [_("A list of users is required")]}, HTTP_400_BAD_REQUEST)
+        max_rows = allauth_api_settings.BULK_REGISTER_MAX
+        if len(rows) > max_rows:
+            return Response({"users": [_("At most %d users can be registered at once") % max_rows]},
+                            HTTP_400_BAD_REQUEST)
+
+        send_confirmation = request.data.get('send_confirmation', True) not in (False, 'false', 'False', '0', 0)
+        results = bulk.register_users(rows, request=request, send_confirmation=send_confirmation)
+        return StreamingHttpResponse((json.dumps(result) + '\n' for result in results),
+                                     content_type='application/x-ndjson')
+
+
+bulk_register = BulkRegisterView.as_view()
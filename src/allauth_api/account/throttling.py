@@ -0,0 +1,191 @@
+"""
+Login throttling.
+
+Failed logins are counted in sliding windows keyed by the client IP and by the submitted
+identifier (username or email) combined with the IP; LOGIN_THROTTLE_RATES gives the number of
+failures allowed per window for each of these scopes, e.g.
+
+    'LOGIN_THROTTLE_RATES': {'ip': (100, 900), 'identifier_ip': (5, 900)}
+
+It is empty by default, which turns throttling off.  There is deliberately no scope keyed by the
+identifier alone: anybody could lock a user out of their account by sending bad passwords for it.
+Once a scope reaches its limit it is locked out for LOGIN_THROTTLE_LOCKOUT seconds, doubling with
+every further lockout up to LOGIN_THROTTLE_MAX_LOCKOUT.  A successful login resets the
+identifier_ip counters and lockout history (but not the IP ones, or an attacker holding one valid
+account could keep resetting them).
+
+Counters and lockouts live in the cache named by CACHE_ALIAS so that every process shares them.
+Lockouts are also remembered in a small in-process table, so a client that keeps hammering a
+locked scope is rejected without even a cache round trip.  The check happens before any database
+lookup or password hashing.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.utils.encoding import force_bytes
+
+from allauth_api.account.verification import get_cache
+from allauth_api.settings import allauth_api_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+IP = 'ip'
+IDENTIFIER_IP = 'identifier_ip'
+RESET_ON_SUCCESS = (IDENTIFIER_IP,)
+
+COUNTER_KEY_TEMPLATE = 'allauth_api:login_failures:%s:%d'
+LOCKOUT_KEY_TEMPLATE = 'allauth_api:login_lockout:%s'
+STRIKES_KEY_TEMPLATE = 'allauth_api:login_strikes:%s'
+
+_local_lockouts = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def reset():
+    """
+    Forgets the lockouts held in this process
+    """
+    with _local_lock:
+        _local_lockouts.clear()
+
+
+def _get_local_lockout(key, now):
+    with _local_lock:
+        deadline = _local_lockouts.get(key)
+        if deadline is not None and deadline <= now:
+            del _local_lockouts[key]
+            deadline = None
+        return deadline
+
+
+def _set_local_lockout(key, deadline):
+    with _local_lock:
+        _local_lockouts.pop(key, None)
+        _local_lockouts[key] = deadline
+        while len(_local_lockouts) > allauth_api_settings.LOGIN_THROTTLE_LOCAL_SIZE:
+            _local_lockouts.popitem(last=False)
+
+
+def _clear_local_lockout(key):
+    with _local_lock:
+        _local_lockouts.pop(key, None)
+
+
+def normalize_identifier(identifier):
+    return identifier.strip().lower()
+
+
+class LoginThrottle(object):
+    """
+    Throttles login attempts for one identifier/IP pair.  Either may be None, in which case the
+    scopes that need it are skipped
+    """
+
+    def __init__(self, identifier=None, ip=None):
+        rates = allauth_api_settings.LOGIN_THROTTLE_RATES or {}
+        if identifier:
+            identifier = normalize_identifier(identifier)
+        values = {
+            IP: ip,
+            IDENTIFIER_IP: "%s|%s" % (identifier, ip) if identifier and ip else None,
+        }
+        # scope -> (key, limit, window)
+        self.scopes = {}
+        for scope, value in values.items():
+            rate = rates.get(scope)
+            if value and rate:
+                digest = hashlib.sha1(force_bytes("%s:%s" % (scope, value))).hexdigest()
+                self.scopes[scope] = ("%s:%s" % (scope, digest), rate[0], rate[1])
+
+    def check(self, now=None):
+        """
+        Returns the number of seconds until the next attempt is allowed, or 0 if it is allowed now
+        """
+        if not self.scopes:
+            return 0
+        if now is None:
+            now = time.time()
+
+        deadline = 0
+        for key, limit, window in self.scopes.values():
+            deadline = max(deadline, _get_local_lockout(key, now) or 0)
+        if deadline:
+            return deadline - now
+
+        lockout_keys = [LOCKOUT_KEY_TEMPLATE % key for key, limit, window in self.scopes.values()]
+        lockouts = get_cache().get_many(lockout_keys)
+        for key, limit, window in self.scopes.values():
+            scope_deadline = lockouts.get(LOCKOUT_KEY_TEMPLATE % key)
+            if scope_deadline and scope_deadline > now:
+                _set_local_lockout(key, scope_deadline)
+                deadline = max(deadline, scope_deadline)
+        return deadline - now if deadline else 0
+
+    def failure(self, now=None):
+        """
+        Records a failed attempt, locking out the scopes that reach their limit
+        """
+        if not self.scopes:
+            return
+        if now is None:
+            now = time.time()
+
+        cache = get_cache()
+        previous_keys = {}
+        current_keys = {}
+        for scope, (key, limit, window) in self.scopes.items():
+            bucket = int(now // window)
+            previous_keys[scope] = COUNTER_KEY_TEMPLATE % (key, bucket - 1)
+            current_keys[scope] = COUNTER_KEY_TEMPLATE % (key, bucket)
+        previous = cache.get_many(list(previous_keys.values()))
+
+        for scope, (key, limit, window) in self.scopes.items():
+            current_key = current_keys[scope]
+            cache.add(current_key, 0, 2 * window)
+            try:
+                count = cache.incr(current_key)
+            except ValueError:
+                # Expired between add() and incr()
+                cache.set(current_key, 1, 2 * window)
+                count = 1
+            # Weigh the previous window by how much of it still overlaps the sliding window
+            overlap = 1 - (now % window) / float(window)
+            count += previous.get(previous_keys[scope], 0) * overlap
+            if count >= limit:
+                self.lock_out(key, now)
+                cache.delete_many([previous_keys[scope], current_key])
+
+    def lock_out(self, key, now):
+        cache = get_cache()
+        base = allauth_api_settings.LOGIN_THROTTLE_LOCKOUT
+        maximum = allauth_api_settings.LOGIN_THROTTLE_MAX_LOCKOUT
+        strikes_key = STRIKES_KEY_TEMPLATE % key
+        strikes = cache.get(strikes_key, 0)
+        duration = min(base * 2 ** strikes, maximum)
+        deadline = now + duration
+        cache.set(LOCKOUT_KEY_TEMPLATE % key, deadline, int(duration) + 1)
+        # Remember the strikes long enough for a returning attacker to get a longer lockout
+        cache.set(strikes_key, strikes + 1, int(maximum) * 2)
+        _set_local_lockout(key, deadline)
+        logger.warning("Locked out login scope %s for %ds", key, duration)
+
+    def success(self, now=None):
+        """
+        Records a successful attempt, clearing the identifier_ip counters and lockout history
+        """
+        if now is None:
+            now = time.time()
+        keys = []
+        for scope in RESET_ON_SUCCESS:
+            if scope not in self.scopes:
+                continue
+            key, limit, window = self.scopes[scope]
+            bucket = int(now // window)
+            keys.extend([COUNTER_KEY_TEMPLATE % (key, bucket - 1), COUNTER_KEY_TEMPLATE % (key, bucket),
+                         LOCKOUT_KEY_TEMPLATE % key, STRIKES_KEY_TEMPLATE % key])
+            _clear_local_lockout(key)
+        if keys:
+            get_cache().delete_many(keys)
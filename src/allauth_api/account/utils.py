@@ -1,107 +1,323 @@
+import io
 import os
+import struct
 import tempfile
+import threading
+import zlib
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 from allauth_api.settings import allauth_api_settings
 
-try:
-    from PIL import Image
-    from PIL.PngImagePlugin import PngInfo
-    HAS_PIL = True
-except ImportError:
-    HAS_PIL = False
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
 
-if HAS_PIL:
-    class BaseImageKeyGenerator(object):
-        """
-        Base class for image key generators
-        """
-        image_format = "PNG"
-
-        def create_image_key(self, key):
-            self.key = key
-            image = self.create_image()
-            image = self.resize_image(image)
-            image = self.inscribe_image(image)
-            return self.export_image(image)
-
-        def get_image_format(self):
-            return getattr(allauth_api_settings, "IMAGE_KEY_FORMAT", self.image_format)
-
-        def get_image_size(self):
-            return getattr(allauth_api_settings, "IMAGE_KEY_SIZE", None)
-
-        def get_image_options(self):
-            return {}
-
-        def resize_image(self, image):
-            current_size = image.size
-            final_size = self.get_image_size()
-            if final_size is not None and final_size != current_size:
-                return image.thumbnail(final_size)
-            return image
-
-        def create_image(self):
-            raise NotImplementedError("subclass and implement")
-
-        def inscribe_image(self, image):
-            return image
-
-        def export_image(self, image):
-            options = self.get_image_options()
-            outfile = tempfile.NamedTemporaryFile()
-            image.save(outfile, format=self.get_image_format(), **options)
-            outfile.seek(0)
-            return outfile
-
-    class TemplateImageMixin(object):
-        image_template = os.path.join(settings.STATIC_ROOT, 'allauth_api', 'key.png')
-
-        def create_image(self):
-            """
-            Just loads a template image
-            """
-            template = self.get_template_image()
-            image = Image.open(template)
-            return image
-
-        def get_template_image(self):
-            return getattr(allauth_api_settings, "IMAGE_KEY_TEMPLATE", self.image_template)
-
-    class TextImageMixin(object):
-        """
-        Creates an image using the key
-        """
-        # TODO
-        pass
+def import_pil(purpose):
+    """
+    Imports PIL on first use, so that importing this module stays cheap when image keys are
+    spliced (the default) rather than drawn
+    """
+    try:
+        from PIL import Image, PngImagePlugin
+    except ImportError:
+        raise ImproperlyConfigured("%s requires PIL" % purpose)
+    return Image, PngImagePlugin
+
+
+def png_chunk(chunk_type, data):
+    """
+    Returns an encoded PNG chunk, including its length and CRC
+    """
+    crc = zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def png_text_chunk(keyword, text):
+    """
+    Returns a tEXt chunk, or an iTXt chunk if the text can't be encoded as latin-1
+    """
+    keyword = keyword.encode('latin-1')
+    try:
+        return png_chunk(b'tEXt', keyword + b'\0' + text.encode('latin-1'))
+    except UnicodeEncodeError:
+        # uncompressed, no language tag nor translated keyword
+        return png_chunk(b'iTXt', keyword + b'\0\0\0\0\0' + text.encode('utf-8'))
+
+
+def iter_png_chunks(data):
+    """
+    Yields (chunk_type, offset, length) for each chunk of the PNG in data, checking its structure
+    and CRCs
+    """
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("Not a PNG image")
+    offset = 8
+    while offset < len(data):
+        if offset + 12 > len(data):
+            raise ValueError("Truncated PNG chunk at offset %d" % offset)
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        end = offset + 12 + length
+        if end > len(data):
+            raise ValueError("Truncated PNG chunk at offset %d" % offset)
+        crc, = struct.unpack('>I', data[end - 4:end])
+        if zlib.crc32(data[offset + 4:end - 4]) & 0xffffffff != crc:
+            raise ValueError("Bad CRC in PNG chunk at offset %d" % offset)
+        yield chunk_type, offset, length
+        offset = end
+
+
+class InvalidImageKey(ValueError):
+    pass
+
+
+def read_png_text(fileobj, keyword='key', max_bytes=None, max_chunks=None, max_text_length=4096):
+    """
+    Returns the text of the first tEXt or uncompressed iTXt chunk named keyword in the PNG read
+    from fileobj, or None if there isn't one.  Only chunk headers and text chunks are read; image
+    data is skipped without being decompressed.  Raises InvalidImageKey if the file isn't a PNG or
+    goes over the max_bytes/max_chunks limits (IMAGE_KEY_MAX_BYTES/IMAGE_KEY_MAX_CHUNKS by default)
+    """
+    if max_bytes is None:
+        max_bytes = allauth_api_settings.IMAGE_KEY_MAX_BYTES
+    if max_chunks is None:
+        max_chunks = allauth_api_settings.IMAGE_KEY_MAX_CHUNKS
+    keyword = keyword.encode('latin-1')
+
+    def read(size):
+        data = fileobj.read(size)
+        if len(data) != size:
+            raise InvalidImageKey("Truncated PNG")
+        return data
+
+    if read(8) != PNG_SIGNATURE:
+        raise InvalidImageKey("Not a PNG image")
+    position = 8
+    for i in range(max_chunks):
+        header = read(8)
+        length, chunk_type = struct.unpack('>I4s', header)
+        position += 12 + length
+        if position > max_bytes:
+            raise InvalidImageKey("PNG is larger than %d bytes" % max_bytes)
+
+        if chunk_type == b'IEND':
+            return None
+        if chunk_type not in (b'tEXt', b'iTXt') or length > max_text_length:
+            skip(fileobj, length + 4)
+            continue
+
+        data = read(length)
+        crc, = struct.unpack('>I', read(4))
+        if zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff != crc:
+            raise InvalidImageKey("Bad CRC in %s chunk" % chunk_type.decode('latin-1'))
+        name, _, text = data.partition(b'\0')
+        if name != keyword:
+            continue
+        if chunk_type == b'tEXt':
+            return text.decode('latin-1')
+        # iTXt: compression flag, compression method, language tag, translated keyword, text
+        if text[:1] != b'\0':
+            continue
+        parts = text[2:].split(b'\0', 2)
+        if len(parts) == 3:
+            try:
+                return parts[2].decode('utf-8')
+            except UnicodeDecodeError:
+                raise InvalidImageKey("Invalid iTXt chunk")
+    raise InvalidImageKey("PNG has more than %d chunks" % max_chunks)
+
+
+def skip(fileobj, size):
+    """
+    Skips size bytes of fileobj, seeking if possible
+    """
+    try:
+        seekable = fileobj.seekable()
+    except AttributeError:
+        seekable = False
+    if seekable:
+        fileobj.seek(size, io.SEEK_CUR)
+        return
+    while size:
+        data = fileobj.read(min(size, 65536))
+        if not data:
+            raise InvalidImageKey("Truncated PNG")
+        size -= len(data)
+
+
+class BaseImageKeyGenerator(object):
+    """
+    Base class for image key generators
+    """
+    image_format = "PNG"
+
+    def create_image_key(self, key):
+        self.key = key
+        image = self.create_image()
+        image = self.resize_image(image)
+        image = self.inscribe_image(image)
+        return self.export_image(image)
+
+    def get_image_format(self):
+        return getattr(allauth_api_settings, "IMAGE_KEY_FORMAT", self.image_format)
+
+    def get_image_size(self):
+        return getattr(allauth_api_settings, "IMAGE_KEY_SIZE", None)
+
+    def get_image_options(self):
+        return {}
 
-    class MetadataInscriptionMixin(object):
+    def resize_image(self, image):
+        current_size = image.size
+        final_size = self.get_image_size()
+        if final_size is not None and final_size != current_size:
+            image.thumbnail(final_size)
+        return image
+
+    def create_image(self):
+        raise NotImplementedError("subclass and implement")
+
+    def inscribe_image(self, image):
+        return image
+
+    def export_image(self, image):
+        options = self.get_image_options()
+        outfile = tempfile.NamedTemporaryFile()
+        image.save(outfile, format=self.get_image_format(), **options)
+        outfile.seek(0)
+        return outfile
+
+
+class TemplateImageMixin(object):
+    image_template = os.path.join(settings.STATIC_ROOT, 'allauth_api', 'key.png')
+
+    def create_image(self):
         """
-        Adds the key to embedded image metadata.  Currently only png and jpg files are supported
+        Just loads a template image
         """
-        def get_image_options(self):
-            options = {}
-            image_format = self.get_image_format()
+        template = self.get_template_image()
+        Image, _ = import_pil(self.__class__.__name__)
+        image = Image.open(template)
+        return image
+
+    def get_template_image(self):
+        return getattr(allauth_api_settings, "IMAGE_KEY_TEMPLATE", self.image_template)
+
+
+class TextImageMixin(object):
+    """
+    Creates an image using the key
+    """
+    # TODO
+    pass
+
+
+class MetadataInscriptionMixin(object):
+    """
+    Adds the key to embedded image metadata.  Currently only png and jpg files are supported
+    """
+    def get_image_options(self):
+        options = {}
+        image_format = self.get_image_format()
+
+        if image_format == 'PNG':
+            _, PngImagePlugin = import_pil(self.__class__.__name__)
+            info = PngImagePlugin.PngInfo()
+            info.add_text('key', self.key)
+            options['pnginfo'] = info
+        # elif image_format = 'JPEG':  # TODO
+        #     options['exif'] =
+
+        return options
 
-            if image_format == 'PNG':
-                info = PngInfo()
-                info.add_text('key', self.key)
-                options['pnginfo'] = info
-            # elif image_format = 'JPEG':  # TODO
-            #     options['exif'] =
 
-            return options
+class SuperimposeInscriptionMixin(object):
+    """
+    Superimposes the key onto the image
+    """
+    # TODO
 
-    class SuperimposeInscriptionMixin(object):
+
+class Base64ExporterMixin(object):
+    pass
+
+
+class PNGImageKeyGenerator(TemplateImageMixin, MetadataInscriptionMixin, BaseImageKeyGenerator):
+    pass
+
+
+class SplicedPNGImageKeyGenerator(object):
+    """
+    Writes the key into a tEXt chunk spliced into the template PNG bytes, just before IEND.  The
+    template is read (and, if IMAGE_KEY_SIZE asks for it, resized with PIL) only once per process,
+    so generating a key doesn't decode, recompress or write any image data
+    """
+    image_template = os.path.join(settings.STATIC_ROOT, 'allauth_api', 'key.png')
+    keyword = 'key'
+
+    _templates = {}
+    _templates_lock = threading.Lock()
+
+    def create_image_key(self, key):
+        head, tail = self.get_template_parts()
+        return io.BytesIO(head + png_text_chunk(self.keyword, key) + tail)
+
+    def get_template_image(self):
+        return getattr(allauth_api_settings, "IMAGE_KEY_TEMPLATE", self.image_template)
+
+    def get_image_size(self):
+        size = getattr(allauth_api_settings, "IMAGE_KEY_SIZE", None)
+        return tuple(size) if size is not None else None
+
+    def get_template_parts(self):
         """
-        Superimposes the key onto the image
+        Returns the template bytes split at the IEND chunk
         """
-        # TODO
+        cache_key = (self.get_template_image(), self.get_image_size())
+        parts = self._templates.get(cache_key)
+        if parts is None:
+            with self._templates_lock:
+                parts = self._templates.get(cache_key)
+                if parts is None:
+                    parts = self._templates[cache_key] = self.load_template(*cache_key)
+        return parts
+
+    def load_template(self, path, size):
+        if getattr(allauth_api_settings, "IMAGE_KEY_FORMAT", "PNG") != "PNG":
+            raise ImproperlyConfigured("SplicedPNGImageKeyGenerator only generates PNG image keys")
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        try:
+            if size is not None:
+                data = self.resize_template(data, size)
+            chunks = list(iter_png_chunks(data))
+        except ValueError as e:
+            raise ImproperlyConfigured("Invalid image key template %s: %s" % (path, e))
+        if not chunks or chunks[0][0] != b'IHDR' or chunks[-1][0] != b'IEND':
+            raise ImproperlyConfigured("Invalid image key template %s: missing IHDR or IEND chunk" % path)
 
-    class Base64ExporterMixin(object):
-        pass
+        # Drop any key the template already carries so the spliced one is the only one
+        head = [data[:8]]
+        for chunk_type, offset, length in chunks[:-1]:
+            chunk = data[offset:offset + 12 + length]
+            if chunk_type in (b'tEXt', b'iTXt') and chunk[8:].split(b'\0', 1)[0] == self.keyword.encode('latin-1'):
+                continue
+            head.append(chunk)
+        return b''.join(head), data[chunks[-1][1]:]
 
-    class PNGImageKeyGenerator(TemplateImageMixin, MetadataInscriptionMixin, BaseImageKeyGenerator):
-        pass
+    def resize_template(self, data, size):
+        # The size is read from the IHDR chunk, which must come first
+        if data[:8] != PNG_SIGNATURE:
+            raise ValueError("Not a PNG image")
+        if len(data) < 24 or data[12:16] != b'IHDR':
+            raise ValueError("missing IHDR chunk")
+        width, height = struct.unpack('>II', data[16:24])
+        if (width, height) == size:
+            return data
+        Image, _ = import_pil("Resizing the image key template (IMAGE_KEY_SIZE)")
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail(size)
+        out = io.BytesIO()
+        image.save(out, format="PNG")
+        return out.getvalue()
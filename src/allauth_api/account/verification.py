@@ -0,0 +1,197 @@
+"""
+Cached email verification status.
+
+Whether a user has a verified email address is checked on every request to an endpoint protected
+by EmailVerified, and again on every login.  The answer rarely changes, so it is kept in the cache
+named by the CACHE_ALIAS setting for EMAIL_VERIFICATION_CACHE_TIMEOUT seconds and invalidated when
+one of the user's email addresses is confirmed, changed or removed.  Setting the timeout to None or
+0 disables the cache.
+
+Confirmation emails are throttled with a resend ledger: the time the last confirmation was sent to
+a user is kept in the same cache (backed by the EmailConfirmationLedger table), and no new one is
+sent until EMAIL_CONFIRMATION_RESEND_INTERVAL seconds have passed.  Before sending, a request
+reserves the slot with cache.add(), which only one of several concurrent requests wins, so they
+don't all send a confirmation.  This needs a cache shared by every process (not LocMemCache).
+"""
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from allauth.account import signals
+from allauth.account.models import EmailAddress
+from allauth.account.utils import send_email_confirmation as allauth_send_email_confirmation
+from allauth.utils import get_user_model
+
+from allauth_api.settings import allauth_api_settings
+
+CACHE_KEY_TEMPLATE = 'allauth_api:verified:%s'
+LEDGER_KEY_TEMPLATE = 'allauth_api:confirmation_sent:%s'
+RESERVATION_KEY_TEMPLATE = 'allauth_api:confirmation_reserved:%s'
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def get_cache():
+    return caches[allauth_api_settings.CACHE_ALIAS]
+
+
+def get_cache_key(user_id):
+    return CACHE_KEY_TEMPLATE % user_id
+
+
+def has_verified_email(user):
+    """
+    Returns True if the user has at least one verified email address
+    """
+    if user is None or user.pk is None:
+        return False
+
+    timeout = allauth_api_settings.EMAIL_VERIFICATION_CACHE_TIMEOUT
+    if not timeout:
+        return EmailAddress.objects.filter(user=user, verified=True).exists()
+
+    cache = get_cache()
+    key = get_cache_key(user.pk)
+    verified = cache.get(key)
+    if verified is None:
+        verified = EmailAddress.objects.filter(user=user, verified=True).exists()
+        cache.set(key, verified, timeout)
+    return verified
+
+
+def invalidate_verification_status(user_id):
+    get_cache().delete(get_cache_key(user_id))
+
+
+def to_db_datetime(timestamp):
+    value = datetime.fromtimestamp(timestamp, timezone.utc)
+    if not settings.USE_TZ:
+        value = timezone.make_naive(value, timezone.get_current_timezone())
+    return value
+
+
+def from_db_datetime(value):
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_current_timezone())
+    return (value - EPOCH).total_seconds()
+
+
+def get_last_confirmation_sent(user):
+    """
+    Returns the timestamp of the last confirmation email sent to the user, or 0 if there is none
+    """
+    from allauth_api.models import EmailConfirmationLedger
+
+    cache = get_cache()
+    key = LEDGER_KEY_TEMPLATE % user.pk
+    last_sent = cache.get(key)
+    if last_sent is None:
+        try:
+            last_sent = from_db_datetime(
+                EmailConfirmationLedger.objects.values_list('last_sent', flat=True).get(user=user))
+        except EmailConfirmationLedger.DoesNotExist:
+            last_sent = 0
+        cache.set(key, last_sent, allauth_api_settings.EMAIL_CONFIRMATION_RESEND_INTERVAL)
+    return last_sent
+
+
+def record_confirmation_sent(user, timestamp=None):
+    from allauth_api.models import EmailConfirmationLedger
+
+    if timestamp is None:
+        timestamp = time.time()
+    interval = allauth_api_settings.EMAIL_CONFIRMATION_RESEND_INTERVAL
+    cache = get_cache()
+    cache.set(LEDGER_KEY_TEMPLATE % user.pk, timestamp, interval)
+    # Keep the reservation in line with the ledger, it lasts until the next send is allowed
+    remaining = timestamp + (interval or 0) - time.time()
+    if remaining > 0:
+        cache.set(RESERVATION_KEY_TEMPLATE % user.pk, timestamp, remaining)
+    else:
+        cache.delete(RESERVATION_KEY_TEMPLATE % user.pk)
+
+    last_sent = to_db_datetime(timestamp)
+    if not EmailConfirmationLedger.objects.filter(user=user).update(last_sent=last_sent):
+        try:
+            with transaction.atomic():
+                EmailConfirmationLedger.objects.create(user=user, last_sent=last_sent)
+        except IntegrityError:
+            # Somebody else created it in the meantime
+            EmailConfirmationLedger.objects.filter(user=user).update(last_sent=last_sent)
+
+
+def next_confirmation_allowed(user):
+    """
+    Returns the (aware) datetime after which another confirmation email may be sent to the user,
+    or None if one can be sent right away
+    """
+    interval = allauth_api_settings.EMAIL_CONFIRMATION_RESEND_INTERVAL
+    if not interval or user.pk is None:
+        return None
+    allowed = get_last_confirmation_sent(user) + interval
+    if allowed <= time.time():
+        return None
+    return datetime.fromtimestamp(allowed, timezone.utc)
+
+
+def send_email_confirmation(request, user, signup=False):
+    """
+    Sends an email confirmation unless one was sent to the user less than
+    EMAIL_CONFIRMATION_RESEND_INTERVAL seconds ago.  Returns a (sent, next_allowed) tuple where
+    next_allowed is the datetime after which a new confirmation can be sent (None if there is no
+    interval)
+    """
+    interval = allauth_api_settings.EMAIL_CONFIRMATION_RESEND_INTERVAL
+    # The signup confirmation is the first one a user gets, it is never a duplicate
+    if not signup:
+        next_allowed = next_confirmation_allowed(user)
+        if next_allowed is not None:
+            return (False, next_allowed)
+    if not interval:
+        allauth_send_email_confirmation(request, user, signup=signup)
+        return (True, None)
+
+    cache = get_cache()
+    key = RESERVATION_KEY_TEMPLATE % user.pk
+    now = time.time()
+    if not cache.add(key, now, interval) and not signup:
+        # Another request is sending one right now
+        reserved = cache.get(key, now)
+        return (False, datetime.fromtimestamp(reserved + interval, timezone.utc))
+    try:
+        allauth_send_email_confirmation(request, user, signup=signup)
+    except Exception:
+        cache.delete(key)
+        raise
+    record_confirmation_sent(user, now)
+    return (True, datetime.fromtimestamp(now + interval, timezone.utc))
+
+
+@receiver(signals.email_confirmed)
+def email_confirmed_handler(sender, email_address, **kwargs):
+    invalidate_verification_status(email_address.user_id)
+
+
+@receiver(signals.email_removed)
+def email_removed_handler(sender, user, **kwargs):
+    invalidate_verification_status(user.pk)
+
+
+@receiver(post_save, sender=EmailAddress)
+@receiver(post_delete, sender=EmailAddress)
+def email_address_changed_handler(sender, instance, **kwargs):
+    # Catches changes that don't go through allauth's views, e.g. the admin or
+    # EmailAddress.objects.create() with verified=True
+    invalidate_verification_status(instance.user_id)
+
+
+@receiver(post_delete, sender=get_user_model())
+def user_deleted_handler(sender, instance, **kwargs):
+    # Primary keys can be reused (e.g. sqlite), don't let a new user inherit these
+    get_cache().delete_many([get_cache_key(instance.pk), LEDGER_KEY_TEMPLATE % instance.pk,
+                             RESERVATION_KEY_TEMPLATE % instance.pk])
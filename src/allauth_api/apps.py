@@ -0,0 +1,22 @@
+from django.apps import AppConfig
+
+
+class AllAuthAPIConfig(AppConfig):
+    name = 'allauth_api'
+    verbose_name = "Allauth API"
+
+    def ready(self):
+        # Connect signal receivers
+        from allauth_api.account import verification, identifiers, identifier_filter  # NOQA
+        # Resolve and validate the settings now rather than on the first request
+        from allauth_api.settings import allauth_api_settings
+        allauth_api_settings.snapshot
+
+        from allauth import app_settings
+        if app_settings.SOCIALACCOUNT_ENABLED:
+            from allauth.socialaccount import providers
+            from allauth_api.socialaccount import receivers  # NOQA
+            from allauth_api.socialaccount.providers import registry
+            # Load the providers while starting up, in a single thread
+            providers.registry.load()
+            registry.load()
@@ -0,0 +1,219 @@
+"""
+Per-request database query instrumentation.
+
+When QUERY_INSTRUMENTATION is on (by default, whenever DEBUG is), the views record every query
+they run, grouped by the phases marked with `phase()`, and compare the total with the view's
+`query_budget`.  Going over budget is logged, and `assert_query_budget()` turns it into a test
+failure.  In DEBUG the counts are also returned in the X-Query-Count, X-Query-Phases and
+X-Query-Duplicates response headers, and totals per view are kept in `get_stats()`.
+"""
+import threading
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from allauth_api.settings import allauth_api_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_PHASE = 'other'
+
+_local = threading.local()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def is_enabled():
+    enabled = allauth_api_settings.QUERY_INSTRUMENTATION
+    if enabled is None:
+        return settings.DEBUG
+    return enabled
+
+
+class QueryReport(object):
+    """
+    The queries run while handling one request
+    """
+
+    def __init__(self, view_name, queries, phases, budget=None):
+        self.view_name = view_name
+        self.queries = queries
+        # phase -> list of queries, in the order the phases started
+        self.phases = phases
+        self.budget = budget
+
+    def __len__(self):
+        return len(self.queries)
+
+    @property
+    def duplicates(self):
+        """
+        SQL statements run more than once, with their counts
+        """
+        counts = Counter(q['sql'] for q in self.queries)
+        return OrderedDict((sql, n) for sql, n in counts.items() if n > 1)
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and len(self) > self.budget
+
+    def phase_counts(self):
+        return OrderedDict((phase, len(queries)) for phase, queries in self.phases.items())
+
+    def describe(self):
+        lines = ["%s ran %d queries (budget %s)" % (self.view_name, len(self), self.budget)]
+        for phase, queries in self.phases.items():
+            lines.append("  %s: %d" % (phase, len(queries)))
+            for query in queries:
+                lines.append("    %s" % query['sql'])
+        return "\n".join(lines)
+
+
+class QueryRecorder(object):
+
+    def __init__(self, view_name, using=DEFAULT_DB_ALIAS):
+        self.view_name = view_name
+        self.connection = connections[using]
+        self.marks = []
+        self.phase_stack = [DEFAULT_PHASE]
+
+    def __enter__(self):
+        self.force_debug_cursor = self.connection.force_debug_cursor
+        self.connection.force_debug_cursor = True
+        self.initial = len(self.connection.queries_log)
+        self.marks.append((self.initial, DEFAULT_PHASE))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.final = len(self.connection.queries_log)
+        self.connection.force_debug_cursor = self.force_debug_cursor
+
+    def enter_phase(self, name):
+        self.phase_stack.append(name)
+        self.marks.append((len(self.connection.queries_log), name))
+
+    def exit_phase(self):
+        self.phase_stack.pop()
+        self.marks.append((len(self.connection.queries_log), self.phase_stack[-1]))
+
+    def report(self, budget=None):
+        log = list(self.connection.queries_log)
+        queries = log[self.initial:self.final]
+        phases = OrderedDict()
+        marks = self.marks + [(self.final, None)]
+        for (start, phase), (end, _) in zip(marks, marks[1:]):
+            if end > start:
+                phases.setdefault(phase, []).extend(log[start:end])
+        return QueryReport(self.view_name, queries, phases, budget)
+
+
+def _get_stack():
+    stack = getattr(_local, 'recorders', None)
+    if stack is None:
+        stack = _local.recorders = []
+    return stack
+
+
+@contextmanager
+def record(view_name):
+    """
+    Records the queries run inside the block.  Yields the recorder; call its report() afterwards
+    """
+    stack = _get_stack()
+    with QueryRecorder(view_name) as recorder:
+        stack.append(recorder)
+        try:
+            yield recorder
+        finally:
+            stack.pop()
+
+
+@contextmanager
+def phase(name):
+    """
+    Attributes the queries run inside the block to the named phase of the current request.  Does
+    nothing if the request isn't being recorded
+    """
+    stack = _get_stack()
+    if not stack:
+        yield
+        return
+    recorder = stack[-1]
+    recorder.enter_phase(name)
+    try:
+        yield
+    finally:
+        recorder.exit_phase()
+
+
+def add_stats(report):
+    with _stats_lock:
+        stats = _stats.setdefault(report.view_name, {'requests': 0, 'queries': 0, 'max_queries': 0,
+                                                     'over_budget': 0, 'phases': {}})
+        stats['requests'] += 1
+        stats['queries'] += len(report)
+        stats['max_queries'] = max(stats['max_queries'], len(report))
+        if report.over_budget:
+            stats['over_budget'] += 1
+        for phase_name, count in report.phase_counts().items():
+            stats['phases'][phase_name] = stats['phases'].get(phase_name, 0) + count
+
+
+def get_stats():
+    """
+    Returns query totals per view (and phase) since the process started or reset_stats() was called
+    """
+    with _stats_lock:
+        return dict((view, dict(stats, phases=dict(stats['phases']))) for view, stats in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def assert_query_budget(response):
+    """
+    Test helper raising QueryBudgetExceeded, with the offending queries, if the view that produced
+    the response went over its query budget.  QUERY_INSTRUMENTATION must be on
+    """
+    report = getattr(response, 'query_report', None)
+    if report is None:
+        raise AssertionError("The response carries no query report, is QUERY_INSTRUMENTATION on?")
+    if report.over_budget:
+        raise QueryBudgetExceeded(report.describe())
+    return report
+
+
+class QueryBudgetMixin(object):
+    """
+    View mixin recording the queries run by each request (see above).  Set query_budget to the
+    maximum number of queries the view may run
+    """
+    query_budget = None
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_enabled():
+            return super(QueryBudgetMixin, self).dispatch(request, *args, **kwargs)
+
+        view_name = self.__class__.__name__
+        with record(view_name) as recorder:
+            response = super(QueryBudgetMixin, self).dispatch(request, *args, **kwargs)
+        report = recorder.report(self.query_budget)
+        add_stats(report)
+        if report.over_budget:
+            logger.warning("%s ran %d queries, over its budget of %d", view_name, len(report), report.budget)
+
+        response.query_report = report
+        if settings.DEBUG:
+            response['X-Query-Count'] = '%d' % len(report)
+            response['X-Query-Phases'] = ', '.join('%s=%d' % item for item in report.phase_counts().items())
+            response['X-Query-Duplicates'] = '%d' % sum(n - 1 for n in report.duplicates.values())
+        return response
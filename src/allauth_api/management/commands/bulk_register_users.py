@@ -0,0 +1,50 @@
+import json
+import sys
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from allauth_api.account import bulk
+
+
+class Command(BaseCommand):
+    help = ("Registers the users of a file with one JSON object per line (username, email and optionally "
+            "password, first_name, last_name and verified), writing the result of each line to stdout")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The file to read, - for stdin")
+        parser.add_argument('--no-confirmation', action='store_false', dest='send_confirmation', default=True,
+                            help="Don't send confirmation mails to the unverified addresses")
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="Number of users inserted per transaction")
+
+    def handle(self, *args, **options):
+        rows = self.read_rows(options['path'])
+        counts = Counter()
+        for result in bulk.register_users(rows, send_confirmation=options['send_confirmation'],
+                                          chunk_size=options['chunk_size']):
+            counts[result['status']] += 1
+            self.stdout.write(json.dumps(result))
+
+        if options['verbosity'] > 0:
+            self.stderr.write("%d user(s) created, %d rejected, %d failed" % (
+                counts[bulk.CREATED], counts[bulk.REJECTED], counts[bulk.FAILED]))
+
+    def read_rows(self, path):
+        stream = sys.stdin if path == '-' else open(path)
+        rows = []
+        try:
+            for number, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise CommandError("Line %d is not valid JSON: %s" % (number, e))
+                if not isinstance(row, dict):
+                    raise CommandError("Line %d is not a JSON object" % number)
+                rows.append(row)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        return rows
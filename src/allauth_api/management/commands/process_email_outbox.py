@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from allauth_api.account.outbox import DatabaseOutbox
+from allauth_api.settings import allauth_api_settings
+
+
+class Command(BaseCommand):
+    help = "Delivers the emails queued in the allauth_api outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help="Keep polling the outbox instead of exiting once it is empty")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to sleep between polls when the outbox is empty (with --loop)")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Number of messages delivered per mail connection")
+        parser.add_argument('--stale-timeout', type=int, default=300,
+                            help="Seconds after which messages claimed by a dead worker are retried")
+
+    def handle(self, *args, **options):
+        outbox = DatabaseOutbox()
+        batch_size = options['batch_size'] or allauth_api_settings.EMAIL_OUTBOX_BATCH_SIZE
+        total_sent = total_failed = 0
+        while True:
+            outbox.release_stale(options['stale_timeout'])
+            sent, failed = outbox.drain(limit=batch_size)
+            total_sent += sent
+            total_failed += failed
+            # Failed messages wait for their next attempt, only a full batch means more are due
+            if sent + failed >= batch_size:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        if options['verbosity'] > 0:
+            self.stdout.write("Sent %d message(s), %d failed" % (total_sent, total_failed))
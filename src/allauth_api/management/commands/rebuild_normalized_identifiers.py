@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+
+from allauth.account import app_settings
+from allauth.utils import get_user_model
+
+from allauth_api.account.identifiers import normalize
+from allauth_api.models import NormalizedIdentifier
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the normalized identifiers used with the NORMALIZED_IDS setting.  Rows are updated "
+            "in place, batch by batch, so lookups keep working while it runs")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of users synced per batch")
+
+    def handle(self, *args, **options):
+        fields = ['pk']
+        fields.append(app_settings.USER_MODEL_USERNAME_FIELD or 'pk')
+        fields.append(app_settings.USER_MODEL_EMAIL_FIELD or 'pk')
+        has_username = app_settings.USER_MODEL_USERNAME_FIELD is not None
+        has_email = app_settings.USER_MODEL_EMAIL_FIELD is not None
+
+        User = get_user_model()
+        users = User.objects.order_by('pk').values_list(*fields).iterator()
+
+        total = 0
+        self.clashes = []
+        # Rows whose username was still held by a stale row, retried once every batch is synced
+        self.retries = []
+        batch = []
+        for pk, username, email in users:
+            batch.append(NormalizedIdentifier(user_id=pk,
+                                              username=normalize(username) or None if has_username else None,
+                                              email=normalize(email) or '' if has_email else ''))
+            if len(batch) >= options['batch_size']:
+                total += self.sync(batch)
+                batch = []
+        if batch:
+            total += self.sync(batch)
+
+        retries, self.retries = self.retries, []
+        # Free the stale usernames of the rows retried, e.g. of two users who swapped usernames
+        NormalizedIdentifier.objects.filter(pk__in=[identifier.user_id for identifier, exists in retries if exists]) \
+            .update(username=None)
+        for identifier, exists in retries:
+            if not self.save(identifier, exists):
+                self.clashes.append((identifier.user_id, identifier.username))
+                identifier.username = None
+                identifier.save(force_update=exists, force_insert=not exists)
+
+        # Rows of users deleted without the cascade (e.g. databases without foreign keys)
+        NormalizedIdentifier.objects.exclude(user__in=User.objects.all()).delete()
+
+        if options['verbosity'] > 0:
+            self.stdout.write("Stored normalized identifiers for %d user(s)" % total)
+            for pk, username in self.clashes:
+                self.stderr.write("User %s: username '%s' is already taken by another user in a different case, "
+                                  "it won't be found by username" % (pk, username))
+
+    def sync(self, batch):
+        """
+        Inserts the missing rows of batch and updates the stale ones
+        """
+        existing = dict((identifier.pk, (identifier.username, identifier.email)) for identifier in
+                        NormalizedIdentifier.objects.filter(pk__in=[identifier.user_id for identifier in batch]))
+        new = [identifier for identifier in batch if identifier.user_id not in existing]
+        changed = [identifier for identifier in batch if identifier.user_id in existing and
+                   existing[identifier.user_id] != (identifier.username, identifier.email)]
+        try:
+            with transaction.atomic():
+                for identifier in changed:
+                    identifier.save(force_update=True)
+                NormalizedIdentifier.objects.bulk_create(new)
+        except IntegrityError:
+            # Some usernames only differ by case, or are still held by a row not synced yet
+            pending = [(identifier, True) for identifier in changed] + [(identifier, False) for identifier in new]
+            for identifier, exists in pending:
+                if not self.save(identifier, exists):
+                    self.retries.append((identifier, exists))
+        return len(batch)
+
+    def save(self, identifier, exists):
+        try:
+            with transaction.atomic():
+                identifier.save(force_update=exists, force_insert=not exists)
+        except IntegrityError:
+            return False
+        return True
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:10
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('allauth_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailConfirmationLedger',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+                ('last_sent', models.DateTimeField(verbose_name='last sent')),
+            ],
+            options={
+                'verbose_name': 'email confirmation ledger entry',
+                'verbose_name_plural': 'email confirmation ledger',
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:25
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('allauth_api', '0003_devicetoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NormalizedIdentifier',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='normalized_identifier', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+                ('username', models.CharField(blank=True, max_length=254, null=True, unique=True, verbose_name='username')),
+                ('email', models.CharField(blank=True, db_index=True, max_length=254, verbose_name='email')),
+            ],
+            options={
+                'verbose_name': 'normalized identifier',
+                'verbose_name_plural': 'normalized identifiers',
+            },
+        ),
+    ]
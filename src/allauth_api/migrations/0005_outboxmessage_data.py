@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fail_pickled_messages(apps, schema_editor):
+    # Messages queued before this migration were pickled.  They are not unpickled (that runs
+    # whatever the column holds), but marked as failed so they can be looked into
+    OutboxMessage = apps.get_model('allauth_api', 'OutboxMessage')
+    OutboxMessage.objects.filter(status__in=['pending', 'sending']).update(
+        status='failed', last_error="Queued in the old pickle format, not delivered")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allauth_api', '0004_normalizedidentifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='data',
+            field=models.TextField(default='', verbose_name='data'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='next attempt at'),
+        ),
+        migrations.RunPython(fail_pickled_messages, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='outboxmessage',
+            name='message',
+        ),
+    ]
@@ -0,0 +1,191 @@
+import base64
+import binascii
+import json
+import os
+from email import encoders
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.db import models
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext_lazy as _
+
+
+# Headers of MIME attachments that are set again when the part is rebuilt
+MIME_PART_HEADERS = ('content-type', 'content-transfer-encoding', 'mime-version')
+
+
+def attachment_to_list(attachment):
+    if isinstance(attachment, MIMEBase):
+        headers = [[force_text(name), force_text(value)] for name, value in attachment.items()
+                   if name.lower() not in MIME_PART_HEADERS]
+        payload = base64.b64encode(attachment.get_payload(decode=True) or b'').decode('ascii')
+        return ['mime', attachment.get_content_maintype(), attachment.get_content_subtype(), payload, headers]
+    filename, content, mimetype = attachment
+    if isinstance(content, six.binary_type):
+        return ['file', filename, base64.b64encode(content).decode('ascii'), mimetype, True]
+    return ['file', filename, force_text(content), mimetype, False]
+
+
+def attachment_from_list(data):
+    if data[0] == 'mime':
+        maintype, subtype, payload, headers = data[1:]
+        attachment = MIMEBase(maintype, subtype)
+        attachment.set_payload(base64.b64decode(payload))
+        encoders.encode_base64(attachment)
+        for name, value in headers:
+            attachment.add_header(name, value)
+        return attachment
+    filename, content, mimetype, encoded = data[1:]
+    return (filename, base64.b64decode(content) if encoded else content, mimetype)
+
+
+def message_to_dict(message):
+    """
+    The fields of an EmailMessage (or EmailMultiAlternatives) as JSON-serializable data.  Attachments
+    can be (filename, content, mimetype) tuples or MIME parts, e.g. the inline image of an image key
+    """
+    return {
+        'subject': force_text(message.subject),
+        'body': force_text(message.body),
+        'from_email': force_text(message.from_email),
+        'to': [force_text(address) for address in message.to],
+        'cc': [force_text(address) for address in message.cc],
+        'bcc': [force_text(address) for address in message.bcc],
+        'reply_to': [force_text(address) for address in message.reply_to],
+        'headers': dict((force_text(k), force_text(v)) for k, v in message.extra_headers.items()),
+        'content_subtype': message.content_subtype,
+        'alternatives': [[force_text(content), mimetype] for content, mimetype in
+                         getattr(message, 'alternatives', ())],
+        'attachments': [attachment_to_list(attachment) for attachment in message.attachments],
+    }
+
+
+def message_from_dict(data):
+    """
+    Rebuilds the message stored by message_to_dict
+    """
+    message_class = EmailMultiAlternatives if data['alternatives'] else EmailMessage
+    message = message_class(subject=data['subject'], body=data['body'], from_email=data['from_email'],
+                            to=data['to'], cc=data['cc'], bcc=data['bcc'], reply_to=data['reply_to'],
+                            headers=data['headers'])
+    message.content_subtype = data['content_subtype']
+    for content, mimetype in data['alternatives']:
+        message.attach_alternative(content, mimetype)
+    for attachment in data['attachments']:
+        attachment = attachment_from_list(attachment)
+        if isinstance(attachment, MIMEBase):
+            message.attach(attachment)
+        else:
+            message.attach(*attachment)
+    return message
+
+
+class OutboxMessage(models.Model):
+    """
+    An email message waiting in the outbox to be delivered by a worker.  The message is stored as
+    JSON (see message_to_dict).  Failed deliveries are retried after next_attempt_at, until
+    EMAIL_OUTBOX_MAX_ATTEMPTS is reached and the message is FAILED for good
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (SENDING, _('Sending')),
+        (SENT, _('Sent')),
+        (FAILED, _('Failed')),
+    )
+
+    status = models.CharField(_('status'), max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    subject = models.CharField(_('subject'), max_length=255, blank=True)
+    recipients = models.TextField(_('recipients'), blank=True)
+    data = models.TextField(_('data'))
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    next_attempt_at = models.DateTimeField(_('next attempt at'), null=True, blank=True, db_index=True)
+    last_error = models.TextField(_('last error'), blank=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+    sent = models.DateTimeField(_('sent'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('outbox message')
+        verbose_name_plural = _('outbox messages')
+        ordering = ('created',)
+
+    def __str__(self):
+        return "%s (%s)" % (self.subject, self.status)
+
+    def set_message(self, message):
+        self.subject = message.subject[:255]
+        self.recipients = ", ".join(message.recipients())
+        self.data = json.dumps(message_to_dict(message))
+
+    def get_message(self):
+        return message_from_dict(json.loads(self.data))
+
+
+class EmailConfirmationLedger(models.Model):
+    """
+    When an email confirmation was last sent to a user.  Backs the cached resend ledger used to
+    throttle confirmation emails (see EMAIL_CONFIRMATION_RESEND_INTERVAL)
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name='+', verbose_name=_('user'))
+    last_sent = models.DateTimeField(_('last sent'))
+
+    class Meta:
+        verbose_name = _('email confirmation ledger entry')
+        verbose_name_plural = _('email confirmation ledger')
+
+    def __str__(self):
+        return "%s (%s)" % (self.user_id, self.last_sent)
+
+
+class DeviceToken(models.Model):
+    """
+    An authentication token for one of a user's devices.  Unlike rest_framework's Token, a user can
+    have any number of these, so logging out on one device doesn't log out the others
+    """
+    key = models.CharField(_('key'), max_length=40, primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='device_tokens',
+                             verbose_name=_('user'))
+    device = models.CharField(_('device'), max_length=64, blank=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('device token')
+        verbose_name_plural = _('device tokens')
+
+    def __str__(self):
+        return self.key
+
+    def save(self, *args, **kwargs):
+        if not self.key:
+            self.key = self.generate_key()
+        return super(DeviceToken, self).save(*args, **kwargs)
+
+    @staticmethod
+    def generate_key():
+        return binascii.hexlify(os.urandom(20)).decode()
+
+
+class NormalizedIdentifier(models.Model):
+    """
+    Lowercased copies of a user's username and email, so that case-insensitive lookups can be exact
+    matches on an index (see allauth_api.account.identifiers)
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name='normalized_identifier', verbose_name=_('user'))
+    username = models.CharField(_('username'), max_length=254, unique=True, null=True, blank=True)
+    email = models.CharField(_('email'), max_length=254, db_index=True, blank=True)
+
+    class Meta:
+        verbose_name = _('normalized identifier')
+        verbose_name_plural = _('normalized identifiers')
+
+    def __str__(self):
+        return self.username or self.email
@@ -16,8 +16,12 @@ allauth API settings, checking for user settings first, then falling
 back to the defaults.
 """
 from __future__ import unicode_literals
+import threading
 from importlib import import_module
+from types import MappingProxyType
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from django.utils import six
 
 
@@ -27,9 +31,16 @@ DEFAULTS = {
     'API_FRAMEWORK': 'rest_framework',
     'PROVIDER_PARAMETER_NAME': 'provider',
     'PROVIDER_MODULES': [
-        'allauth_api.socialaccount.providers.facebook'
+        'allauth_api.socialaccount.providers.facebook',
+        # 'allauth_api.socialaccount.providers.google',
+        # 'allauth_api.socialaccount.providers.apple',
     ],
     'CASE_INSENSITIVE_IDS': False,
+    'NORMALIZED_IDS': False,
+    'IDENTIFIER_FILTER': False,
+    'IDENTIFIER_FILTER_CAPACITY': 1000000,
+    'IDENTIFIER_FILTER_ERROR_RATE': 0.01,
+    'IDENTIFIER_FILTER_PATH': None,
     'AUTO_SEND_EMAIL_CONFIRMATION': True,
     'USE_DJANGO_MESSAGES': False,
     'DRF_LOGIN_TYPE': 'oauth2',
@@ -37,10 +48,14 @@ DEFAULTS = {
         'basic': 'allauth_api.account.rest_framework.authentication.BasicLogin',
         'session': 'allauth_api.account.rest_framework.authentication.BasicLogin',
         'token': 'allauth_api.account.rest_framework.authentication.TokenLogin',
+        'device_token': 'allauth_api.account.rest_framework.authentication.DeviceTokenLogin',
+        'signed_token': 'allauth_api.account.rest_framework.authentication.SignedTokenLogin',
         # 'oauth2': 'allauth_api.account.rest_framework.authentication.OAuth2Login',
         'social_basic': 'allauth_api.socialaccount.rest_framework.authentication.BasicLogin',
         'social_session': 'allauth_api.socialaccount.rest_framework.authentication.BasicLogin',
         'social_token': 'allauth_api.socialaccount.rest_framework.authentication.TokenLogin',
+        'social_device_token': 'allauth_api.socialaccount.rest_framework.authentication.DeviceTokenLogin',
+        'social_signed_token': 'allauth_api.socialaccount.rest_framework.authentication.SignedTokenLogin',
         # 'social_oauth2': 'allauth_api.socialaccount.rest_framework.authentication.OAuth2Login',
     },
     'DRF_LOGIN_VIEW_PERMISSIONS': ('rest_framework.permissions.AllowAny',),
@@ -51,13 +66,59 @@ DEFAULTS = {
     'DRF_PASSWORD_RESET_PERMISSIONS': ('rest_framework.permissions.AllowAny',),
     'DRF_REGISTRATIONS_VIEW_PERMISSIONS': ('rest_framework.permissions.AllowAny',),
     'DRF_PROVIDERS_VIEW_PERMISSIONS': ('rest_framework.permissions.AllowAny',),
+    'DRF_REGISTRATIONS_VIEW_THROTTLES': (),
+    'DRF_BULK_REGISTER_PERMISSIONS': ('rest_framework.permissions.IsAdminUser',),
     'DRF_API_VIEW': 'rest_framework.views.APIView',
     'IMAGE_KEY_PREFIXES': [
         'account/email/email_confirmation_signup',
         'account/email/email_confirmation',
         'account/email/password_reset_key',
     ],
-    'IMAGE_KEY_GENERATOR_CLASS': 'allauth_api.account.utils.PNGImageKeyGenerator',
+    'IMAGE_KEY_SIZE': None,
+    'IMAGE_KEY_MAX_BYTES': 1024 * 1024,
+    'IMAGE_KEY_MAX_CHUNKS': 64,
+    'IMAGE_KEY_GENERATOR_CLASS': 'allauth_api.account.utils.SplicedPNGImageKeyGenerator',
+    'EMAIL_OUTBOX_CLASS': 'allauth_api.account.outbox.ImmediateOutbox',
+    'EMAIL_OUTBOX_WORKERS': 2,
+    'EMAIL_OUTBOX_BATCH_SIZE': 100,
+    'EMAIL_OUTBOX_MAX_ATTEMPTS': 5,
+    'EMAIL_OUTBOX_RETRY_DELAY': 60,
+    'EMAIL_OUTBOX_MAX_RETRY_DELAY': 3600,
+    'CACHE_ALIAS': 'default',
+    'EMAIL_VERIFICATION_CACHE_TIMEOUT': 300,
+    'EMAIL_CONFIRMATION_RESEND_INTERVAL': 180,
+    'SIGNED_TOKEN_KEYS': {},
+    'SIGNED_TOKEN_KEY_ID': None,
+    'SIGNED_TOKEN_LIFETIME': 3600,
+    'PASSWORD_HASHING_EXECUTOR': None,
+    'PASSWORD_HASHING_WORKERS': 4,
+    'PASSWORD_HASHING_QUEUE_DEPTH': 16,
+    'PASSWORD_HASHING_TIMEOUT': 10,
+    'PASSWORD_HASHING_RETRY_AFTER': 1,
+    'LOGIN_THROTTLE_RATES': {},
+    'LOGIN_THROTTLE_LOCKOUT': 60,
+    'LOGIN_THROTTLE_MAX_LOCKOUT': 3600,
+    'LOGIN_THROTTLE_LOCAL_SIZE': 10000,
+    'LOGIN_THROTTLE_IP_META_KEY': 'REMOTE_ADDR',
+    'LOGIN_JOIN_TOKEN': True,
+    'QUERY_INSTRUMENTATION': None,
+    'REGISTRATIONS_BATCH_MAX': 500,
+    'REGISTRATIONS_QUERY_CHUNK_SIZE': 500,
+    'BULK_REGISTER_MAX': 10000,
+    'BULK_REGISTER_CHUNK_SIZE': 500,
+    'PROVIDERS_CACHE_MAX_AGE': 300,
+    'PROVIDER_SETTINGS': {},
+    'SOCIAL_TOKEN_CACHE_TIMEOUT': 300,
+    'PROVIDER_HTTP_TIMEOUT': 10,
+    'PROVIDER_HTTP_RETRIES': 2,
+    'PROVIDER_HTTP_BACKOFF': 0.1,
+    'PROVIDER_HTTP_POOL_SIZE': 10,
+    'PROVIDER_HTTP_WORKERS': 8,
+    'OIDC_JWKS_MAX_AGE': 3600,
+    'OIDC_JWKS_REFETCH_INTERVAL': 60,
+    'OIDC_LEEWAY': 60,
+    'SOCIAL_SIGNUP_STATE': 'session',
+    'SOCIAL_SIGNUP_TOKEN_MAX_AGE': 3600,
 }
 
 
@@ -72,8 +133,11 @@ IMPORT_STRINGS = (
     'DRF_PASSWORD_RESET_PERMISSIONS',
     'DRF_REGISTRATIONS_VIEW_PERMISSIONS',
     'DRF_PROVIDERS_VIEW_PERMISSIONS',
+    'DRF_REGISTRATIONS_VIEW_THROTTLES',
+    'DRF_BULK_REGISTER_PERMISSIONS',
     'DRF_API_VIEW',
-    'IMAGE_KEY_GENERATOR_CLASS'
+    'IMAGE_KEY_GENERATOR_CLASS',
+    'EMAIL_OUTBOX_CLASS',
 )
 
 
@@ -109,6 +173,34 @@ def import_from_string(val, setting_name):
         raise ImportError(msg)
 
 
+class SettingsSnapshot(object):
+    """
+    The resolved and validated settings at one point in time.  Read only, so that it can be
+    shared by every thread and replaced as a whole
+    """
+
+    def __init__(self, values, login_handlers):
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, 'login_handlers', login_handlers)
+
+    def __getattr__(self, attr):
+        try:
+            return self._values[attr]
+        except KeyError:
+            raise AttributeError("Invalid API setting: '%s'" % attr)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("API settings are read only, refresh() them instead")
+
+
+def freeze(val):
+    if isinstance(val, dict):
+        return MappingProxyType(dict(val))
+    if isinstance(val, list):
+        return tuple(val)
+    return val
+
+
 class AllAuthAPISettings(object):
     """
     A settings object, that allows API settings to be accessed as properties.
@@ -119,43 +211,121 @@ class AllAuthAPISettings(object):
 
     Any setting with string import paths will be automatically resolved
     and return the class, rather than the string literal.
+
+    The settings are compiled into a read only snapshot when the app is ready (or on first use):
+    every import string is resolved, the values are validated, and one instance of each login
+    handler is created.  refresh() compiles a new snapshot and swaps it in, so readers always see
+    either the old or the new settings as a whole.
     """
     def __init__(self, user_settings=None, defaults=None, import_strings=None):
         self.user_settings = user_settings or {}
         self.defaults = defaults or {}
         self.import_strings = import_strings or ()
+        self._snapshot = None
+        self._lock = threading.RLock()
+        self._compiling = threading.local()
 
     def __getattr__(self, attr):
-        if attr not in self.defaults.keys():
+        if attr.startswith('_') or attr not in self.defaults:
             raise AttributeError("Invalid API setting: '%s'" % attr)
+        compiling = getattr(self._compiling, 'user_settings', None)
+        if compiling is not None:
+            # A module imported while compiling reads a setting at import time
+            return self.resolve(compiling, attr)
+        return getattr(self.snapshot, attr)
 
-        try:
-            # Check if present in user settings
-            val = self.user_settings[attr]
-        except KeyError:
-            # Fall back to defaults
-            val = self.defaults[attr]
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self.compile(self.user_settings)
+                snapshot = self._snapshot
+        return snapshot
+
+    @property
+    def login_handlers(self):
+        """
+        Maps each login_type to its login handler instance
+        """
+        return self.snapshot.login_handlers
 
+    def resolve(self, user_settings, attr):
+        val = user_settings.get(attr, self.defaults[attr])
         # Coerce import strings into classes
         if val and attr in self.import_strings:
             val = perform_import(val, attr)
+        return val
 
-        self.validate_setting(attr, val)
+    def compile(self, user_settings):
+        """
+        Returns a snapshot of the settings, raising ImproperlyConfigured if they are invalid
+        """
+        self._compiling.user_settings = user_settings
+        try:
+            drf = user_settings.get('API_FRAMEWORK', self.defaults.get('API_FRAMEWORK')) == 'rest_framework'
+            values = {}
+            for attr in self.defaults:
+                if attr.startswith('DRF_') and not drf:
+                    # Only resolved for the rest_framework API
+                    values[attr] = user_settings.get(attr, self.defaults[attr])
+                else:
+                    values[attr] = freeze(self.resolve(user_settings, attr))
+        finally:
+            self._compiling.user_settings = None
 
-        # Cache the result
-        setattr(self, attr, val)
-        return val
+        self.validate(values)
+        login_handlers = {}
+        if drf:
+            login_handlers = dict((login_type, login_class())
+                                  for login_type, login_class in values['DRF_LOGIN_CLASSES'].items() if login_class)
+        return SettingsSnapshot(values, MappingProxyType(login_handlers))
 
-    def validate_setting(self, attr, val):
-        if attr == 'FILTER_BACKEND' and val is not None:
-            # Make sure we can initialize the class
-            val()
+    def validate(self, values):
+        def check(valid, message, *args):
+            if not valid:
+                raise ImproperlyConfigured("ALLAUTH_API: " + message % args)
+
+        if values['API_FRAMEWORK'] == 'rest_framework':
+            login_classes = values['DRF_LOGIN_CLASSES'] or {}
+            for login_type, login_class in login_classes.items():
+                check(not login_class or (callable(login_class) and hasattr(login_class, 'login')),
+                      "DRF_LOGIN_CLASSES['%s'] is not a login handler class", login_type)
+
+        for scope, rate in (values['LOGIN_THROTTLE_RATES'] or {}).items():
+            check(scope != 'identifier', "LOGIN_THROTTLE_RATES can't lock out an identifier from every IP, "
+                                         "use 'identifier_ip'")
+            check(scope in ('ip', 'identifier_ip'), "unknown LOGIN_THROTTLE_RATES scope '%s'", scope)
+            check(rate is None or (len(rate) == 2 and all(isinstance(n, int) and n > 0 for n in rate)),
+                  "LOGIN_THROTTLE_RATES['%s'] must be a (failures, seconds) pair", scope)
+        check(values['PASSWORD_HASHING_EXECUTOR'] in (None, 'thread', 'process'),
+              "PASSWORD_HASHING_EXECUTOR must be None, 'thread' or 'process'")
+        check(0 < values['IDENTIFIER_FILTER_ERROR_RATE'] < 1, "IDENTIFIER_FILTER_ERROR_RATE must be between 0 and 1")
+        check(values['IDENTIFIER_FILTER_CAPACITY'] > 0, "IDENTIFIER_FILTER_CAPACITY must be positive")
+        check(not values['IDENTIFIER_FILTER'] or values['IDENTIFIER_FILTER_PATH'],
+              "IDENTIFIER_FILTER needs an IDENTIFIER_FILTER_PATH shared by every process registering users")
+        check(values['EMAIL_OUTBOX_MAX_ATTEMPTS'] > 0, "EMAIL_OUTBOX_MAX_ATTEMPTS must be positive")
+        check(0 <= values['EMAIL_OUTBOX_RETRY_DELAY'] <= values['EMAIL_OUTBOX_MAX_RETRY_DELAY'],
+              "EMAIL_OUTBOX_RETRY_DELAY must be between 0 and EMAIL_OUTBOX_MAX_RETRY_DELAY")
+        check(values['SOCIAL_SIGNUP_STATE'] in ('session', 'token'), "SOCIAL_SIGNUP_STATE must be 'session' or 'token'")
+        check(values['IMAGE_KEY_SIZE'] is None or len(values['IMAGE_KEY_SIZE']) == 2,
+              "IMAGE_KEY_SIZE must be None or a (width, height) pair")
 
     def refresh(self, user_settings=None):
-        self.user_settings = user_settings or {}
-        for k in list(user_settings):
-            if hasattr(self, k):
-                delattr(self, k)
+        user_settings = user_settings or {}
+        snapshot = self.compile(user_settings)
+        with self._lock:
+            self.user_settings = user_settings
+            self._snapshot = snapshot
 
 
 allauth_api_settings = AllAuthAPISettings(USER_SETTINGS, DEFAULTS, IMPORT_STRINGS)
+
+
+def reload_api_settings(setting, value, **kwargs):
+    if setting == 'ALLAUTH_API':
+        allauth_api_settings.refresh(value)
+
+
+setting_changed.connect(reload_api_settings)
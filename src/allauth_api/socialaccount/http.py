@@ -0,0 +1,145 @@
+"""
+HTTP client for the social providers' APIs.
+
+Every call to a provider goes through a process-wide requests session per provider host, so the
+connections are kept alive and reused across logins (up to PROVIDER_HTTP_POOL_SIZE of them per
+host).  Calls time out after PROVIDER_HTTP_TIMEOUT seconds, and failed connections and 502, 503 and
+504 responses are retried PROVIDER_HTTP_RETRIES times, PROVIDER_HTTP_BACKOFF seconds apart (doubling
+each time).
+
+A login that needs several calls (say the token check, the profile and the picture) makes them at
+the same time with `run_concurrently()`, on a pool of PROVIDER_HTTP_WORKERS threads, so it takes as
+long as the slowest one rather than their sum.  Latency and error counts per provider are kept in
+`get_stats()`.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.utils.six.moves.urllib.parse import urlsplit
+
+from allauth_api.settings import allauth_api_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_session(url):
+    """
+    Returns the shared session for the host of url
+    """
+    scheme, host = urlsplit(url)[:2]
+    config = (allauth_api_settings.PROVIDER_HTTP_RETRIES, allauth_api_settings.PROVIDER_HTTP_BACKOFF,
+              allauth_api_settings.PROVIDER_HTTP_POOL_SIZE)
+    # Settings changes get a new session
+    key = (scheme, host) + config
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = create_session(scheme, *config)
+    return session
+
+
+def create_session(scheme, retries, backoff, pool_size):
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    session = requests.Session()
+    session.mount(scheme + '://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+    return session
+
+
+def get(provider_id, url, params=None, **kwargs):
+    """
+    GETs url, for provider_id, with the shared session of its host.  Raises requests' exceptions
+    """
+    kwargs.setdefault('timeout', allauth_api_settings.PROVIDER_HTTP_TIMEOUT)
+    start = time.time()
+    error = True
+    try:
+        response = get_session(url).get(url, params=params, **kwargs)
+        error = response.status_code >= 500
+        return response
+    finally:
+        add_stats(provider_id, time.time() - start, error)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _executor = ThreadPoolExecutor(max_workers=allauth_api_settings.PROVIDER_HTTP_WORKERS)
+    return _executor
+
+
+def run_concurrently(*funcs):
+    """
+    Calls the functions at the same time and returns their results, in order.  The first one runs
+    in the calling thread.  If any of them raised, the first exception is raised once they're all done
+    """
+    futures = [get_executor().submit(func) for func in funcs[1:]]
+    results = []
+    errors = []
+    for func, future in zip(funcs, [None] + futures):
+        try:
+            results.append(func() if future is None else future.result())
+        except Exception as e:
+            results.append(None)
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def reset():
+    """
+    Closes the shared sessions and worker threads, they're created again when next needed
+    """
+    global _executor
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = None
+
+
+def add_stats(provider_id, seconds, error):
+    with _stats_lock:
+        stats = _stats.setdefault(provider_id, {'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['requests'] += 1
+        if error:
+            stats['errors'] += 1
+        stats['total_ms'] += seconds * 1000
+        stats['max_ms'] = max(stats['max_ms'], seconds * 1000)
+
+
+def get_stats():
+    """
+    Returns the request count, error count (failed connections and 5xx responses) and latency of the
+    calls made to each provider since the process started or reset_stats() was called
+    """
+    with _stats_lock:
+        return dict((provider_id, dict(stats, mean_ms=stats['total_ms'] / stats['requests']))
+                    for provider_id, stats in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
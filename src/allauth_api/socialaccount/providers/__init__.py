@@ -1,11 +1,17 @@
+import threading
+import uuid
+
 from allauth_api.settings import allauth_api_settings
 from importlib import import_module
 
+VERSION_CACHE_KEY = 'allauth_api:providers_version'
+
 
 class ProviderRegistry(object):
     def __init__(self):
         self.provider_map = {}
         self.loaded = False
+        self.lock = threading.RLock()
 
     def get_list(self):
         self.load()
@@ -24,7 +30,11 @@ class ProviderRegistry(object):
             yield (provider.id, provider.name)
 
     def load(self):
-        if not self.loaded:
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
             for app in allauth_api_settings.PROVIDER_MODULES:
                 provider_module = app + '.provider'
                 try:
@@ -33,5 +43,23 @@ class ProviderRegistry(object):
                     pass
             self.loaded = True
 
+    def get_version(self):
+        """
+        Returns the version of the provider configuration.  It's kept in the cache named by
+        CACHE_ALIAS, so that a change (e.g. to a SocialApp) made by any process is seen by all of
+        them; it's a random value, not a counter, so a cleared cache can't bring an old one back
+        """
+        from allauth_api.account.verification import get_cache
+        cache = get_cache()
+        version = cache.get(VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+            version = cache.get(VERSION_CACHE_KEY)
+        return version
+
+    def configuration_changed(self):
+        from allauth_api.account.verification import get_cache
+        get_cache().set(VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
 
 registry = ProviderRegistry()
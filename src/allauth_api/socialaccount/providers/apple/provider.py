@@ -0,0 +1,16 @@
+from allauth_api.socialaccount.providers import registry
+from allauth_api.socialaccount.providers.oidc import OIDCProvider
+
+
+class AppleProvider(OIDCProvider):
+    """
+    Verifies the ID tokens of Sign in with Apple.  The SocialApp's client_id is the Services ID,
+    add the bundle ids of the native apps to the AUDIENCES of the 'apple' PROVIDER_SETTINGS
+    """
+    id = 'apple'
+    name = 'Apple'
+    issuer = 'https://appleid.apple.com'
+    jwks_url = 'https://appleid.apple.com/auth/keys'
+
+
+registry.register(AppleProvider)
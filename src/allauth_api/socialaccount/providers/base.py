@@ -1,5 +1,216 @@
+"""
+Base class for the social providers that SocialAuthentication hands logins to.
 
+A provider checks the access token sent by the client with the provider's API, and resolves it to
+the provider's uid for the user (and their profile), then to the user connected to that uid.  The
+resolved identity is cached by a hash of the token for SOCIAL_TOKEN_CACHE_TIMEOUT seconds, or until
+the token expires if that comes first, so retried logins and logins from several tabs don't call
+the provider again.  Concurrent verifications of the same token in a process share one call.
+Failed verifications are not cached.
 
-class Provider(object):
-    # TODO
+A uid that isn't connected to any user raises SignupRequired with a pending social login built from
+the profile, for the client to complete with the social RegisterView.
+"""
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_bytes
+from django.utils.translation import ugettext as _
+
+from rest_framework import status
+from rest_framework.exceptions import APIException, AuthenticationFailed
+
+from allauth.account.models import EmailAddress
+from allauth.socialaccount.adapter import get_adapter
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialLogin
+
+from allauth_api.account.verification import get_cache
+from allauth_api.settings import allauth_api_settings
+from allauth_api.socialaccount.signup import SignupRequired
+
+import logging
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_KEY_TEMPLATE = "allauth_api:social_token:%s:%s"
+
+
+class ProviderIdentity(namedtuple('ProviderIdentity', ['uid', 'profile', 'expires_at'])):
+    """
+    A verified access token: the provider's uid for the user, the profile data the provider
+    returned and the time (a timestamp) the token expires at, if known
+    """
+    __slots__ = ()
+
+
+class InvalidToken(Exception):
+    """
+    Raised when the credentials sent by the client (e.g. an access token) are rejected
+    """
     pass
+
+
+class ProviderUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The authentication provider could not be reached.'
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs a function once for all the threads asking for the same key at the same time: the first
+    thread calls it, the others wait for its result (or exception)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def run(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+
+_verifications = SingleFlight()
+
+
+def get_token_cache_key(provider_id, token):
+    return TOKEN_CACHE_KEY_TEMPLATE % (provider_id, hashlib.sha256(force_bytes(token)).hexdigest())
+
+
+class Provider(object):
+    """
+    Base class for a provider.  Subclasses set id and name and implement fetch_identity().  A
+    single instance of each provider serves every request, so providers must not keep per-request
+    state
+    """
+    id = None
+    name = None
+    token_parameter = 'access_token'
+
+    def authenticate(self, request):
+        try:
+            identity = self.get_identity(request)
+        except InvalidToken as e:
+            raise AuthenticationFailed(str(e) or _("Invalid access token"))
+        return (self.get_user(request, identity), None)
+
+    def get_identity(self, request):
+        """
+        Returns the ProviderIdentity of the credentials sent with the request
+        """
+        token = self.get_access_token(request)
+        if not token:
+            raise AuthenticationFailed("%s %s" % (self.token_parameter, _("parameter must be provided")))
+        return self.verify_token(request, token)
+
+    def get_access_token(self, request):
+        return request.data.get(self.token_parameter)
+
+    def verify_token(self, request, token):
+        """
+        Returns the ProviderIdentity of an access token, from the cache if it was verified recently
+        """
+        cache = get_cache()
+        key = get_token_cache_key(self.id, token)
+        cached = cache.get(key)
+        if cached is not None:
+            return ProviderIdentity(*cached)
+
+        def verify():
+            identity = self.fetch_identity(request, token)
+            timeout = self.get_cache_timeout(identity)
+            if timeout > 0:
+                cache.set(key, tuple(identity), timeout)
+            return identity
+
+        return _verifications.run(key, verify)
+
+    def get_cache_timeout(self, identity):
+        timeout = allauth_api_settings.SOCIAL_TOKEN_CACHE_TIMEOUT
+        if identity.expires_at:
+            timeout = min(timeout, int(identity.expires_at - time.time()))
+        return timeout
+
+    def fetch_identity(self, request, token):
+        """
+        Verifies the token with the provider and returns its ProviderIdentity.  Raises InvalidToken
+        if the provider rejects the token, and ProviderUnavailable if it can't be reached
+        """
+        raise NotImplementedError
+
+    def get_user(self, request, identity):
+        try:
+            account = SocialAccount.objects.select_related('user').get(provider=self.id, uid=identity.uid)
+        except SocialAccount.DoesNotExist:
+            raise SignupRequired(self.get_sociallogin(request, identity))
+        return account.user
+
+    def get_sociallogin(self, request, identity):
+        """
+        Returns an unsaved SocialLogin for the identity, with the user suggested by the profile
+        """
+        adapter = get_adapter(request)
+        account = SocialAccount(provider=self.id, uid=identity.uid, extra_data=identity.profile)
+        sociallogin = SocialLogin(account=account, email_addresses=self.get_email_addresses(identity))
+        sociallogin.user = adapter.new_user(request, sociallogin)
+        adapter.populate_user(request, sociallogin, self.extract_common_fields(identity))
+        return sociallogin
+
+    def extract_common_fields(self, identity):
+        profile = identity.profile
+        return {
+            'email': profile.get('email'),
+            'name': profile.get('name'),
+            'first_name': profile.get('first_name') or profile.get('given_name'),
+            'last_name': profile.get('last_name') or profile.get('family_name'),
+        }
+
+    def get_email_addresses(self, identity):
+        email = identity.profile.get('email')
+        if not email:
+            return []
+        return [EmailAddress(email=email, verified=self.is_email_verified(identity), primary=True)]
+
+    def is_email_verified(self, identity):
+        return identity.profile.get('email_verified') in (True, 'true')
+
+    def get_app(self, request):
+        try:
+            return SocialApp.objects.get_current(self.id, request)
+        except SocialApp.DoesNotExist:
+            raise ImproperlyConfigured("No SocialApp is configured for the %s provider" % self.id)
+
+    def get_settings(self):
+        """
+        The PROVIDER_SETTINGS of this provider
+        """
+        return allauth_api_settings.PROVIDER_SETTINGS.get(self.id, {})
@@ -1,9 +1,167 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+import requests
+
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes, force_text
+from django.utils.translation import ugettext as _
+
+from rest_framework.exceptions import AuthenticationFailed
+
+from allauth_api.socialaccount import http
 from allauth_api.socialaccount.providers import registry
-from allauth_api.socialaccount.providers.base import Provider
+from allauth_api.socialaccount.providers.base import Provider, ProviderIdentity, InvalidToken, ProviderUnavailable
+from allauth_api.socialaccount.signup import SignupRequired
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def b64decode(data):
+    data = force_bytes(data)
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def parse_signed_request(signed_request, secret, max_age=None):
+    """
+    Verifies a Facebook signed_request (a base64url HMAC-SHA256 signature of the base64url JSON
+    payload, with the app secret, joined by a '.') and returns its payload.  Raises InvalidToken if it
+    is malformed, isn't signed with secret or was issued more than max_age seconds ago
+    """
+    try:
+        encoded_signature, encoded_payload = force_text(signed_request).split('.', 1)
+        signature = b64decode(encoded_signature)
+        payload = json.loads(force_text(b64decode(encoded_payload)))
+    except (ValueError, TypeError):
+        raise InvalidToken("Malformed signed_request")
+    if not isinstance(payload, dict) or str(payload.get('algorithm', '')).upper() != 'HMAC-SHA256':
+        raise InvalidToken("Unsupported signed_request algorithm")
+
+    expected = hmac.new(force_bytes(secret), force_bytes(encoded_payload), hashlib.sha256).digest()
+    if not constant_time_compare(signature, expected):
+        raise InvalidToken("Invalid signed_request signature")
+    issued_at = payload.get('issued_at')
+    if max_age is not None and (not isinstance(issued_at, (int, float)) or time.time() - issued_at > max_age):
+        raise InvalidToken("Expired signed_request")
+    return payload
 
 
 class FacebookProvider(Provider):
+    """
+    Verifies Facebook user access tokens with the Graph API: the token is inspected with the app's
+    credentials (it must have been issued to this app) before the user's profile is read.  The API
+    can be pointed elsewhere with the GRAPH_URL of the 'facebook' PROVIDER_SETTINGS.  The token check,
+    the profile (with the email) and the picture are fetched at the same time.
+
+    When the client sends the signed_request of the Facebook login instead (or as well), it's verified
+    locally with the app secret and no Graph API call is made.  A signed_request can be replayed until
+    it's SIGNED_REQUEST_MAX_AGE seconds old (300 by default); if it's rejected and an access token was
+    sent too, the token is checked with the Graph API.
+
+    A signed_request only carries the uid, not the profile a signup needs (email, name).  For a uid
+    that isn't connected to a user yet, the access token must be sent too: the profile is fetched
+    with it and the client gets the usual signup_required response.  Without one the login is
+    rejected
+    """
     id = 'facebook'
+    name = 'Facebook'
+    graph_url = 'https://graph.facebook.com'
+    profile_fields = ['id', 'email', 'name', 'first_name', 'last_name']
+    signed_request_parameter = 'signed_request'
+    signed_request_max_age = 300
+
+    def get_graph_url(self):
+        return self.get_settings().get('GRAPH_URL', self.graph_url).rstrip('/')
+
+    def get_identity(self, request):
+        signed_request = request.data.get(self.signed_request_parameter)
+        if signed_request:
+            try:
+                return self.verify_signed_request(request, signed_request)
+            except InvalidToken as e:
+                if not self.get_access_token(request):
+                    raise
+                logger.debug("Checking the access token, the signed_request was rejected: %s", e)
+        return super(FacebookProvider, self).get_identity(request)
+
+    def verify_signed_request(self, request, signed_request):
+        max_age = self.get_settings().get('SIGNED_REQUEST_MAX_AGE', self.signed_request_max_age)
+        payload = parse_signed_request(signed_request, self.get_app(request).secret, max_age)
+        if not payload.get('user_id'):
+            # The user hasn't authorized the app
+            raise InvalidToken("The signed_request has no user")
+        return ProviderIdentity(str(payload['user_id']), {}, payload.get('expires') or None)
+
+    def get_user(self, request, identity):
+        try:
+            return super(FacebookProvider, self).get_user(request, identity)
+        except SignupRequired:
+            if identity.profile:
+                raise
+        # Verified from a signed_request, get the profile to sign up with from the Graph API
+        token = self.get_access_token(request)
+        if not token:
+            raise AuthenticationFailed(_("A signed_request can only log in a connected account, "
+                                         "send the access_token to sign up"))
+        try:
+            profile_identity = self.verify_token(request, token)
+        except InvalidToken as e:
+            raise AuthenticationFailed(str(e) or _("Invalid access token"))
+        if profile_identity.uid != identity.uid:
+            raise AuthenticationFailed(_("The signed_request and the access_token are of different users"))
+        raise SignupRequired(self.get_sociallogin(request, profile_identity))
+
+    def graph_get(self, path, **params):
+        try:
+            response = http.get(self.id, self.get_graph_url() + path, params=params)
+        except requests.RequestException as e:
+            logger.warning("Facebook Graph API request failed: %s", e)
+            raise ProviderUnavailable()
+        if response.status_code >= 500:
+            logger.warning("Facebook Graph API responded %d", response.status_code)
+            raise ProviderUnavailable()
+        try:
+            data = response.json()
+        except ValueError:
+            raise ProviderUnavailable()
+        if 'error' in data:
+            raise InvalidToken(data['error'].get('message', "Invalid Facebook access token"))
+        return data
+
+    def get_appsecret_proof(self, app, token):
+        return hmac.new(force_bytes(app.secret), force_bytes(token), hashlib.sha256).hexdigest()
+
+    def fetch_identity(self, request, token):
+        app = self.get_app(request)
+        proof = self.get_appsecret_proof(app, token)
+        debug, profile, picture = http.run_concurrently(
+            lambda: self.graph_get('/debug_token', input_token=token,
+                                   access_token='%s|%s' % (app.client_id, app.secret)).get('data', {}),
+            lambda: self.graph_get('/me', access_token=token, appsecret_proof=proof,
+                                   fields=','.join(self.profile_fields)),
+            lambda: self.get_picture(token, proof))
+        if not debug.get('is_valid') or str(debug.get('app_id')) != str(app.client_id):
+            raise InvalidToken("Invalid Facebook access token")
+
+        if picture:
+            profile['picture'] = picture
+        uid = str(debug.get('user_id') or profile.get('id'))
+        # Facebook reports tokens that don't expire with an expires_at of 0
+        return ProviderIdentity(uid, profile, debug.get('expires_at') or None)
+
+    def get_picture(self, token, proof):
+        """
+        Returns the URL of the user's picture, or None.  Not getting one doesn't fail the login
+        """
+        try:
+            return self.graph_get('/me/picture', access_token=token, appsecret_proof=proof, type='large',
+                                  redirect='false').get('data', {}).get('url')
+        except (InvalidToken, ProviderUnavailable):
+            return None
 
 
 registry.register(FacebookProvider)
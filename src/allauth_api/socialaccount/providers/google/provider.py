@@ -0,0 +1,16 @@
+from allauth_api.socialaccount.providers import registry
+from allauth_api.socialaccount.providers.oidc import OIDCProvider
+
+
+class GoogleProvider(OIDCProvider):
+    """
+    Verifies the ID tokens of Google Sign-In.  Add the client ids of the Android and iOS apps to
+    the AUDIENCES of the 'google' PROVIDER_SETTINGS
+    """
+    id = 'google'
+    name = 'Google'
+    issuer = ('https://accounts.google.com', 'accounts.google.com')
+    jwks_url = 'https://www.googleapis.com/oauth2/v3/certs'
+
+
+registry.register(GoogleProvider)
@@ -0,0 +1,265 @@
+"""
+Base class for OpenID Connect providers (Google, Apple, Microsoft and the like).
+
+Clients send the ID token they got from the provider's login as id_token.  It's a JWT signed with
+one of the provider's published keys (its JWKS), so it's verified locally: the RS256 signature (or
+RS384, RS512) with the key named by the token's kid, then the issuer, the audience (the client_id of
+the SocialApp, plus any AUDIENCES in the provider's PROVIDER_SETTINGS, e.g. the ids of the mobile
+apps) and the expiry, allowing OIDC_LEEWAY seconds of clock skew.  No HTTP call is made per login.
+
+The provider's keys are fetched once per process and kept for the max-age of the JWKS response, or
+OIDC_JWKS_MAX_AGE seconds if it has none.  They're refreshed in the background when 90% of that has
+passed, and kept if the refresh fails.  A token signed with a key that isn't known yet (the provider
+rotated its keys) triggers a refetch, at most once every OIDC_JWKS_REFETCH_INTERVAL seconds, so
+tokens with made up kids can't make every login call the provider.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import re
+import threading
+import time
+
+import requests
+
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes, force_text
+
+from allauth_api.settings import allauth_api_settings
+from allauth_api.socialaccount import http
+
+from .base import Provider, ProviderIdentity, InvalidToken, ProviderUnavailable
+
+import logging
+logger = logging.getLogger(__name__)
+
+# alg -> (hash, DER encoded DigestInfo prefix of the EMSA-PKCS1-v1_5 encoding)
+RSA_ALGORITHMS = {
+    'RS256': ('sha256', binascii.unhexlify('3031300d060960864801650304020105000420')),
+    'RS384': ('sha384', binascii.unhexlify('3041300d060960864801650304020205000430')),
+    'RS512': ('sha512', binascii.unhexlify('3051300d060960864801650304020305000440')),
+}
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+_key_sets = {}
+_key_sets_lock = threading.Lock()
+
+
+def b64decode(data):
+    data = force_bytes(data)
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def b64decode_int(data):
+    return int(binascii.hexlify(b64decode(data)), 16)
+
+
+def decode_jwt(token):
+    """
+    Returns the header, claims, signing input and signature of a JWT, without verifying it
+    """
+    try:
+        encoded_header, encoded_claims, encoded_signature = force_text(token).split('.')
+        header = json.loads(force_text(b64decode(encoded_header)))
+        claims = json.loads(force_text(b64decode(encoded_claims)))
+        signature = b64decode(encoded_signature)
+    except (ValueError, TypeError):
+        raise InvalidToken("Malformed ID token")
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise InvalidToken("Malformed ID token")
+    return header, claims, force_bytes(encoded_header + '.' + encoded_claims), signature
+
+
+class RSAPublicKey(object):
+
+    def __init__(self, n, e):
+        self.n = n
+        self.e = e
+        self.size = (n.bit_length() + 7) // 8
+
+    @classmethod
+    def from_jwk(cls, jwk):
+        return cls(b64decode_int(jwk['n']), b64decode_int(jwk['e']))
+
+    def verify(self, message, signature, algorithm):
+        """
+        Returns True if signature is the RSASSA-PKCS1-v1_5 signature of message with algorithm (RS256,
+        RS384 or RS512) by the private key
+        """
+        hash_name, prefix = RSA_ALGORITHMS[algorithm]
+        if len(signature) != self.size:
+            return False
+        s = int(binascii.hexlify(signature), 16)
+        if s >= self.n:
+            return False
+        encoded = binascii.unhexlify('%0*x' % (self.size * 2, pow(s, self.e, self.n)))
+        digest_info = prefix + hashlib.new(hash_name, message).digest()
+        expected = b'\x00\x01' + b'\xff' * (self.size - len(digest_info) - 3) + b'\x00' + digest_info
+        return constant_time_compare(encoded, expected)
+
+
+class KeySet(object):
+    """
+    The cached signing keys of a provider, fetched from its JWKS url (see above)
+    """
+
+    def __init__(self, provider_id, url):
+        self.provider_id = provider_id
+        self.url = url
+        self.keys = {}
+        self.fetched_at = None
+        self.refresh_at = None
+        self.expires_at = None
+        self.last_attempt = None
+        self.refresh_thread = None
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+
+    def get_key(self, kid):
+        now = time.time()
+        if self.fetched_at is None or now >= self.expires_at:
+            self.refresh(self.fetched_at)
+        elif now >= self.refresh_at:
+            self.refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None and self.can_refetch():
+            logger.info("Refetching the %s keys for unknown key id %s", self.provider_id, kid)
+            self.refresh(self.fetched_at)
+            key = self.keys.get(kid)
+        return key
+
+    def can_refetch(self):
+        return time.time() - (self.last_attempt or 0) >= allauth_api_settings.OIDC_JWKS_REFETCH_INTERVAL
+
+    def refresh(self, seen_fetched_at=None):
+        """
+        Fetches the keys, unless another thread fetched them since seen_fetched_at
+        """
+        with self.fetch_lock:
+            if self.fetched_at != seen_fetched_at:
+                return
+            self.last_attempt = time.time()
+            try:
+                keys, max_age = self.fetch()
+            except ProviderUnavailable:
+                if not self.keys:
+                    raise
+                logger.warning("Failed to refresh the %s keys, keeping the current ones", self.provider_id)
+                return
+            now = time.time()
+            with self.lock:
+                self.keys = keys
+                self.fetched_at = now
+                self.refresh_at = now + max_age * 0.9
+                self.expires_at = now + max_age
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refresh_thread is not None and self.refresh_thread.is_alive():
+                return
+            self.refresh_thread = threading.Thread(target=self.background_refresh, args=(self.fetched_at,))
+            self.refresh_thread.daemon = True
+            self.refresh_thread.start()
+
+    def background_refresh(self, seen_fetched_at):
+        try:
+            self.refresh(seen_fetched_at)
+        except Exception:
+            logger.exception("Failed to refresh the %s keys", self.provider_id)
+
+    def fetch(self):
+        try:
+            response = http.get(self.provider_id, self.url)
+            response.raise_for_status()
+            jwks = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("Failed to fetch the %s keys from %s: %s", self.provider_id, self.url, e)
+            raise ProviderUnavailable()
+
+        keys = {}
+        for jwk in jwks.get('keys', []):
+            if jwk.get('kty') != 'RSA' or jwk.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[jwk.get('kid')] = RSAPublicKey.from_jwk(jwk)
+            except (KeyError, ValueError, TypeError):
+                logger.warning("Skipping malformed %s key %s", self.provider_id, jwk.get('kid'))
+        match = MAX_AGE_RE.search(response.headers.get('Cache-Control', ''))
+        max_age = int(match.group(1)) if match else allauth_api_settings.OIDC_JWKS_MAX_AGE
+        return keys, max_age
+
+
+def get_key_set(provider_id, url):
+    key_set = _key_sets.get(url)
+    if key_set is None:
+        with _key_sets_lock:
+            key_set = _key_sets.get(url)
+            if key_set is None:
+                key_set = _key_sets[url] = KeySet(provider_id, url)
+    return key_set
+
+
+def reset():
+    """
+    Forgets the cached keys of every provider
+    """
+    with _key_sets_lock:
+        _key_sets.clear()
+
+
+class OIDCProvider(Provider):
+    """
+    Base class for OpenID Connect providers.  Subclasses set issuer (one issuer or a tuple of
+    them) and jwks_url, which can be overridden with the ISSUER and JWKS_URL of the provider's
+    PROVIDER_SETTINGS
+    """
+    token_parameter = 'id_token'
+    issuer = None
+    jwks_url = None
+    algorithms = ('RS256',)
+
+    def get_issuers(self):
+        issuer = self.get_settings().get('ISSUER', self.issuer)
+        return (issuer,) if isinstance(issuer, str) else tuple(issuer)
+
+    def get_jwks_url(self):
+        return self.get_settings().get('JWKS_URL', self.jwks_url)
+
+    def get_audiences(self, request):
+        return [self.get_app(request).client_id] + list(self.get_settings().get('AUDIENCES', []))
+
+    def verify_token(self, request, token):
+        # Verified locally, there's nothing worth caching
+        header, claims, signing_input, signature = decode_jwt(token)
+        algorithm = header.get('alg')
+        if algorithm not in self.algorithms or algorithm not in RSA_ALGORITHMS:
+            raise InvalidToken("Unsupported ID token algorithm")
+        key = get_key_set(self.id, self.get_jwks_url()).get_key(header.get('kid'))
+        if key is None:
+            raise InvalidToken("Unknown ID token signing key")
+        if not key.verify(signing_input, signature, algorithm):
+            raise InvalidToken("Invalid ID token signature")
+        self.validate_claims(request, claims)
+        return ProviderIdentity(str(claims['sub']), claims, claims['exp'])
+
+    def validate_claims(self, request, claims):
+        now = time.time()
+        leeway = allauth_api_settings.OIDC_LEEWAY
+        if claims.get('iss') not in self.get_issuers():
+            raise InvalidToken("Invalid ID token issuer")
+        audiences = claims.get('aud')
+        if not isinstance(audiences, list):
+            audiences = [audiences]
+        if not set(audiences).intersection(self.get_audiences(request)):
+            raise InvalidToken("Invalid ID token audience")
+        exp = claims.get('exp')
+        if not isinstance(exp, (int, float)) or exp < now - leeway:
+            raise InvalidToken("Expired ID token")
+        iat = claims.get('iat')
+        if isinstance(iat, (int, float)) and iat > now + leeway:
+            raise InvalidToken("ID token issued in the future")
+        if not claims.get('sub'):
+            raise InvalidToken("The ID token has no subject")
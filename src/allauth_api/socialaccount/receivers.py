@@ -0,0 +1,17 @@
+"""
+Tracks changes to the social app configuration, so that what is derived from it (e.g. the cached
+providers list) can be refreshed by every process
+"""
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from allauth.socialaccount.models import SocialApp
+
+from allauth_api.socialaccount.providers import registry
+
+
+@receiver(post_save, sender=SocialApp)
+@receiver(post_delete, sender=SocialApp)
+@receiver(m2m_changed, sender=SocialApp.sites.through)
+def social_app_changed(sender, **kwargs):
+    registry.configuration_changed()
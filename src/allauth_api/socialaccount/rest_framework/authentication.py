@@ -2,9 +2,12 @@ from django.utils.translation import ugettext as _
 
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.response import Response
+from rest_framework.status import HTTP_401_UNAUTHORIZED
 
 from allauth_api.account.rest_framework import authentication as account_auth
 from allauth_api.settings import allauth_api_settings
+from allauth_api.socialaccount import signup
 from allauth_api.socialaccount.providers import registry
 
 
@@ -15,22 +18,37 @@ class SocialAuthentication(BaseAuthentication):
     """
 
     def authenticate(self, request):
-        provider_id = request.DATA.get(allauth_api_settings.PROVIDER_PARAMETER_NAME)
+        provider_id = request.data.get(allauth_api_settings.PROVIDER_PARAMETER_NAME)
 
         if provider_id:
-            provider = registry.by_id(provider_id)
-            if provider:
-                return provider.authneticate(request)
-            else:
+            try:
+                provider = registry.by_id(provider_id)
+            except KeyError:
                 msg = "%s %s" % (_("no provider found for"), provider_id)
                 raise AuthenticationFailed(msg)
+            return provider.authenticate(request)
         else:
             msg = "%s %s" % (allauth_api_settings.PROVIDER_PARAMETER_NAME,
                              _("parameter must be provided"))
             raise AuthenticationFailed(msg)
 
 
-class BasicLogin(account_auth.BasicLogin):
+class SocialLoginMixin(object):
+    """
+    Answers social logins that aren't connected to an account yet with a 401 and signup_required,
+    plus the signup_token to register with if SOCIAL_SIGNUP_STATE is 'token'
+    """
+
+    def login(self, request, *args, **kwargs):
+        try:
+            return super(SocialLoginMixin, self).login(request, *args, **kwargs)
+        except signup.SignupRequired as e:
+            data = {'detail': _("Signup required"), 'signup_required': True}
+            data.update(signup.save_pending(request, e.sociallogin))
+            return Response(data, HTTP_401_UNAUTHORIZED)
+
+
+class BasicLogin(SocialLoginMixin, account_auth.BasicLogin):
     """
     A login class that just uses the standard Django authenticate mechanism
     """
@@ -38,7 +56,7 @@ class BasicLogin(account_auth.BasicLogin):
     auth_class = SocialAuthentication
 
 
-class TokenLogin(account_auth.TokenLogin):
+class TokenLogin(SocialLoginMixin, account_auth.TokenLogin):
     """
     A login class that returns a user authentication token.  This method, in its default
     configuration is only available if rest_framework.authtoken is in installed_apps
@@ -47,6 +65,22 @@ class TokenLogin(account_auth.TokenLogin):
     auth_class = SocialAuthentication
 
 
+class DeviceTokenLogin(SocialLoginMixin, account_auth.DeviceTokenLogin):
+    """
+    A login class that returns a new authentication token for each device the user logs in from
+    """
+
+    auth_class = SocialAuthentication
+
+
+class SignedTokenLogin(SocialLoginMixin, account_auth.SignedTokenLogin):
+    """
+    A login class that returns a stateless signed authentication token
+    """
+
+    auth_class = SocialAuthentication
+
+
 # class OAuth2Login(account_auth.OAuth2Login):
 #     """
 #     A login class that accepts oauth2 authentication requests and returns the appropriate
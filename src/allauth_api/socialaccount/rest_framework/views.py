@@ -1,24 +1,41 @@
+import hashlib
+from collections import namedtuple
+
+from django.core import signing
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.translation import ugettext as _
+
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from allauth.socialaccount import providers
 from allauth.socialaccount.adapter import get_adapter
 
+from allauth_api.account.rest_framework import utils
 from allauth_api.account.rest_framework.views import CloseableSignupMixin
 from .serializers import ProviderSerializer
-from allauth import app_settings
+from allauth.account import app_settings as account_settings
+from allauth.socialaccount import app_settings
 from allauth.utils import get_form_class
-from allauth.socialaccount.models import SocialLogin
+from allauth.socialaccount.models import SocialAccount
 from allauth.socialaccount.forms import SignupForm
-from allauth.socialaccount.helpers import complete_social_signup
-from rest_framework.status import HTTP_400_BAD_REQUEST
+from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_304_NOT_MODIFIED
 from allauth_api.settings import allauth_api_settings
+from allauth_api.instrumentation import QueryBudgetMixin
+from allauth_api.socialaccount import signup
+from allauth_api.socialaccount.providers import registry as api_registry
 
 APIView = allauth_api_settings.DRF_API_VIEW
 
 
-class RegisterView(CloseableSignupMixin, APIView):
+class RegisterView(QueryBudgetMixin, CloseableSignupMixin, APIView):
     """
-    Register users who use 3rd-party authentication (e.g. Facebook, Google, Twitter, etc.)
+    Register users who use 3rd-party authentication (e.g. Facebook, Google, Twitter, etc.).  The
+    pending social login comes from the session, or from the signup_token sent with the form if
+    SOCIAL_SIGNUP_STATE is 'token' (see allauth_api.socialaccount.signup)
     """
 
     permission_classes = allauth_api_settings.DRF_REGISTER_VIEW_PERMISSIONS
@@ -27,19 +44,38 @@ class RegisterView(CloseableSignupMixin, APIView):
     def get_form_class(self):
         return get_form_class(app_settings.FORMS, 'signup', self.form_class)
 
-    def dispatch(self, request, *args, **kwargs):
-        self.sociallogin = None
-        data = request.session.get('socialaccount_sociallogin')
-        if data:
-            self.sociallogin = SocialLogin.deserialize(data)
-        return super(RegisterView, self).dispatch(request, *args, **kwargs)
+    def initial(self, request, *args, **kwargs):
+        # Loaded before CloseableSignupMixin calls is_open(), which is given the sociallogin
+        try:
+            self.sociallogin = signup.get_pending(request)
+        except signing.BadSignature:
+            raise ParseError(_("Invalid or expired signup token"))
+        super(RegisterView, self).initial(request, *args, **kwargs)
 
     def post(self, request, format=None):
+        if self.sociallogin is None:
+            return Response({"detail": _("No social login is pending signup")}, HTTP_400_BAD_REQUEST)
+        account = self.sociallogin.account
+        if SocialAccount.objects.filter(provider=account.provider, uid=account.uid).exists():
+            # e.g. a signup token used twice
+            return Response({"detail": _("The social account is already connected")}, HTTP_400_BAD_REQUEST)
+
         fc = self.get_form_class()
-        form = fc(data=request.DATA, files=request.FILES, sociallogin=self.sociallogin)
+        form = fc(data=request.data, sociallogin=self.sociallogin)
         if form.is_valid():
-            user = form.save(request)
-            return complete_social_signup(self.request, user, app_settings.EMAIL_VERIFICATION)
+            try:
+                with transaction.atomic():
+                    user = form.save(request)
+            except IntegrityError as e:
+                # e.g. a username differing only by case, or registered by another process the
+                # identifier filter hadn't seen yet
+                errors = utils.identifier_taken_errors(e)
+                if errors is None:
+                    raise
+                return Response(errors, HTTP_400_BAD_REQUEST)
+            signup.clear_pending(request)
+            return utils.complete_signup(request, user, account_settings.EMAIL_VERIFICATION,
+                                         signal_kwargs={'sociallogin': self.sociallogin})
         return Response(form.errors, HTTP_400_BAD_REQUEST)
 
     def is_open(self):
@@ -50,17 +86,60 @@ class RegisterView(CloseableSignupMixin, APIView):
 register = RegisterView.as_view()
 
 
-class ProviderListView(APIView):
+RenderedProviders = namedtuple('RenderedProviders', ['registry', 'version', 'data', 'body', 'etag'])
+
+
+def etag_matches(header, etag):
     """
-    List the social account providers available
+    Returns True if an If-None-Match header lists the (strong) etag
+    """
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+
+class ProviderListView(QueryBudgetMixin, APIView):
+    """
+    List the social account providers available.  The list only changes with the provider
+    configuration, so each process serializes and renders it once per configuration version (kept in
+    the shared cache, see ProviderRegistry.get_version) and serves it with an ETag and a
+    Cache-Control max age of PROVIDERS_CACHE_MAX_AGE seconds; requests with a matching
+    If-None-Match get a 304
     """
 
     permission_classes = allauth_api_settings.DRF_PROVIDERS_VIEW_PERMISSIONS
+    query_budget = 0
+
+    _rendered = None
 
     def get(self, request, format=None):
-        p = providers.registry.get_list()
-        serializer = ProviderSerializer(p, many=True)
-        return Response(serializer.data)
+        rendered = self.get_rendered()
+        if etag_matches(request.META.get('HTTP_IF_NONE_MATCH', ''), rendered.etag):
+            response = Response(None, HTTP_304_NOT_MODIFIED)
+        elif isinstance(request.accepted_renderer, JSONRenderer) and request.accepted_media_type == JSONRenderer.media_type:
+            response = HttpResponse(rendered.body, content_type=JSONRenderer.media_type)
+        else:
+            response = Response(rendered.data)
+        response['ETag'] = rendered.etag
+        response['Cache-Control'] = 'max-age=%d' % allauth_api_settings.PROVIDERS_CACHE_MAX_AGE
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    def get_rendered(self):
+        # The registry is looked up every time since it can be replaced
+        registry = providers.registry
+        version = api_registry.get_version()
+        rendered = ProviderListView._rendered
+        if rendered is None or rendered.registry is not registry or rendered.version != version:
+            data = ProviderSerializer(registry.get_list(), many=True).data
+            body = JSONRenderer().render(data)
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            rendered = ProviderListView._rendered = RenderedProviders(registry, version, data, body, etag)
+        return rendered
 
 
 list_providers = ProviderListView.as_view()
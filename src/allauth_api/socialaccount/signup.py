@@ -0,0 +1,74 @@
+"""
+Pending social signups.
+
+A social login that isn't connected to an account yet has to sign up first: the pending social
+login (the provider account and the suggested user and email addresses) is kept until the client
+posts the signup form to the social RegisterView.  With SOCIAL_SIGNUP_STATE = 'session' (the
+default) it's stored in the session, as allauth does.  With 'token' nothing is stored: the login
+response hands it to the client as a signed, compressed signup_token that the client sends back
+with the signup form, within SOCIAL_SIGNUP_TOKEN_MAX_AGE seconds.  The token is signed, not
+encrypted, the client can read the profile data in it.
+"""
+from django.core import signing
+
+from allauth.socialaccount.models import SocialLogin
+
+from allauth_api.settings import allauth_api_settings
+
+SESSION_KEY = 'socialaccount_sociallogin'
+TOKEN_SALT = 'allauth_api.socialaccount.signup'
+TOKEN_PARAMETER = 'signup_token'
+
+
+class SignupRequired(Exception):
+    """
+    Raised by a provider when the social login isn't connected to any account
+    """
+
+    def __init__(self, sociallogin):
+        super(SignupRequired, self).__init__("Signup required")
+        self.sociallogin = sociallogin
+
+
+def uses_token():
+    return allauth_api_settings.SOCIAL_SIGNUP_STATE == 'token'
+
+
+def dumps(sociallogin):
+    return signing.dumps(sociallogin.serialize(), salt=TOKEN_SALT, compress=True)
+
+
+def loads(token):
+    """
+    Returns the SocialLogin of a signup token.  Raises signing.BadSignature if it's invalid or
+    expired
+    """
+    data = signing.loads(token, salt=TOKEN_SALT, max_age=allauth_api_settings.SOCIAL_SIGNUP_TOKEN_MAX_AGE)
+    return SocialLogin.deserialize(data)
+
+
+def save_pending(request, sociallogin):
+    """
+    Keeps the social login until signup.  Returns the data to add to the login response
+    """
+    if uses_token():
+        return {TOKEN_PARAMETER: dumps(sociallogin)}
+    request.session[SESSION_KEY] = sociallogin.serialize()
+    return {}
+
+
+def get_pending(request):
+    """
+    Returns the pending SocialLogin of the request, or None.  Raises signing.BadSignature for an
+    invalid signup token
+    """
+    if uses_token():
+        token = request.data.get(TOKEN_PARAMETER)
+        return loads(token) if token else None
+    data = request.session.get(SESSION_KEY)
+    return SocialLogin.deserialize(data) if data else None
+
+
+def clear_pending(request):
+    if not uses_token():
+        request.session.pop(SESSION_KEY, None)
@@ -0,0 +1,290 @@
+"""
+Endpoint benchmarks.
+
+Not collected with the regular tests, run them explicitly (or with `tox -e bench`):
+
+    py.test tests/bench_endpoints.py -s
+
+Every account and social endpoint is driven through the test client, with the test settings from
+conftest.py (sqlite in memory), for BENCHMARK_ITERATIONS iterations (30 by default).  Latency
+percentiles, database query counts and, where tracemalloc is available, allocations are recorded for
+each endpoint, along with the time a fresh interpreter takes to import the API (a cold start), and
+written as JSON to BENCHMARK_OUTPUT (benchmark-results.json by default).  If BENCHMARK_BASELINE names
+the results of a previous run, a comparison is printed as well.
+"""
+from __future__ import absolute_import, print_function
+import base64
+import json
+import os
+import platform
+import time
+
+import django
+import rest_framework
+from django.contrib.auth.models import User
+from django.core import mail
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from allauth.account.forms import default_token_generator
+from allauth.account.models import EmailAddress, EmailConfirmationHMAC
+from allauth.account.utils import user_pk_to_url_str
+
+from allauth_api.account import throttling
+from allauth_api.account.verification import get_cache
+
+from tests.test_imports import import_api
+from tests.utils import override_api_settings
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from oauth2_provider.models import get_application_model
+except ImportError:
+    get_application_model = None
+
+ITERATIONS = int(os.environ.get('BENCHMARK_ITERATIONS', 30))
+ALLOCATION_ITERATIONS = min(ITERATIONS, 5)
+OUTPUT = os.environ.get('BENCHMARK_OUTPUT', 'benchmark-results.json')
+BASELINE = os.environ.get('BENCHMARK_BASELINE')
+
+PASSWORD = "benchpassword"
+LOGIN_TYPES = ['basic', 'session', 'token', 'device_token', 'signed_token']
+
+results = {}
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    index = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(timings, query_counts, allocations):
+    timings = sorted(t * 1000 for t in timings)
+    summary = {
+        'iterations': len(timings),
+        'latency_ms': {
+            'min': timings[0],
+            'p50': percentile(timings, 50),
+            'p90': percentile(timings, 90),
+            'p99': percentile(timings, 99),
+            'max': timings[-1],
+            'mean': sum(timings) / len(timings),
+        },
+        'queries': {
+            'min': min(query_counts),
+            'max': max(query_counts),
+            'mean': sum(query_counts) / float(len(query_counts)),
+        },
+    }
+    if allocations:
+        summary['allocations'] = {
+            'peak_kb': max(peak for peak, blocks in allocations) / 1024.0,
+            'blocks': max(blocks for peak, blocks in allocations),
+        }
+    return summary
+
+
+def write_results():
+    data = {
+        'meta': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'rest_framework': rest_framework.VERSION,
+            'iterations': ITERATIONS,
+            'timestamp': time.time(),
+        },
+        'endpoints': results,
+    }
+    with open(OUTPUT, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    print("\nBenchmark results written to %s" % OUTPUT)
+
+    baseline = {}
+    if BASELINE:
+        with open(BASELINE) as f:
+            baseline = json.load(f)['endpoints']
+
+    print("%-32s %9s %9s %9s %8s" % ("endpoint", "p50 ms", "p99 ms", "queries", "p50 chg"))
+    for name in sorted(results):
+        result = results[name]
+        change = ""
+        if name in baseline:
+            old = baseline[name]['latency_ms']['p50']
+            change = "%+.0f%%" % ((result['latency_ms']['p50'] - old) / old * 100) if old else ""
+            if result['queries']['max'] != baseline[name]['queries']['max']:
+                change += " (%d queries before)" % baseline[name]['queries']['max']
+        print("%-32s %9.2f %9.2f %9d %8s" % (name, result['latency_ms']['p50'], result['latency_ms']['p99'],
+                                             result['queries']['max'], change))
+
+
+class EndpointBenchmark(TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super(EndpointBenchmark, cls).tearDownClass()
+        if results:
+            write_results()
+
+    def setUp(self):
+        get_cache().clear()
+        throttling.reset()
+        self.user = self.create_user("benchuser", verified=True)
+
+    def create_user(self, username, verified=False):
+        user = User.objects.create(username=username, email="%s@example.com" % username)
+        user.set_password(PASSWORD)
+        user.save()
+        EmailAddress.objects.create(user=user, email=user.email, primary=True, verified=verified)
+        return user
+
+    def measure(self, name, request, setup=None, expected_status=200):
+        """
+        Runs request(i, context) where context = setup(i), only timing the request
+        """
+        timings = []
+        query_counts = []
+        allocations = []
+        for i in range(ITERATIONS + ALLOCATION_ITERATIONS):
+            mail.outbox = []
+            context = setup(i) if setup else None
+            trace = tracemalloc is not None and i >= ITERATIONS
+            if trace:
+                tracemalloc.start()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = request(i, context)
+                elapsed = time.perf_counter() - start
+            if trace:
+                allocations.append((tracemalloc.get_traced_memory()[1], len(tracemalloc.take_snapshot().traces)))
+                tracemalloc.stop()
+            self.assertEqual(response.status_code, expected_status,
+                             "%s: %s" % (name, getattr(response, 'content', b'').decode()))
+            if not trace:
+                timings.append(elapsed)
+                query_counts.append(len(queries))
+        results[name] = summarize(timings, query_counts, allocations)
+
+    def login(self, login_type='basic', username="benchuser"):
+        self.client.logout()
+        response = self.client.post("/login/", {"username": username, "password": PASSWORD,
+                                                "login_type": login_type})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def bench_login(self, login_type):
+        self.measure("login:%s" % login_type,
+                     lambda i, c: self.client.post("/login/", {"username": "benchuser", "password": PASSWORD,
+                                                               "login_type": login_type}),
+                     setup=lambda i: self.client.logout())
+
+    def bench_logout(self, login_type):
+        headers = {}
+
+        def setup(i):
+            data = self.login(login_type)
+            headers.clear()
+            if login_type == 'device_token':
+                self.client.logout()
+                headers['HTTP_AUTHORIZATION'] = 'Device ' + data['token']
+            elif login_type == 'signed_token':
+                self.client.logout()
+                headers['HTTP_AUTHORIZATION'] = 'Bearer ' + data['token']
+
+        self.measure("logout:%s" % login_type,
+                     lambda i, c: self.client.post("/logout/", {"login_type": login_type}, **headers),
+                     setup=setup, expected_status=204)
+
+    def test_register(self):
+        self.measure("register",
+                     lambda i, c: self.client.post("/register/", {"username": "newuser%d" % i,
+                                                                  "email": "newuser%d@example.com" % i,
+                                                                  "password1": PASSWORD, "password2": PASSWORD}),
+                     setup=lambda i: self.client.logout(), expected_status=201)
+
+    def test_login(self):
+        for login_type in LOGIN_TYPES:
+            self.bench_login(login_type)
+
+    def test_logout(self):
+        for login_type in LOGIN_TYPES:
+            self.bench_logout(login_type)
+
+    def test_oauth2_login(self):
+        if get_application_model is None:
+            return
+        get_application_model().objects.create(name="Bench", client_id="bench_client", client_secret="bench_secret",
+                                               client_type="confidential", authorization_grant_type="password",
+                                               user=self.user)
+        auth = 'Basic ' + base64.b64encode(b'bench_client:bench_secret').decode()
+        self.measure("oauth2_login",
+                     lambda i, c: self.client.post("/oauth-login/", {"username": "benchuser", "password": PASSWORD,
+                                                                     "grant_type": "password"},
+                                                   HTTP_AUTHORIZATION=auth))
+
+    def test_send_email_confirmation(self):
+        self.create_user("unverified")
+        self.login(username="unverified")
+        with override_api_settings(EMAIL_CONFIRMATION_RESEND_INTERVAL=0):
+            self.measure("send_email_confirmation", lambda i, c: self.client.post("/send-email-confirmation/"))
+
+    def test_confirm_email(self):
+        def setup(i):
+            user = self.create_user("confirm%d" % i)
+            return EmailConfirmationHMAC(EmailAddress.objects.get(user=user)).key
+
+        self.measure("confirm_email", lambda i, key: self.client.post("/confirm-email/", {"key": key}), setup=setup)
+
+    def test_change_password(self):
+        passwords = [PASSWORD]
+
+        def setup(i):
+            # Changing the password ends the session
+            self.client.logout()
+            self.assertTrue(self.client.login(username="benchuser", password=passwords[-1]))
+            passwords.append("newpassword%d" % i)
+            return {"oldpassword": passwords[-2], "password1": passwords[-1], "password2": passwords[-1]}
+
+        self.measure("change_password", lambda i, data: self.client.post("/password/", data), setup=setup,
+                     expected_status=204)
+
+    def test_reset_password(self):
+        self.measure("reset_password",
+                     lambda i, c: self.client.post("/password/reset/", {"email": self.user.email}),
+                     expected_status=204)
+
+    def test_confirm_reset_password(self):
+        def setup(i):
+            user = User.objects.get(pk=self.user.pk)
+            return {"uidb36": user_pk_to_url_str(user), "key": default_token_generator.make_token(user),
+                    "password1": "resetpassword%d" % i, "password2": "resetpassword%d" % i}
+
+        self.measure("confirm_reset_password",
+                     lambda i, data: self.client.post("/password/reset/confirm/", data), setup=setup)
+
+    def test_check_registration(self):
+        self.measure("check_registration:found",
+                     lambda i, c: self.client.get("/registrations/benchuser/"), expected_status=204)
+        self.measure("check_registration:missing",
+                     lambda i, c: self.client.get("/registrations/nobody%d/" % i), expected_status=404)
+
+    def test_check_registrations(self):
+        identifiers = ["benchuser", "benchuser@example.com"] + ["nobody%d" % i for i in range(100)]
+        self.measure("check_registrations:batch",
+                     lambda i, c: self.client.post("/registrations/", json.dumps({"identifiers": identifiers}),
+                                                   content_type="application/json"))
+
+    def test_import(self):
+        # Cold start: Django setup and URL loading in a fresh interpreter
+        timings = [import_api()['seconds'] for i in range(min(ITERATIONS, 10))]
+        results["import"] = summarize(timings, [0] * len(timings), [])
+
+    def test_social_providers(self):
+        self.measure("social_providers", lambda i, c: self.client.get("/social/providers/"))
@@ -99,6 +99,8 @@ def pytest_configure():
             'DEFAULT_AUTHENTICATION_CLASSES': (
                 'oauth2_provider.ext.rest_framework.OAuth2Authentication',
                 'rest_framework.authentication.SessionAuthentication',
+                'allauth_api.account.rest_framework.authentication.DeviceTokenAuthentication',
+                'allauth_api.account.rest_framework.authentication.SignedTokenAuthentication',
             )
         },
     )
@@ -0,0 +1,78 @@
+"""
+A local HTTP stand-in for the social providers' APIs.
+
+    server = FakeProviderServer({'/me': lambda query: (200, {'id': '1'})})
+    server.start()
+    ... point the provider at server.url ...
+    server.stop()
+
+Each route gets the query parameters (a dict of single values) and returns a (status, data) pair,
+or a (status, data, headers) triple, data being serialized as JSON.  server.hits counts the requests per path, and server.connections the
+requests per client connection (the server keeps connections alive).
+"""
+import json
+import threading
+from collections import Counter
+
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import urlparse, parse_qsl
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeProviderServer(object):
+
+    def __init__(self, routes=None):
+        self.routes = dict(routes or {})
+        self.hits = Counter()
+        self.connections = Counter()
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with server.lock:
+                    server.hits[url.path] += 1
+                    server.connections[self.client_address] += 1
+                route = server.routes.get(url.path)
+                headers = {}
+                if route is None:
+                    status, data = 404, {'error': {'message': 'Unknown path'}}
+                else:
+                    result = route(dict(parse_qsl(url.query)))
+                    status, data = result[:2]
+                    if len(result) > 2:
+                        headers = result[2]
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.httpd.server_address[1]
@@ -24,11 +24,19 @@ from allauth.utils import get_user_model
 
 from allauth import app_settings
 from allauth_api.settings import allauth_api_settings
+from allauth_api.account.verification import get_cache
+from allauth_api.socialaccount.providers import VERSION_CACHE_KEY
+from tests.utils import override_api_settings
 
 from allauth.account.adapter import get_adapter as account_adapter
 from allauth.account.models import EmailAddress, EmailConfirmation
 from allauth.socialaccount.adapter import get_adapter as social_account_adapter
 from allauth.socialaccount import providers
+from allauth.socialaccount.models import SocialApp
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 try:
     from unittest.case import skipIf, skip
 except ImportError:
@@ -187,6 +195,44 @@ class ProvidersTest(BaseAccountsTest):
 
         providers.registry = old_registry
 
+    def test_cached_response(self):
+        response = self.client.get(self.endpoint)
+        etag = response['ETag']
+        self.assertEqual(response['Cache-Control'], 'max-age=300')
+
+        serializer = 'allauth_api.socialaccount.rest_framework.views.ProviderSerializer'
+        with mock.patch(serializer) as provider_serializer:
+            response = self.client.get(self.endpoint, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            response = self.client.get(self.endpoint, HTTP_IF_NONE_MATCH='"other", W/%s' % etag)
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(self.endpoint, HTTP_IF_NONE_MATCH='"other"')
+            self.assertEqual(response.status_code, 200)
+            self.assertJSONEqual(response.content.decode(), json.dumps([{"name": "Facebook"}]))
+            self.assertFalse(provider_serializer.called)
+
+        # Changing the provider configuration renders the list again
+        SocialApp.objects.create(provider='facebook', name='Facebook', client_id='id', secret='secret')
+        with mock.patch(serializer) as provider_serializer:
+            provider_serializer.return_value.data = []
+            response = self.client.get(self.endpoint)
+            self.assertTrue(provider_serializer.called)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.content.decode(), '[]')
+        SocialApp.objects.all().delete()
+        response = self.client.get(self.endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # A change made by another process is seen through the shared cache
+        get_cache().set(VERSION_CACHE_KEY, 'changed-elsewhere', None)
+        with mock.patch(serializer) as provider_serializer:
+            provider_serializer.return_value.data = []
+            response = self.client.get(self.endpoint, HTTP_IF_NONE_MATCH=etag)
+            self.assertTrue(provider_serializer.called)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode(), '[]')
+
 
 class RegistrationsTest(BaseAccountsTest):
     allowed_methods = ['OPTIONS', 'HEAD', 'GET']
@@ -221,6 +267,72 @@ class RegistrationsTest(BaseAccountsTest):
         self.assertEqual(response.content.decode(), '', "Response should not contain content")
 
 
+class RegistrationsBatchTest(BaseAccountsTest):
+    allowed_methods = ['OPTIONS', 'POST']
+    endpoint = '/registrations/'
+
+    def setUp(self):
+        User.objects.create(username='johndoe', email='johndoe@example.com')
+        User.objects.create(username='janedoe', email='janedoe@example.com')
+        self.identifiers = ['johndoe', 'JaneDoe', 'nobody', 'johndoe@example.com', 'JANEDOE@example.com',
+                            'nobody@example.com']
+
+    def tearDown(self):
+        set_case_insensitive(False)
+
+    def post(self, identifiers):
+        return self.client.post(self.endpoint, json.dumps({'identifiers': identifiers}),
+                                content_type='application/json')
+
+    def test_registrations(self):
+        set_case_insensitive(False)
+        with self.assertNumQueries(2):
+            response = self.post(self.identifiers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode()), {
+            'johndoe': True, 'JaneDoe': False, 'nobody': False,
+            'johndoe@example.com': True, 'JANEDOE@example.com': False, 'nobody@example.com': False,
+        })
+
+        # form data works too
+        response = self.client.post(self.endpoint, {'identifiers': ['johndoe', 'nobody']})
+        self.assertEqual(json.loads(response.content.decode()), {'johndoe': True, 'nobody': False})
+
+    def test_case_insensitive_registrations(self):
+        set_case_insensitive(True)
+        response = self.post(self.identifiers + ['JOHNDOE'])
+        self.assertEqual(json.loads(response.content.decode()), {
+            'johndoe': True, 'JaneDoe': True, 'JOHNDOE': True, 'nobody': False,
+            'johndoe@example.com': True, 'JANEDOE@example.com': True, 'nobody@example.com': False,
+        })
+
+    def test_chunked_queries(self):
+        with override_api_settings(REGISTRATIONS_QUERY_CHUNK_SIZE=2):
+            with self.assertNumQueries(4):
+                response = self.post(self.identifiers)
+        self.assertEqual(sum(json.loads(response.content.decode()).values()), 2)
+
+    def test_invalid_requests(self):
+        for data in ({}, {'identifiers': 'johndoe'}, {'identifiers': [1, 2]}, {'identifiers': ['']}):
+            response = self.client.post(self.endpoint, json.dumps(data), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+        with override_api_settings(REGISTRATIONS_BATCH_MAX=5):
+            response = self.post(self.identifiers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_throttling(self):
+        from rest_framework.throttling import ScopedRateThrottle
+        from allauth_api.account.rest_framework.views import RegistrationBatchCheckView
+
+        get_cache().clear()
+        with mock.patch.object(RegistrationBatchCheckView, 'throttle_classes', [ScopedRateThrottle]), \
+                mock.patch.object(ScopedRateThrottle, 'THROTTLE_RATES', {'allauth_api_registrations': '2/min'}):
+            self.assertEqual(self.post(['johndoe']).status_code, 200)
+            self.assertEqual(self.post(['johndoe']).status_code, 200)
+            self.assertEqual(self.post(['johndoe']).status_code, 429)
+
+
 class RegisterTest(BaseAccountsTest):
     allowed_methods = ['OPTIONS', 'POST']
     endpoint = '/register/'
@@ -312,6 +424,13 @@ class RegisterTest(BaseAccountsTest):
         self.assertEqual(response.status_code, 400)
         self.assertJSONEqual(response.content.decode(), json.dumps(expected))
 
+    def test_closed(self):
+        with mock.patch('allauth.account.adapter.DefaultAccountAdapter.is_open_for_signup', return_value=False):
+            response = self.client.post(self.endpoint, user1)
+        self.assertEqual(response.status_code, 403)
+        self.assertJSONEqual(response.content.decode(), json.dumps({"detail": "Registration is closed"}))
+        self.assertFalse(get_user_model().objects.filter(username=user1['username']).exists())
+
 
 @override_settings(ACCOUNT_ADAPTER='tests.accountadapter.ImageKeyTestAccountAdapter')
 class ImageKeyRegisterTest(BaseAccountsTest):
@@ -348,7 +467,16 @@ class SendEmailConfirmationTest(BaseAccountsTest):
         user = User.objects.get(username=user1['username'])
 
         self.client.login(username=user1['username'], password=user1['password1'])
+
+        # the signup confirmation was just sent
         response = self.client.post("/send-email-confirmation/")
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('next_send_allowed', json.loads(response.content.decode()))
+        self.assertTrue(int(response['Retry-After']) > 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+        with override_api_settings(EMAIL_CONFIRMATION_RESEND_INTERVAL=0):
+            response = self.client.post("/send-email-confirmation/")
         self.assertEqual(response.status_code, 200)
 
         self.assertEqual(len(mail.outbox), 2)
@@ -495,6 +623,50 @@ class LoginLogoutTest(BaseAccountsTest):
 
         # TODO Test that user is actually logged out and tokens are revoked
 
+    def test_device_token_login_logout(self):
+        from allauth_api.models import DeviceToken
+        from allauth_api.account.rest_framework.utils import DeviceTokenGenerator
+        from allauth_api.account.rest_framework.authentication import DeviceTokenAuthentication
+        from rest_framework.test import APIRequestFactory
+
+        # each device gets its own token
+        tokens = {}
+        for device in ['phone', 'tablet', 'laptop']:
+            self.data.update({'login_type': 'device_token', 'device': device})
+            response = self.client.post(self.endpoint, self.data)
+            self.assertEqual(response.status_code, 200)
+            tokens[device] = json.loads(response.content.decode())['token']
+            self.client.logout()
+        self.assertEqual(len(set(tokens.values())), 3)
+        self.assertEqual(DeviceToken.objects.get(pk=tokens['tablet']).device, 'tablet')
+
+        # logging out of one device leaves the others logged in
+        self.logout_data["login_type"] = "device_token"
+        response = self.client.post("/logout/", self.logout_data, HTTP_AUTHORIZATION='Device ' + tokens['phone'])
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(DeviceToken.objects.filter(pk=tokens['phone']).exists())
+        self.assertEqual(DeviceToken.objects.filter(user=self.user).count(), 2)
+
+        response = self.client.post("/logout/", self.logout_data, HTTP_AUTHORIZATION='Device ' + tokens['phone'])
+        self.assertEqual(response.status_code, 401)
+
+        # or all of them at once
+        self.logout_data["all_devices"] = "true"
+        response = self.client.post("/logout/", self.logout_data, HTTP_AUTHORIZATION='Device ' + tokens['laptop'])
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(DeviceToken.objects.filter(user=self.user).exists())
+
+        # rest_framework's tokens are left to its TokenAuthentication
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION='Token ' + tokens['laptop'])
+        self.assertIsNone(DeviceTokenAuthentication().authenticate(request))
+
+        # issuing and bulk revoking are single queries
+        generator = DeviceTokenGenerator()
+        with self.assertNumQueries(1):
+            generator.get_token(self.user, device='watch')
+        with self.assertNumQueries(1):
+            generator.revoke_all_tokens(self.user)
+
     @skipIf(not has_oauth2, "oauth2_provider is not installed")
     def test_oauth2_login_logout(self):
         # oauth2 invalid client login
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+import json
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+
+from allauth.account.models import EmailAddress
+from rest_framework.authtoken.models import Token
+
+from allauth_api.account.auth_backends import AuthenticationBackend, VERIFIED_EMAIL_ATTRIBUTE
+from allauth_api.account.verification import get_cache
+
+from tests.utils import override_api_settings
+
+BACKENDS = ("allauth_api.account.auth_backends.AuthenticationBackend",)
+
+
+@override_settings(AUTHENTICATION_BACKENDS=BACKENDS, ACCOUNT_EMAIL_VERIFICATION='mandatory',
+                   ACCOUNT_AUTHENTICATION_METHOD='username_email')
+class LoginQueriesTest(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create(username='johndoe', email='johndoe@example.com')
+        self.user.set_password('testpassword')
+        self.user.save()
+        EmailAddress.objects.create(user=self.user, email='johndoe@example.com', verified=True, primary=True)
+        EmailAddress.objects.create(user=self.user, email='john@example.org', verified=False)
+
+    def login(self, **data):
+        self.client.logout()
+        data.setdefault('password', 'testpassword')
+        data.setdefault('login_type', 'token')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/login/', data)
+        selects = [query['sql'] for query in queries
+                   if query['sql'].startswith('SELECT') and 'django_session' not in query['sql']]
+        return response, selects
+
+    def test_token_login_is_one_query(self):
+        token = Token.objects.create(user=self.user)
+        response, selects = self.login(username='johndoe')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['token'], token.key)
+        self.assertEqual(len(selects), 1, selects)
+
+    def test_new_token(self):
+        response, selects = self.login(username='johndoe')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['token'], Token.objects.get(user=self.user).key)
+        # The user, then get_or_create's lookup of the token
+        self.assertEqual(len(selects), 2, selects)
+
+        with override_api_settings(LOGIN_JOIN_TOKEN=False):
+            response, selects = self.login(username='johndoe')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(selects), 2, selects)
+
+    def test_email_login(self):
+        Token.objects.create(user=self.user)
+        for email in ('JohnDoe@example.com', 'john@example.org'):
+            response, selects = self.login(email=email)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(selects), 1, selects)
+
+    def test_unverified(self):
+        EmailAddress.objects.filter(user=self.user).update(verified=False)
+        response, selects = self.login(username='johndoe', login_type='basic')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.content.decode())['message'], 'Account email verification sent')
+
+    def test_backend(self):
+        backend = AuthenticationBackend()
+        other = User.objects.create(username='other', email='other@example.com')
+        other.set_password('testpassword')
+        other.save()
+
+        user = backend.authenticate(username='JOHNDOE', password='testpassword')
+        self.assertEqual(user, self.user)
+        self.assertTrue(getattr(user, VERIFIED_EMAIL_ATTRIBUTE))
+        user = backend.authenticate(email='other@example.com', password='testpassword')
+        self.assertEqual(user, other)
+        self.assertFalse(getattr(user, VERIFIED_EMAIL_ATTRIBUTE))
+        self.assertIsNone(backend.authenticate(email='john@example.org', password='wrong'))
+        self.assertIsNone(backend.authenticate(email='nobody@example.org', password='testpassword'))
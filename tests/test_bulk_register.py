@@ -0,0 +1,185 @@
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from allauth.account.models import EmailAddress
+
+from allauth_api.account import bulk, hashing, identifier_filter
+from allauth_api.account.verification import get_cache
+from allauth_api.models import NormalizedIdentifier, OutboxMessage
+
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class BulkRegisterTest(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        self.admin = User.objects.create(username='admin', email='admin@example.com', is_staff=True)
+        self.client.force_login(self.admin)
+
+    def bulk_register(self, users, **data):
+        data['users'] = users
+        response = self.client.post('/register/bulk/', json.dumps(data), content_type='application/json')
+        if not response.streaming:
+            return response, None
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        return response, [json.loads(line) for line in lines]
+
+    def test_register(self):
+        User.objects.create(username='taken', email='taken@example.com')
+        users = [
+            {'username': 'partner%d' % i, 'email': 'partner%d@example.com' % i, 'first_name': 'Partner'}
+            for i in range(5)
+        ] + [
+            {'username': 'Taken', 'email': 'new@example.com'},
+            {'username': 'other', 'email': 'TAKEN@example.com'},
+            {'username': 'partner0', 'email': 'dup@example.com'},
+            {'username': 'bad name!', 'email': 'not-an-email'},
+            {'username': 'verified', 'email': 'verified@example.com', 'verified': True, 'password': 'secret'},
+        ]
+        with override_api_settings(CASE_INSENSITIVE_IDS=True, BULK_REGISTER_CHUNK_SIZE=3):
+            response, results = self.bulk_register(users)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([result['row'] for result in results], list(range(len(users))))
+        self.assertEqual([result['status'] for result in results], ['created'] * 5 + ['rejected'] * 4 + ['created'])
+        self.assertIn('username', results[5]['errors'])
+        self.assertIn('email', results[6]['errors'])
+        self.assertEqual(results[7]['errors'], {'username': ["Duplicated in this batch."]})
+        self.assertEqual(set(results[8]['errors']), set(['username', 'email']))
+
+        user = User.objects.get(pk=results[0]['id'])
+        self.assertEqual((user.username, user.first_name), ('partner0', 'Partner'))
+        self.assertFalse(user.has_usable_password())
+        self.assertTrue(User.objects.get(username='verified').check_password('secret'))
+        self.assertTrue(EmailAddress.objects.get(email='verified@example.com').verified)
+        self.assertFalse(EmailAddress.objects.get(email='partner0@example.com').verified)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['partner%d@example.com' % i for i in range(5)])
+
+    def test_invalid_values(self):
+        users = [
+            {'username': 123, 'email': 'partner0@example.com'},
+            {'username': 'partner1', 'email': ['partner1@example.com'], 'password': 42},
+            {'username': 'partner2', 'email': 'partner2@example.com', 'password': 'x'},
+            {'username': 'partner3', 'email': 'partner3@example.com', 'password': 'partner3'},
+            {'username': 'partner4', 'email': 'partner4@example.com', 'password': 'correct horse battery'},
+        ]
+        validators = [{'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
+                      {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'}]
+        with self.settings(AUTH_PASSWORD_VALIDATORS=validators):
+            response, results = self.bulk_register(users)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in results], ['rejected'] * 4 + ['created'])
+        self.assertEqual(results[0]['errors'], {'username': ["Must be a string."]})
+        self.assertEqual(results[1]['errors'], {'email': ["Must be a string."], 'password': ["Must be a string."]})
+        self.assertEqual(list(results[2]['errors']), ['password'])
+        self.assertIn("too similar", results[3]['errors']['password'][0])
+        self.assertTrue(User.objects.get(username='partner4').check_password('correct horse battery'))
+
+    def test_passwords_are_hashed_on_the_executor(self):
+        rows = [{'username': 'partner%d' % i, 'email': 'partner%d@example.com' % i, 'password': 'secret%d' % i}
+                for i in range(2)]
+        with mock.patch('allauth_api.account.hashing.set_password', wraps=hashing.set_password) as set_password:
+            results = list(bulk.register_users(rows, send_confirmation=False))
+        self.assertEqual([result['status'] for result in results], ['created'] * 2)
+        self.assertEqual(set_password.call_count, 2)
+
+    def test_query_count(self):
+        rows = [{'username': 'partner%d' % i, 'email': 'partner%d@example.com' % i} for i in range(50)]
+        # 3 conflict checks, then per chunk the savepoint, users, their ids, email addresses,
+        # unverified addresses and the savepoint release
+        with self.assertNumQueries(3 + 6 * 2):
+            results = list(bulk.register_users(rows, send_confirmation=False, chunk_size=25))
+        self.assertEqual([result['status'] for result in results], ['created'] * 50)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_validated_before_streaming(self):
+        users = [{'username': 'partner%d' % i, 'email': 'partner%d@example.com' % i} for i in range(3)]
+        with mock.patch('allauth_api.account.bulk.validate_rows', wraps=bulk.validate_rows) as validate_rows:
+            response = self.client.post('/register/bulk/', json.dumps({'users': users}),
+                                        content_type='application/json')
+            self.assertEqual(validate_rows.call_count, 1)
+            self.assertFalse(User.objects.filter(username__startswith='partner').exists())
+            b''.join(response.streaming_content)
+        self.assertEqual(User.objects.filter(username__startswith='partner').count(), 3)
+
+    def test_failed_chunk(self):
+        rows = [{'username': 'partner%d' % i, 'email': 'partner%d@example.com' % i} for i in range(4)]
+        insert_users = bulk.insert_users
+
+        def fail_first_chunk(users, verified):
+            if users[0].username == 'partner0':
+                raise KeyError('partner0')
+            return insert_users(users, verified)
+
+        with mock.patch('allauth_api.account.bulk.insert_users', side_effect=fail_first_chunk):
+            results = list(bulk.register_users(rows, send_confirmation=False, chunk_size=2))
+        self.assertEqual([result['status'] for result in results], ['failed'] * 2 + ['created'] * 2)
+        self.assertEqual(results[0]['errors'], {'__all__': ["KeyError: 'partner0'"]})
+        self.assertEqual(sorted(User.objects.filter(username__startswith='partner')
+                                .values_list('username', flat=True)), ['partner2', 'partner3'])
+
+    def test_batched_outbox(self):
+        users = [{'username': 'partner%d' % i, 'email': 'partner%d@example.com' % i} for i in range(10)]
+        with override_api_settings(EMAIL_OUTBOX_CLASS='allauth_api.account.outbox.DatabaseOutbox'):
+            self.bulk_register(users)
+        self.assertEqual(OutboxMessage.objects.count(), 10)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_identifiers_are_updated(self):
+        identifier_filter.reset()
+        directory = tempfile.mkdtemp()
+        try:
+            with override_api_settings(CASE_INSENSITIVE_IDS=True, NORMALIZED_IDS=True, IDENTIFIER_FILTER=True,
+                                       IDENTIFIER_FILTER_PATH=os.path.join(directory, 'identifiers.bloom')):
+                self.assertFalse(identifier_filter.might_be_registered(identifier_filter.USERNAME, 'partner'))
+                self.bulk_register([{'username': 'Partner', 'email': 'Partner@example.com'}])
+                self.assertTrue(identifier_filter.might_be_registered(identifier_filter.USERNAME, 'partner'))
+                self.assertEqual(NormalizedIdentifier.objects.get(username='partner').email, 'partner@example.com')
+        finally:
+            identifier_filter.reset()
+            shutil.rmtree(directory)
+
+    def test_invalid_requests(self):
+        response, results = self.bulk_register('not a list')
+        self.assertEqual(response.status_code, 400)
+        with override_api_settings(BULK_REGISTER_MAX=1):
+            response, results = self.bulk_register([{'username': 'a'}, {'username': 'b'}])
+        self.assertEqual(response.status_code, 400)
+
+        self.client.logout()
+        self.client.force_login(User.objects.create(username='notadmin'))
+        response, results = self.bulk_register([])
+        self.assertEqual(response.status_code, 403)
+
+    def test_command(self):
+        lines = [json.dumps({'username': 'cmduser%d' % i, 'email': 'cmduser%d@example.com' % i}) for i in range(3)]
+        lines.append(json.dumps({'username': 'cmduser0', 'email': 'other@example.com'}))
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        stdout = StringIO()
+        stderr = StringIO()
+        try:
+            call_command('bulk_register_users', path, '--no-confirmation', stdout=stdout, stderr=stderr)
+        finally:
+            os.remove(path)
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([result['status'] for result in results], ['created'] * 3 + ['rejected'])
+        self.assertIn("3 user(s) created, 1 rejected", stderr.getvalue())
+        self.assertEqual(len(mail.outbox), 0)
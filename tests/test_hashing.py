@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+import json
+from unittest import skipIf
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from allauth_api.account import hashing
+
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+except ImportError:
+    NativeThreadPoolExecutor = None
+
+BACKENDS = ("allauth_api.account.auth_backends.AuthenticationBackend",)
+
+user1 = {
+    "username": "johndoe",
+    "email": "johndoe@example.com",
+    "password1": "testpassword",
+    "password2": "testpassword"
+}
+
+
+@override_settings(AUTHENTICATION_BACKENDS=BACKENDS)
+class HashingExecutorTest(TestCase):
+    executor = 'thread'
+
+    def setUp(self):
+        self.settings_override = override_api_settings(PASSWORD_HASHING_EXECUTOR=self.executor,
+                                                       PASSWORD_HASHING_WORKERS=1,
+                                                       PASSWORD_HASHING_QUEUE_DEPTH=0,
+                                                       PASSWORD_HASHING_RETRY_AFTER=3)
+        self.settings_override.__enter__()
+        self.login_data = {"username": user1["username"], "password": user1["password1"], "login_type": "basic"}
+
+    def tearDown(self):
+        hashing.shutdown()
+        self.settings_override.__exit__(None, None, None)
+
+    def test_register_login_change_password(self):
+        response = self.client.post("/register/", user1)
+        self.assertEqual(response.status_code, 201)
+        user = User.objects.get(username=user1["username"])
+        self.assertTrue(user.check_password(user1["password1"]))
+        self.client.logout()
+
+        response = self.client.post("/login/", self.login_data)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post("/password/", {"oldpassword": "wrong", "password1": "newpassword",
+                                                   "password2": "newpassword"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/password/", {"oldpassword": user1["password1"], "password1": "newpassword",
+                                                   "password2": "newpassword"})
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(User.objects.get(pk=user.pk).check_password("newpassword"))
+
+    def test_invalid_credentials(self):
+        User.objects.create(username=user1["username"], password=make_password(user1["password1"]))
+        self.login_data["password"] = "invalidpassword"
+        response = self.client.post("/login/", self.login_data)
+        self.assertEqual(response.status_code, 401)
+
+    def test_full_queue_returns_503(self):
+        User.objects.create(username=user1["username"], password=make_password(user1["password1"]))
+        executor = hashing.get_executor()
+        self.assertTrue(executor.slots.acquire(False))
+        try:
+            response = self.client.post("/login/", self.login_data)
+        finally:
+            executor.slots.release()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertIn('detail', json.loads(response.content.decode()))
+
+        response = self.client.post("/login/", self.login_data)
+        self.assertEqual(response.status_code, 200)
+
+    def test_outdated_hash_is_upgraded(self):
+        user = User.objects.create(username=user1["username"],
+                                   password=make_password(user1["password1"], hasher='md5'))
+        self.assertTrue(hashing.check_password(user, user1["password1"]))
+        self.assertTrue(User.objects.get(pk=user.pk).password.startswith('sha1$'))
+        self.assertFalse(hashing.check_password(user, "invalidpassword"))
+
+
+class ProcessHashingExecutorTest(HashingExecutorTest):
+    executor = 'process'
+
+
+@skipIf(NativeThreadPoolExecutor is None, "gevent is not installed")
+class GeventHashingExecutorTest(HashingExecutorTest):
+
+    def setUp(self):
+        super(GeventHashingExecutorTest, self).setUp()
+        patcher = mock.patch('allauth_api.account.hashing.threading_is_patched', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_uses_native_threads(self):
+        self.assertIsInstance(hashing.get_executor().pool, NativeThreadPoolExecutor)
@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import tempfile
+
+from django import forms
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from allauth.account.adapter import get_adapter
+
+from allauth_api.account import identifier_filter
+from allauth_api.account.identifier_filter import BloomFilter, IdentifierFilter
+from allauth_api.account.verification import get_cache
+
+from tests.utils import override_api_settings
+
+
+class BloomFilterTest(TestCase):
+
+    def test_parameters(self):
+        self.assertEqual(BloomFilter.get_parameters(1000, 0.01), (9586, 7))
+
+    def test_membership(self):
+        num_bits, num_hashes = BloomFilter.get_parameters(1000, 0.01)
+        bloom = BloomFilter(num_bits, num_hashes)
+        for i in range(1000):
+            bloom.add("user%d" % i)
+        self.assertTrue(all("user%d" % i in bloom for i in range(1000)))
+        false_positives = sum("other%d" % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class IdentifierFilterTest(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        self.directory = tempfile.mkdtemp()
+        self.settings_override = override_api_settings(
+            IDENTIFIER_FILTER=True, IDENTIFIER_FILTER_CAPACITY=1000,
+            IDENTIFIER_FILTER_PATH=os.path.join(self.directory, "identifiers.bloom"))
+        self.settings_override.__enter__()
+        identifier_filter.reset()
+        User.objects.create(username="JohnDoe", email="john@example.com")
+
+    def tearDown(self):
+        identifier_filter.reset()
+        self.settings_override.__exit__(None, None, None)
+        shutil.rmtree(self.directory)
+
+    def test_registration_check(self):
+        # The filter was built when the user of setUp was saved
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get("/registrations/nobody/").status_code, 404)
+            self.assertEqual(self.client.get("/registrations/nobody@example.com/").status_code, 404)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get("/registrations/JohnDoe/").status_code, 204)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get("/registrations/john@example.com/").status_code, 204)
+
+        # Saved users are added
+        User.objects.create(username="JaneDoe")
+        self.assertEqual(self.client.get("/registrations/JaneDoe/").status_code, 204)
+
+    def test_batch_check(self):
+        identifier_filter.get_filter().get_bloom()
+        identifiers = ["JohnDoe", "john@example.com"] + ["nobody%d" % i for i in range(20)]
+        response = self.client.post("/registrations/", json.dumps({"identifiers": identifiers}),
+                                    content_type="application/json")
+        data = json.loads(response.content.decode())
+        self.assertTrue(data["JohnDoe"] and data["john@example.com"])
+        self.assertFalse(any(data["nobody%d" % i] for i in range(20)))
+
+        with self.assertNumQueries(0):
+            response = self.client.post("/registrations/", json.dumps({"identifiers": ["nobody", "no@example.com"]}),
+                                        content_type="application/json")
+        self.assertEqual(json.loads(response.content.decode()), {"nobody": False, "no@example.com": False})
+
+    def test_clean_username(self):
+        identifier_filter.get_filter().get_bloom()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_adapter().clean_username("available"), "available")
+        with self.assertRaises(forms.ValidationError):
+            get_adapter().clean_username("JohnDoe")
+
+    def test_register_unseen_user(self):
+        identifier_filter.get_filter().get_bloom()
+        # bulk_create doesn't send post_save, as if another process had registered the user
+        User.objects.bulk_create([User(username="taken", email="taken@example.com")])
+        response = self.client.post("/register/", {"username": "taken", "email": "other@example.com",
+                                                   "password1": "testpassword", "password2": "testpassword"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("username", json.loads(response.content.decode()))
+
+    def test_saved_before_first_use(self):
+        # The file was built by another process, this one hasn't opened it yet
+        IdentifierFilter(1000, 0.01, identifier_filter.get_filter().path).get_bloom()
+        User.objects.create(username="JaneDoe")
+        self.assertTrue(identifier_filter.might_be_registered(identifier_filter.USERNAME, "janedoe"))
+
+    def test_path_is_required(self):
+        # Each process would only see the users saved by that process
+        with self.assertRaises(ImproperlyConfigured):
+            with override_api_settings(IDENTIFIER_FILTER_PATH=None):
+                pass
+
+
+class SharedIdentifierFilterTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "identifiers.bloom")
+        User.objects.create(username="JohnDoe", email="john@example.com")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared_file(self):
+        first = IdentifierFilter(1000, 0.01, self.path)
+        with self.assertNumQueries(1):
+            self.assertTrue(first.contains(identifier_filter.USERNAME, "johndoe"))
+
+        # Another process maps the built filter instead of scanning the users again
+        second = IdentifierFilter(1000, 0.01, self.path)
+        with self.assertNumQueries(0):
+            self.assertTrue(second.contains(identifier_filter.EMAIL, "john@example.com"))
+            self.assertFalse(second.contains(identifier_filter.USERNAME, "janedoe"))
+
+        first.add_user(User(username="JaneDoe"))
+        self.assertTrue(second.contains(identifier_filter.USERNAME, "janedoe"))
+
+        # Other parameters rebuild the file
+        third = IdentifierFilter(2000, 0.01, self.path)
+        with self.assertNumQueries(1):
+            self.assertTrue(third.contains(identifier_filter.USERNAME, "johndoe"))
+        for id_filter in (first, second, third):
+            id_filter.close()
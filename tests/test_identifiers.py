@@ -0,0 +1,164 @@
+from __future__ import absolute_import
+import json
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models.signals import pre_save
+from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils.six import StringIO
+
+from allauth.account.adapter import get_adapter
+
+from allauth_api.account import identifiers
+from allauth_api.account.identifiers import UsernameTaken
+from allauth_api.account.rest_framework.utils import identifier_taken_errors
+from allauth_api.account.verification import get_cache
+from allauth_api.models import NormalizedIdentifier
+
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+user1 = {
+    "username": "JohnDoe",
+    "email": "JohnDoe@Example.com",
+    "password1": "testpassword",
+    "password2": "testpassword"
+}
+
+
+class NormalizedIdentifierTest(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        self.settings_override = override_api_settings(CASE_INSENSITIVE_IDS=True, NORMALIZED_IDS=True)
+        self.settings_override.__enter__()
+
+    def tearDown(self):
+        self.settings_override.__exit__(None, None, None)
+
+    def test_identifiers_are_synced(self):
+        user = User.objects.create(username="JohnDoe", email="JohnDoe@Example.com")
+        identifier = NormalizedIdentifier.objects.get(user=user)
+        self.assertEqual((identifier.username, identifier.email), ("johndoe", "johndoe@example.com"))
+
+        user.username = "JDoe"
+        user.save()
+        self.assertEqual(NormalizedIdentifier.objects.get(user=user).username, "jdoe")
+
+        # Saves that don't touch the identifiers don't touch the table either
+        with self.assertNumQueries(1):
+            user.save(update_fields=['last_login'])
+
+        with self.assertRaises(IntegrityError):
+            User.objects.create(username="jdoe")
+
+    def test_register(self):
+        response = self.client.post("/register/", user1)
+        self.assertEqual(response.status_code, 201)
+        self.client.logout()
+
+        data = dict(user1, username="JOHNDOE", email="other@example.com")
+        response = self.client.post("/register/", data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('username', json.loads(response.content.decode()))
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_clash_is_rejected_before_saving(self):
+        User.objects.create(username="JohnDoe")
+        with self.assertRaises(UsernameTaken):
+            User.objects.create(username="johndoe", email="other@example.com")
+        self.assertFalse(User.objects.filter(email="other@example.com").exists())
+
+    def test_concurrent_clash_outside_a_transaction(self):
+        User.objects.create(username="JohnDoe")
+        # Another process saved the same username after the pre_save check
+        pre_save.disconnect(identifiers.user_saving_handler, sender=User)
+        try:
+            with self.assertRaises(UsernameTaken):
+                with transaction.atomic():
+                    User.objects.create(username="johndoe", email="first@example.com")
+            self.assertFalse(User.objects.filter(email="first@example.com").exists())
+            with mock.patch('allauth_api.account.identifiers.in_transaction', return_value=False):
+                user = User.objects.create(username="johndoe", email="second@example.com")
+        finally:
+            pre_save.connect(identifiers.user_saving_handler, sender=User)
+        identifier = NormalizedIdentifier.objects.get(user=user)
+        self.assertEqual((identifier.username, identifier.email), (None, "second@example.com"))
+
+    def test_taken_errors(self):
+        self.assertEqual(identifier_taken_errors(UsernameTaken("taken")),
+                         {'username': [get_adapter().get_username_taken_message()]})
+        self.assertEqual(identifier_taken_errors(IntegrityError("UNIQUE constraint failed: auth_user.username")),
+                         {'username': [get_adapter().get_username_taken_message()]})
+        self.assertEqual(identifier_taken_errors(IntegrityError("UNIQUE constraint failed: account_emailaddress.email")),
+                         {'email': [get_adapter().error_messages['email_taken']]})
+        self.assertIsNone(identifier_taken_errors(IntegrityError("NOT NULL constraint failed: auth_user.password")))
+
+    def test_clean_username_skips_query(self):
+        User.objects.create(username="JohnDoe")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_adapter().clean_username("johndoe"), "johndoe")
+
+    def test_registration_checks_use_exact_lookups(self):
+        User.objects.create(username="JohnDoe", email="JohnDoe@Example.com")
+        for user_id, status in (("JOHNDOE", 204), ("johndoe@EXAMPLE.com", 204), ("nobody", 404)):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/registrations/%s/" % user_id)
+            self.assertEqual(response.status_code, status)
+            self.assertEqual(len(queries), 1)
+            self.assertIn('allauth_api_normalizedidentifier', queries[0]['sql'])
+            self.assertNotIn('LIKE', queries[0]['sql'])
+            self.assertNotIn('UPPER', queries[0]['sql'])
+
+        response = self.client.post("/registrations/", json.dumps({'identifiers': ["jOhNdOe", "nobody",
+                                                                                   "johndoe@example.COM"]}),
+                                    content_type='application/json')
+        self.assertEqual(json.loads(response.content.decode()),
+                         {"jOhNdOe": True, "nobody": False, "johndoe@example.COM": True})
+
+    @override_settings(AUTHENTICATION_BACKENDS=("allauth_api.account.auth_backends.AuthenticationBackend",))
+    def test_login(self):
+        user = User.objects.create(username="JohnDoe")
+        user.set_password(user1["password1"])
+        user.save()
+        response = self.client.post("/login/", {"username": "JOHNDOE", "password": user1["password1"],
+                                                "login_type": "basic"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_rebuild_command(self):
+        with override_api_settings(NORMALIZED_IDS=False):
+            User.objects.create(username="Bob", email="Bob@example.com")
+            User.objects.create(username="bob", email="bob2@example.com")
+            User.objects.create(username="Alice", email="alice@example.com")
+        self.assertFalse(NormalizedIdentifier.objects.exists())
+
+        stderr = StringIO()
+        call_command('rebuild_normalized_identifiers', batch_size=2, stdout=StringIO(), stderr=stderr)
+        self.assertEqual(NormalizedIdentifier.objects.count(), 3)
+        self.assertEqual(set(NormalizedIdentifier.objects.values_list('username', flat=True)),
+                         {"bob", None, "alice"})
+        self.assertIn("'bob' is already taken", stderr.getvalue())
+        self.assertEqual(self.client.get("/registrations/ALICE/").status_code, 204)
+
+    def test_rebuild_updates_in_place(self):
+        alice = User.objects.create(username="Alice", email="alice@example.com")
+        carol = User.objects.create(username="Carol", email="carol@example.com")
+        # Stale rows, as if the users had swapped usernames without the post_save handler
+        NormalizedIdentifier.objects.filter(user=carol).update(username=None)
+        NormalizedIdentifier.objects.filter(user=alice).update(username="carol", email="old@example.com")
+        NormalizedIdentifier.objects.filter(user=carol).update(username="alice")
+        dave = User.objects.create(username="Dave", email="dave@example.com")
+        NormalizedIdentifier.objects.filter(user=dave).delete()
+
+        stderr = StringIO()
+        call_command('rebuild_normalized_identifiers', batch_size=1, stdout=StringIO(), stderr=stderr)
+        self.assertEqual(stderr.getvalue(), "")
+        self.assertEqual(set(NormalizedIdentifier.objects.values_list('user_id', 'username', 'email')),
+                         {(alice.pk, "alice", "alice@example.com"), (carol.pk, "carol", "carol@example.com"),
+                          (dave.pk, "dave", "dave@example.com")})
@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+import io
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase
+
+from PIL import Image
+
+from allauth_api.account.utils import (SplicedPNGImageKeyGenerator, PNGImageKeyGenerator, InvalidImageKey,
+                                       iter_png_chunks, png_chunk, png_text_chunk, read_png_text, PNG_SIGNATURE)
+
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class SplicedPNGImageKeyGeneratorTest(SimpleTestCase):
+
+    def setUp(self):
+        SplicedPNGImageKeyGenerator._templates.clear()
+
+    def test_key_is_readable(self):
+        image_key = SplicedPNGImageKeyGenerator().create_image_key("1-4ot-abcdef")
+        data = image_key.read()
+        self.assertEqual([c[0] for c in iter_png_chunks(data)][-2:], [b'tEXt', b'IEND'])
+
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        self.assertEqual(image.text['key'], "1-4ot-abcdef")
+        template = Image.open(SplicedPNGImageKeyGenerator().get_template_image())
+        self.assertEqual(image.size, template.size)
+        self.assertEqual(image.tobytes(), template.tobytes())
+
+    def test_same_pixels_as_pil_generator(self):
+        spliced = Image.open(SplicedPNGImageKeyGenerator().create_image_key("abc"))
+        reencoded = Image.open(PNGImageKeyGenerator().create_image_key("abc"))
+        self.assertEqual(spliced.text['key'], reencoded.text['key'])
+        self.assertEqual(spliced.tobytes(), reencoded.tobytes())
+
+    def test_non_latin1_key(self):
+        image = Image.open(SplicedPNGImageKeyGenerator().create_image_key("clé-☃"))
+        image.load()
+        self.assertEqual(image.text['key'], "clé-☃")
+
+    def test_template_is_read_once(self):
+        generator = SplicedPNGImageKeyGenerator()
+        generator.create_image_key("first")
+        with mock.patch('allauth_api.account.utils.open', create=True) as mock_open:
+            SplicedPNGImageKeyGenerator().create_image_key("second")
+        self.assertFalse(mock_open.called)
+
+    def test_resized_template(self):
+        with override_api_settings(IMAGE_KEY_SIZE=(120, 120)):
+            image = Image.open(SplicedPNGImageKeyGenerator().create_image_key("abc"))
+        self.assertLessEqual(image.size[0], 120)
+        self.assertEqual(image.text['key'], "abc")
+
+    def test_invalid_template(self):
+        for data in (b'GIF89a', PNG_SIGNATURE + b'\0\0\0\x0d', PNG_SIGNATURE + png_chunk(b'IEND', b'')):
+            SplicedPNGImageKeyGenerator._templates.clear()
+            with tempfile.NamedTemporaryFile(suffix='.png') as template:
+                template.write(data)
+                template.flush()
+                for size in (None, (120, 120)):
+                    with mock.patch.object(SplicedPNGImageKeyGenerator, 'image_template', template.name), \
+                            override_api_settings(IMAGE_KEY_SIZE=size):
+                        with self.assertRaises(ImproperlyConfigured):
+                            SplicedPNGImageKeyGenerator().create_image_key("abc")
+
+
+class Unseekable(io.RawIOBase):
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class ReadPNGTextTest(SimpleTestCase):
+
+    def test_spliced_key(self):
+        image_key = SplicedPNGImageKeyGenerator().create_image_key("1-4ot-abcdef")
+        self.assertEqual(read_png_text(image_key), "1-4ot-abcdef")
+
+    def test_pil_key(self):
+        self.assertEqual(read_png_text(PNGImageKeyGenerator().create_image_key("abc")), "abc")
+
+    def test_itxt_key(self):
+        image_key = SplicedPNGImageKeyGenerator().create_image_key("clé-☃")
+        self.assertEqual(read_png_text(image_key), "clé-☃")
+
+    def test_unseekable_stream(self):
+        data = SplicedPNGImageKeyGenerator().create_image_key("abc").read()
+        self.assertEqual(read_png_text(Unseekable(data)), "abc")
+
+    def test_image_data_is_not_decompressed(self):
+        # Claims to be a huge IDAT but is never inflated
+        data = (PNG_SIGNATURE + png_chunk(b'IHDR', b'\0' * 13) + png_chunk(b'IDAT', b'garbage' * 1000) +
+                png_text_chunk('key', 'abc') + png_chunk(b'IEND', b''))
+        with mock.patch('zlib.decompress') as decompress:
+            self.assertEqual(read_png_text(io.BytesIO(data)), "abc")
+        self.assertFalse(decompress.called)
+
+    def test_missing_key(self):
+        data = PNG_SIGNATURE + png_chunk(b'IHDR', b'\0' * 13) + png_text_chunk('other', 'abc') + png_chunk(b'IEND', b'')
+        self.assertIsNone(read_png_text(io.BytesIO(data)))
+
+    def test_limits(self):
+        data = SplicedPNGImageKeyGenerator().create_image_key("abc").read()
+        with self.assertRaises(InvalidImageKey):
+            read_png_text(io.BytesIO(data), max_bytes=1024)
+        with self.assertRaises(InvalidImageKey):
+            read_png_text(io.BytesIO(data), max_chunks=3)
+
+        many_chunks = PNG_SIGNATURE + png_chunk(b'teXt', b'') * 100000
+        with self.assertRaises(InvalidImageKey):
+            read_png_text(io.BytesIO(many_chunks))
+
+    def test_invalid_images(self):
+        for data in (b'not a png', PNG_SIGNATURE + b'\0\0', PNG_SIGNATURE):
+            with self.assertRaises(InvalidImageKey):
+                read_png_text(io.BytesIO(data))
+        bad_crc = PNG_SIGNATURE + png_text_chunk('key', 'abc')[:-1] + b'\0'
+        with self.assertRaises(InvalidImageKey):
+            read_png_text(io.BytesIO(bad_crc))
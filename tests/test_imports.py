@@ -0,0 +1,92 @@
+"""
+Guards against optional dependencies creeping back into the import of the API.  The API is
+imported in a fresh interpreter, since the test process has long imported everything, with the
+optional modules made unavailable so that every attempt to import them is recorded.  Its import
+time is compared with a baseline measured in the same run: Django, allauth and REST framework
+without allauth_api, the least that importing the API can cost.
+"""
+from __future__ import absolute_import
+import json
+import os
+import subprocess
+import sys
+
+from django.test import SimpleTestCase
+
+# Only needed once their setting asks for them
+OPTIONAL_MODULES = ['PIL', 'oauth2_provider', 'oauthlib', 'multiprocessing', 'concurrent', 'gevent']
+
+SCRIPT = """
+import json, sys, time
+
+optional = %(optional)r
+attempts = []
+
+
+class OptionalModuleBlocker(object):
+
+    def find_spec(self, name, path=None, target=None):
+        if name.split('.')[0] not in optional:
+            return None
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_globals.get('__name__', '').startswith('importlib'):
+            frame = frame.f_back
+        attempts.append([name, frame.f_globals.get('__name__') if frame is not None else None])
+        raise ImportError("%%s is not available" %% name)
+
+
+sys.meta_path.insert(0, OptionalModuleBlocker())
+
+from django.conf import settings
+settings.configure(
+    INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'django.contrib.sessions',
+                    'django.contrib.sites', 'allauth', 'allauth.account', 'allauth.socialaccount',
+                    'rest_framework'] + %(apps)r,
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    ROOT_URLCONF=%(urlconf)r, SECRET_KEY='imports', SITE_ID=1, STATIC_ROOT='static',
+)
+start = time.time()
+import django
+django.setup()
+import rest_framework.views, rest_framework.generics
+from django.core.urlresolvers import get_resolver
+get_resolver(None).url_patterns
+json.dump({'seconds': time.time() - start, 'modules': sorted(sys.modules), 'attempts': attempts}, sys.stdout)
+"""
+
+# Importing the API may take this many times as long as the baseline, plus a fixed allowance
+# for a noisy machine
+TIME_FACTOR = 2
+TIME_ALLOWANCE = 0.5
+
+
+def import_api(api=True):
+    """
+    Sets up Django with allauth_api and loads its URLs in a fresh interpreter, or only allauth and
+    REST framework as the baseline.  Returns the time it took, the loaded modules and the attempts
+    to import optional modules, with their importer
+    """
+    script = SCRIPT % {'optional': OPTIONAL_MODULES, 'apps': ['allauth_api'] if api else [],
+                       'urlconf': 'allauth_api.urls' if api else 'allauth.urls'}
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([src] + sys.path))
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    return json.loads(output.decode())
+
+
+class ImportTest(SimpleTestCase):
+
+    def test_optional_modules_are_not_imported(self):
+        result = import_api()
+        self.assertIn('allauth_api.account.rest_framework.views', result['modules'])
+        self.assertIn('allauth_api.socialaccount.rest_framework.views', result['modules'])
+        attempts = [(module, importer) for module, importer in result['attempts']
+                    if importer and importer.startswith('allauth_api')]
+        self.assertEqual(attempts, [])
+
+    def test_import_time(self):
+        baseline = import_api(api=False)
+        result = import_api()
+        self.assertNotIn('allauth_api', baseline['modules'])
+        self.assertLess(result['seconds'], baseline['seconds'] * TIME_FACTOR + TIME_ALLOWANCE)
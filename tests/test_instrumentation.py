@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from allauth_api import instrumentation
+from allauth_api.account.rest_framework.views import RegisterView
+from allauth_api.account.verification import get_cache
+
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+user1 = {
+    "username": "johndoe",
+    "email": "johndoe@example.com",
+    "password1": "testpassword",
+    "password2": "testpassword"
+}
+
+
+class QueryInstrumentationTest(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        instrumentation.reset_stats()
+        self.settings_override = override_api_settings(QUERY_INSTRUMENTATION=True)
+        self.settings_override.__enter__()
+
+    def tearDown(self):
+        self.settings_override.__exit__(None, None, None)
+
+    def test_views_stay_within_budget(self):
+        response = self.client.post("/register/", user1)
+        self.assertEqual(response.status_code, 201)
+        report = instrumentation.assert_query_budget(response)
+        self.assertEqual(list(report.phase_counts().keys())[-3:], ['validate', 'save', 'complete_signup'])
+        self.client.logout()
+
+        for login_type in ('basic', 'token', 'device_token', 'signed_token'):
+            response = self.client.post("/login/", {"username": user1["username"], "password": user1["password1"],
+                                                    "login_type": login_type})
+            self.assertEqual(response.status_code, 200)
+            instrumentation.assert_query_budget(response)
+            self.client.logout()
+
+        for response in (self.client.get("/registrations/johndoe/"), self.client.get("/social/providers/"),
+                         self.client.post("/password/reset/", {"email": user1["email"]})):
+            instrumentation.assert_query_budget(response)
+
+        stats = instrumentation.get_stats()
+        self.assertEqual(stats['LoginView']['requests'], 4)
+        self.assertEqual(stats['RegisterView']['phases']['save'], report.phase_counts()['save'])
+
+    def test_over_budget(self):
+        with mock.patch.object(RegisterView, 'query_budget', 1):
+            response = self.client.post("/register/", user1)
+        self.assertEqual(response.status_code, 201)
+        with self.assertRaises(instrumentation.QueryBudgetExceeded) as cm:
+            instrumentation.assert_query_budget(response)
+        self.assertIn("RegisterView ran", str(cm.exception))
+        self.assertIn("  save: ", str(cm.exception))
+        self.assertEqual(instrumentation.get_stats()['RegisterView']['over_budget'], 1)
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        User.objects.create(username=user1["username"])
+        response = self.client.get("/registrations/johndoe/")
+        self.assertEqual(response['X-Query-Count'], '1')
+        self.assertEqual(response['X-Query-Phases'], 'other=1')
+        self.assertEqual(response['X-Query-Duplicates'], '0')
+
+    def test_no_headers_without_debug(self):
+        response = self.client.get("/registrations/johndoe/")
+        self.assertFalse(response.has_header('X-Query-Count'))
+        self.assertEqual(len(response.query_report), 1)
+
+    def test_disabled(self):
+        with override_api_settings(QUERY_INSTRUMENTATION=False):
+            response = self.client.get("/registrations/johndoe/")
+        self.assertFalse(hasattr(response, 'query_report'))
+        with self.assertRaises(AssertionError):
+            instrumentation.assert_query_budget(response)
+
+    def test_phases_and_duplicates(self):
+        with instrumentation.phase('ignored'):
+            User.objects.count()
+
+        with instrumentation.record('manual') as recorder:
+            User.objects.count()
+            with instrumentation.phase('outer'):
+                User.objects.count()
+                with instrumentation.phase('inner'):
+                    User.objects.exists()
+                User.objects.count()
+        report = recorder.report(budget=3)
+        self.assertEqual(list(report.phase_counts().items()), [('other', 1), ('outer', 2), ('inner', 1)])
+        self.assertTrue(report.over_budget)
+        self.assertEqual(list(report.duplicates.values()), [3])
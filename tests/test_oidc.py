@@ -0,0 +1,195 @@
+from __future__ import absolute_import
+import base64
+import binascii
+import hashlib
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.test import TestCase, SimpleTestCase
+
+from allauth.socialaccount.models import SocialAccount, SocialApp
+
+from allauth_api.account import throttling
+from allauth_api.account.verification import get_cache
+from allauth_api.socialaccount import http
+from allauth_api.socialaccount.providers import oidc
+from allauth_api.socialaccount.providers.google import provider as google_provider  # NOQA, registers the provider
+from allauth_api.socialaccount.providers.oidc import RSAPublicKey, RSA_ALGORITHMS
+
+from tests.provider_server import FakeProviderServer
+from tests.utils import override_api_settings
+
+CLIENT_ID = 'web-client.apps.googleusercontent.com'
+GOOGLE_UID = '110248495921238986420'
+
+# 1024 bit test keys: kid -> (n, d)
+KEYS = {
+    'key1': (int('d8ef09389ef862bd97adb456f10ce6f6f60914fecaa4d4d0eda307249851ad1474611b1aec7cf69c8ea562470cd'
+                 'a98c3507517049c322b4afac9a96e8d14b748b65b38b6a30687ef1bc823dee95786ed545a38e5a8ca772a4c105b6'
+                 '8df9a5970343070d4ad708392db2747f4cd3a7ca16570ad5ddcf3296490123d001ea03fcf', 16),
+             int('1b0bfa7f57baaa3cef2b561fbce019efd28f2151ff1bfbf8ac9835ecc71cefd26c0c2b5ff8fa3f991763e153f07'
+                 '354b68d527bf33432411991191189da072a2ea8d7d8c3b318c3e72379faa97361958f2a438ccbec8f2e9881120d1'
+                 '0d69ba07898ca762c72ddb8f6b58e1a6d0084265ec889b4264d233afc55c530462d16a3f1', 16)),
+    'key2': (int('ebc6d1eb5c5a0a55314de08ead08a3d73308ec7db949966b99ce43d29c7ce3ccb3ef85640905dd8617f79e95def'
+                 'd7ffd7397240f70c08cc2ace0508d3bdb0c96591a7a335477e333cdfb48969a7fc69c56a27337123af88bb4feb28'
+                 '1a57791f07cf3e816729c5a1bf34f55b2bc4a10306424a014bbf8a5804bf7178cae70b11d', 16),
+             int('355020b96a89859a9bea73236fe6eb3d46f1f69fbb1cf3a16306ebf91c9f74d71dbcc459c95c8529c4139ecd5eb'
+                 'dcd8a1ef0071c62af7764b1b88b1e54718497af64b435305ffdda5e9c5c3bf1761efa1a431fa6151ca5f93b7046c'
+                 '727ea333f0fc2bc0ccfdd08676c1c616a97770f2d4dec940e807b499b9f17708790d85b75', 16)),
+}
+E = 65537
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def int_to_bytes(value, size):
+    return binascii.unhexlify('%0*x' % (size * 2, value))
+
+
+def rsa_sign(message, kid, algorithm='RS256'):
+    n, d = KEYS[kid]
+    size = (n.bit_length() + 7) // 8
+    hash_name, prefix = RSA_ALGORITHMS[algorithm]
+    digest_info = prefix + hashlib.new(hash_name, message).digest()
+    encoded = b'\x00\x01' + b'\xff' * (size - len(digest_info) - 3) + b'\x00' + digest_info
+    return int_to_bytes(pow(int(binascii.hexlify(encoded), 16), d, n), size)
+
+
+def make_id_token(kid='key1', algorithm='RS256', signing_kid=None, **claims):
+    now = int(time.time())
+    claims = dict({'iss': 'https://accounts.google.com', 'aud': CLIENT_ID, 'sub': GOOGLE_UID,
+                   'email': 'guser@example.com', 'iat': now, 'exp': now + 3600}, **claims)
+    header = {'alg': algorithm, 'kid': kid, 'typ': 'JWT'}
+    signing_input = '%s.%s' % (b64encode(json.dumps(header).encode()), b64encode(json.dumps(claims).encode()))
+    return '%s.%s' % (signing_input, b64encode(rsa_sign(signing_input.encode(), signing_kid or kid, algorithm)))
+
+
+def jwk(kid):
+    n = KEYS[kid][0]
+    return {'kty': 'RSA', 'use': 'sig', 'alg': 'RS256', 'kid': kid,
+            'n': b64encode(int_to_bytes(n, (n.bit_length() + 7) // 8)), 'e': b64encode(int_to_bytes(E, 3))}
+
+
+class RSATest(SimpleTestCase):
+
+    def test_verify(self):
+        key = RSAPublicKey.from_jwk(jwk('key1'))
+        for algorithm in ('RS256', 'RS384', 'RS512'):
+            signature = rsa_sign(b'message', 'key1', algorithm)
+            self.assertTrue(key.verify(b'message', signature, algorithm))
+            self.assertFalse(key.verify(b'messagf', signature, algorithm))
+        signature = rsa_sign(b'message', 'key1')
+        self.assertFalse(key.verify(b'message', signature, 'RS512'))
+        self.assertFalse(key.verify(b'message', signature[:-1], 'RS256'))
+        self.assertFalse(key.verify(b'message', rsa_sign(b'message', 'key2'), 'RS256'))
+
+
+class GoogleLoginTest(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        throttling.reset()
+        oidc.reset()
+        self.kids = ['key1']
+        self.max_age = 3600
+        self.server = FakeProviderServer({'/certs': self.certs}).start()
+        self.settings_override = override_api_settings(PROVIDER_SETTINGS={
+            'google': {'JWKS_URL': self.server.url + '/certs', 'AUDIENCES': ['ios-client']}})
+        self.settings_override.__enter__()
+        app = SocialApp.objects.create(provider='google', name='Google', client_id=CLIENT_ID, secret='secret')
+        app.sites.add(Site.objects.get_current())
+        self.user = User.objects.create(username='guser', email='guser@example.com')
+        SocialAccount.objects.create(user=self.user, provider='google', uid=GOOGLE_UID)
+
+    def tearDown(self):
+        self.settings_override.__exit__(None, None, None)
+        self.server.stop()
+        http.reset()
+        oidc.reset()
+
+    def certs(self, query):
+        return 200, {'keys': [jwk(kid) for kid in self.kids]}, {'Cache-Control': 'public, max-age=%d' % self.max_age}
+
+    def social_login(self, id_token):
+        self.client.logout()
+        return self.client.post('/login/', {'login_type': 'social_basic', 'provider': 'google',
+                                            'id_token': id_token})
+
+    def get_key_set(self):
+        return oidc.get_key_set('google', self.server.url + '/certs')
+
+    def test_login(self):
+        for i in range(3):
+            response = self.social_login(make_id_token())
+            self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.client.session['_auth_user_id'], str(self.user.pk))
+        self.assertEqual(self.server.hits['/certs'], 1)
+
+        self.assertEqual(self.social_login(make_id_token(aud=['other', 'ios-client'])).status_code, 200)
+        self.assertEqual(self.social_login(make_id_token(iss='accounts.google.com')).status_code, 200)
+
+    def test_rejected(self):
+        now = int(time.time())
+        header, claims, signature = make_id_token().split('.')
+        other_claims = make_id_token(sub='someone else').split('.')[1]
+        tokens = [
+            make_id_token(aud='other-client'),
+            make_id_token(iss='https://accounts.example.com'),
+            make_id_token(exp=now - 3600),
+            make_id_token(iat=now + 3600),
+            make_id_token(sub=''),
+            make_id_token(algorithm='RS512'),
+            '%s.%s.%s' % (header, other_claims, signature),
+            '%s.%s.' % (b64encode(b'{"alg": "none", "kid": "key1"}'), claims),
+            'not-a-token',
+        ]
+        for token in tokens:
+            self.assertEqual(self.social_login(token).status_code, 401, token)
+
+    def test_unknown_kid(self):
+        self.social_login(make_id_token())
+        self.get_key_set().last_attempt -= 3600
+
+        # The provider rotated its keys
+        self.kids = ['key1', 'key2']
+        self.assertEqual(self.social_login(make_id_token(kid='key2')).status_code, 200)
+        self.assertEqual(self.server.hits['/certs'], 2)
+
+        # Rate limited
+        self.assertEqual(self.social_login(make_id_token(kid='key3', signing_kid='key2')).status_code, 401)
+        self.assertEqual(self.social_login(make_id_token(kid='key4', signing_kid='key2')).status_code, 401)
+        self.assertEqual(self.server.hits['/certs'], 2)
+
+        with override_api_settings(OIDC_JWKS_REFETCH_INTERVAL=0):
+            self.assertEqual(self.social_login(make_id_token(kid='key3', signing_kid='key2')).status_code, 401)
+        self.assertEqual(self.server.hits['/certs'], 3)
+
+    def test_background_refresh(self):
+        self.social_login(make_id_token())
+        key_set = self.get_key_set()
+        self.assertTrue(key_set.expires_at - key_set.fetched_at == 3600)
+
+        self.kids = ['key2']
+        key_set.refresh_at = time.time() - 1
+        # Served with the current keys while they're refreshed
+        self.assertEqual(self.social_login(make_id_token()).status_code, 200)
+        key_set.refresh_thread.join()
+        self.assertEqual(self.server.hits['/certs'], 2)
+        self.assertEqual(list(key_set.keys), ['key2'])
+
+    def test_keys_kept_when_refresh_fails(self):
+        self.social_login(make_id_token())
+        key_set = self.get_key_set()
+        self.server.routes['/certs'] = lambda query: (500, {})
+        key_set.expires_at = key_set.refresh_at = time.time() - 1
+        self.assertEqual(self.social_login(make_id_token()).status_code, 200)
+        self.assertEqual(self.server.hits['/certs'], 2)
+
+    def test_provider_unavailable(self):
+        self.server.routes['/certs'] = lambda query: (500, {})
+        self.assertEqual(self.social_login(make_id_token()).status_code, 503)
+
@@ -0,0 +1,222 @@
+from __future__ import absolute_import
+import io
+import json
+import threading
+from datetime import timedelta
+
+from django.core import mail
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils.timezone import now
+
+from allauth_api.account import outbox
+from allauth_api.models import OutboxMessage
+
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    from unittest.case import skipIf
+except ImportError:
+    from unittest2.case import skipIf
+
+try:
+    import asyncore
+    import smtpd
+except ImportError:
+    smtpd = None
+
+user1 = {
+    "username": "johndoe",
+    "email": "johndoe@example.com",
+    "password1": "testpassword",
+    "password2": "testpassword"
+}
+
+DATABASE_OUTBOX = 'allauth_api.account.outbox.DatabaseOutbox'
+THREADED_OUTBOX = 'allauth_api.account.outbox.ThreadedOutbox'
+
+
+class DatabaseOutboxTest(TestCase):
+
+    def test_register_enqueues_confirmation(self):
+        with override_api_settings(EMAIL_OUTBOX_CLASS=DATABASE_OUTBOX):
+            response = self.client.post("/register/", user1)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.PENDING).count(), 1)
+
+        call_command('process_email_outbox', verbosity=0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [user1['email']])
+        self.assertIn("/testconfirm-email/", mail.outbox[0].body)
+        entry = OutboxMessage.objects.get()
+        self.assertEqual(entry.status, OutboxMessage.SENT)
+        self.assertEqual(entry.attempts, 1)
+        self.assertIsNotNone(entry.sent)
+
+    def test_password_reset_enqueues_mail(self):
+        self.client.post("/register/", user1)
+        mail.outbox = []
+        with override_api_settings(EMAIL_OUTBOX_CLASS=DATABASE_OUTBOX):
+            response = self.client.post("/password/reset/", {'email': user1['email']})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(outbox.DatabaseOutbox().drain(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(outbox.DatabaseOutbox().drain(), (0, 0))
+
+    def test_failed_delivery_is_retried(self):
+        with override_api_settings(EMAIL_OUTBOX_CLASS=DATABASE_OUTBOX, EMAIL_OUTBOX_MAX_ATTEMPTS=3,
+                                   EMAIL_OUTBOX_RETRY_DELAY=60, EMAIL_OUTBOX_MAX_RETRY_DELAY=90):
+            outbox.get_outbox().enqueue(EmailMessage("subject", "body", to=[user1['email']]))
+
+            with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                            side_effect=IOError("connection refused")):
+                start = now()
+                self.assertEqual(outbox.DatabaseOutbox().drain(), (0, 1))
+                entry = OutboxMessage.objects.get()
+                self.assertEqual(entry.status, OutboxMessage.PENDING)
+                self.assertIn("connection refused", entry.last_error)
+                self.assertGreaterEqual(entry.next_attempt_at, start + timedelta(seconds=60))
+
+                # Not retried before its next attempt, even by the command
+                call_command('process_email_outbox', verbosity=0)
+                self.assertEqual(OutboxMessage.objects.get().attempts, 1)
+
+                with mock.patch('allauth_api.account.outbox.now', return_value=start + timedelta(seconds=61)):
+                    self.assertEqual(outbox.DatabaseOutbox().drain(), (0, 1))
+                entry = OutboxMessage.objects.get()
+                self.assertEqual(entry.status, OutboxMessage.PENDING)
+                # Doubled, but capped by EMAIL_OUTBOX_MAX_RETRY_DELAY
+                self.assertEqual(entry.next_attempt_at, start + timedelta(seconds=61 + 90))
+
+                with mock.patch('allauth_api.account.outbox.now', return_value=entry.next_attempt_at):
+                    self.assertEqual(outbox.DatabaseOutbox().drain(), (0, 1))
+                entry = OutboxMessage.objects.get()
+                self.assertEqual(entry.status, OutboxMessage.FAILED)
+                self.assertEqual(entry.attempts, 3)
+                self.assertIsNone(entry.next_attempt_at)
+
+        with mock.patch('allauth_api.account.outbox.now', return_value=start + timedelta(days=1)):
+            self.assertEqual(outbox.DatabaseOutbox().drain(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_message_is_stored_as_json(self):
+        message = EmailMultiAlternatives("subject", "body", "from@example.com", to=[user1['email']],
+                                         cc=["cc@example.com"], reply_to=["reply@example.com"],
+                                         headers={'X-Test': 'yes'})
+        message.attach_alternative("<p>body</p>", "text/html")
+        message.attach("data.bin", b"\x00\xff", "application/octet-stream")
+        outbox.DatabaseOutbox().enqueue(message)
+
+        entry = OutboxMessage.objects.get()
+        data = json.loads(entry.data)
+        self.assertEqual((data['subject'], data['to']), ("subject", [user1['email']]))
+        self.assertEqual(data['alternatives'], [["<p>body</p>", "text/html"]])
+
+        self.assertEqual(outbox.DatabaseOutbox().drain(), (1, 0))
+        sent = mail.outbox[0]
+        self.assertEqual((sent.subject, sent.body, sent.from_email), ("subject", "body", "from@example.com"))
+        self.assertEqual((sent.to, sent.cc, sent.reply_to), ([user1['email']], ["cc@example.com"],
+                                                             ["reply@example.com"]))
+        self.assertEqual(sent.extra_headers, {'X-Test': 'yes'})
+        self.assertEqual(sent.alternatives, [("<p>body</p>", "text/html")])
+        self.assertEqual(sent.attachments, [("data.bin", b"\x00\xff", "application/octet-stream")])
+
+
+    @override_settings(ACCOUNT_ADAPTER='tests.accountadapter.ImageKeyTestAccountAdapter')
+    def test_image_key_mail(self):
+        with override_api_settings(EMAIL_OUTBOX_CLASS=DATABASE_OUTBOX):
+            response = self.client.post("/register/", user1)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(outbox.DatabaseOutbox().drain(), (1, 0))
+
+        message = mail.outbox[0]
+        self.assertEqual(message.alternatives[0][1], 'text/html')
+        image = message.attachments[0]
+        self.assertEqual(image.get_content_type(), 'image/png')
+        self.assertEqual(image['Content-Disposition'], 'inline')
+        self.assertTrue(image['Content-ID'].startswith('<'))
+        # The key can be read back from the delivered image
+        response = self.client.post("/confirm-email/", {"key": io.BytesIO(image.get_payload(decode=True))})
+        self.assertEqual(response.status_code, 200)
+
+
+class ThreadedOutboxTest(TransactionTestCase):
+
+    def tearDown(self):
+        outbox.shutdown()
+
+    def test_register_delivers_in_background(self):
+        with override_api_settings(EMAIL_OUTBOX_CLASS=THREADED_OUTBOX):
+            response = self.client.post("/register/", user1)
+            self.assertEqual(response.status_code, 201)
+            outbox.shutdown(wait=True)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.SENT)
+
+
+if smtpd is not None:
+    class SMTPStandIn(smtpd.SMTPServer):
+        """
+        A local SMTP server that just records what it receives
+        """
+
+        def __init__(self):
+            smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+            self.port = self.socket.getsockname()[1]
+            self.connections = 0
+            self.received = []
+            self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.01, 'map': self._map})
+            self.thread.daemon = True
+
+        def handle_accepted(self, conn, addr):
+            self.connections += 1
+            smtpd.SMTPServer.handle_accepted(self, conn, addr)
+
+        def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+            self.received.append(rcpttos)
+
+        def start(self):
+            self.thread.start()
+
+        def stop(self):
+            self.close()
+            asyncore.close_all(map=self._map)
+            self.thread.join(1)
+
+
+@skipIf(smtpd is None, "smtpd is not available")
+class SMTPOutboxThroughputTest(TestCase):
+    message_count = 50
+
+    def setUp(self):
+        self.server = SMTPStandIn()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_drain_reuses_connection(self):
+        db_outbox = outbox.DatabaseOutbox()
+        for i in range(self.message_count):
+            db_outbox.enqueue(EmailMessage("subject %d" % i, "body", to=["user%d@example.com" % i]))
+
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server.port):
+            sent, failed = db_outbox.drain(limit=self.message_count)
+
+        self.assertEqual((sent, failed), (self.message_count, 0))
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.SENT).count(), self.message_count)
+        self.assertEqual(sorted(self.server.received),
+                         sorted([["user%d@example.com" % i] for i in range(self.message_count)]))
+        self.assertEqual(self.server.connections, 1)
@@ -1,11 +1,25 @@
 from __future__ import absolute_import
+import json
+import time
 
+from django.core import mail
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.test import TestCase
 
+from allauth.account import signals
 from allauth.account.models import EmailAddress
 
+from allauth_api.account.verification import (has_verified_email, send_email_confirmation, next_confirmation_allowed,
+                                              record_confirmation_sent, get_cache)
+
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 PASSWORD = "secrets!"
 
 
@@ -30,3 +44,111 @@ class EmailRequiedPermissionTest(TestCase):
         self.client.login(username=self.user2.username, password=PASSWORD)
         response = self.client.get(reverse('account_api_email_required'))
         self.assertEqual(response.status_code, 403)
+
+
+class EmailVerificationCacheTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create(username='johndoe', email='johndoe@example.com')
+        self.email_address = EmailAddress.objects.create(user=self.user, email=self.user.email, primary=True)
+
+    def test_status_is_cached(self):
+        self.assertFalse(has_verified_email(self.user))
+        with self.assertNumQueries(0):
+            self.assertFalse(has_verified_email(self.user))
+
+    def test_confirmation_invalidates_status(self):
+        self.assertFalse(has_verified_email(self.user))
+        self.email_address.verified = True
+        self.email_address.save()
+        signals.email_confirmed.send(sender=EmailAddress, request=None, email_address=self.email_address)
+        self.assertTrue(has_verified_email(self.user))
+        with self.assertNumQueries(0):
+            self.assertTrue(has_verified_email(self.user))
+
+    def test_removal_invalidates_status(self):
+        self.email_address.verified = True
+        self.email_address.save()
+        self.assertTrue(has_verified_email(self.user))
+        self.email_address.delete()
+        self.assertFalse(has_verified_email(self.user))
+
+    def test_cache_disabled(self):
+        with override_api_settings(EMAIL_VERIFICATION_CACHE_TIMEOUT=None):
+            has_verified_email(self.user)
+            with self.assertNumQueries(1):
+                self.assertFalse(has_verified_email(self.user))
+
+    def test_permission_uses_cache(self):
+        self.email_address.verified = True
+        self.email_address.save()
+        self.user.set_password(PASSWORD)
+        self.user.save()
+        self.client.login(username=self.user.username, password=PASSWORD)
+        response = self.client.get(reverse('account_api_email_required'))
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(2):
+            # session and user lookups only
+            response = self.client.get(reverse('account_api_email_required'))
+        self.assertEqual(response.status_code, 200)
+
+
+class ConfirmationResendLedgerTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create(username='janedoe', email='janedoe@example.com')
+        self.user.set_password(PASSWORD)
+        self.user.save()
+        EmailAddress.objects.create(user=self.user, email=self.user.email, primary=True)
+        self.client.login(username=self.user.username, password=PASSWORD)
+
+    def test_auto_send_is_throttled(self):
+        for i in range(3):
+            response = self.client.get(reverse('account_api_email_required'))
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('next_send_allowed', json.loads(response.content.decode()))
+
+    def test_ledger_falls_back_to_database(self):
+        sent, next_allowed = send_email_confirmation(None, self.user)
+        self.assertTrue(sent)
+        self.assertEqual(next_confirmation_allowed(self.user), next_allowed)
+
+        # a worker with a cold cache still sees the previous send
+        get_cache().clear()
+        allowed = next_confirmation_allowed(self.user)
+        self.assertIsNotNone(allowed)
+        self.assertTrue(abs((allowed - next_allowed).total_seconds()) < 1)
+
+        sent, _ = send_email_confirmation(None, self.user)
+        self.assertFalse(sent)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_resend_allowed_after_interval(self):
+        send_email_confirmation(None, self.user)
+        record_confirmation_sent(self.user, time.time() - 3600)
+        self.assertIsNone(next_confirmation_allowed(self.user))
+        sent, _ = send_email_confirmation(None, self.user)
+        self.assertTrue(sent)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_concurrent_sends(self):
+        concurrent = []
+
+        def send(request, user, signup=False):
+            # Another request for the same user arrives while this one is sending
+            concurrent.append(send_email_confirmation(None, user))
+
+        with mock.patch('allauth_api.account.verification.allauth_send_email_confirmation', side_effect=send):
+            sent, next_allowed = send_email_confirmation(None, self.user)
+        self.assertTrue(sent)
+        self.assertEqual(concurrent, [(False, next_allowed)])
+
+    def test_failed_send_releases_reservation(self):
+        with mock.patch('allauth_api.account.verification.allauth_send_email_confirmation',
+                        side_effect=IOError("connection refused")):
+            with self.assertRaises(IOError):
+                send_email_confirmation(None, self.user)
+        sent, _ = send_email_confirmation(None, self.user)
+        self.assertTrue(sent)
+        self.assertEqual(len(mail.outbox), 1)
@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+import time
+
+from django.test import SimpleTestCase
+
+from allauth_api.socialaccount import http
+
+from tests.provider_server import FakeProviderServer
+from tests.utils import override_api_settings
+
+
+class ProviderHTTPTest(SimpleTestCase):
+
+    def setUp(self):
+        http.reset_stats()
+        self.server = FakeProviderServer({'/ok': lambda query: (200, {'ok': True})}).start()
+
+    def tearDown(self):
+        self.server.stop()
+        http.reset()
+
+    def test_connections_are_reused(self):
+        for i in range(3):
+            self.assertEqual(http.get('test', self.server.url + '/ok').json(), {'ok': True})
+        self.assertEqual(list(self.server.connections.values()), [3])
+        self.assertIs(http.get_session(self.server.url + '/ok'), http.get_session(self.server.url + '/other'))
+
+    def test_retries(self):
+        statuses = [503, 200]
+        self.server.routes['/flaky'] = lambda query: (statuses.pop(0), {})
+        with override_api_settings(PROVIDER_HTTP_BACKOFF=0):
+            response = http.get('test', self.server.url + '/flaky')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.hits['/flaky'], 2)
+
+        self.server.routes['/down'] = lambda query: (503, {})
+        with override_api_settings(PROVIDER_HTTP_RETRIES=1, PROVIDER_HTTP_BACKOFF=0):
+            response = http.get('test', self.server.url + '/down')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.hits['/down'], 2)
+
+    def test_run_concurrently(self):
+        def slow(query):
+            time.sleep(0.3)
+            return 200, {'path': query['n']}
+
+        self.server.routes['/slow'] = slow
+        start = time.time()
+        results = http.run_concurrently(*[
+            (lambda n=n: http.get('test', self.server.url + '/slow', params={'n': n}).json()['path'])
+            for n in '1234'])
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(results, ['1', '2', '3', '4'])
+
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            http.run_concurrently(lambda: 1, fail)
+
+    def test_stats(self):
+        self.server.routes['/error'] = lambda query: (500, {})
+        http.get('test', self.server.url + '/ok')
+        http.get('test', self.server.url + '/error')
+        stats = http.get_stats()['test']
+        self.assertEqual((stats['requests'], stats['errors']), (2, 1))
+        self.assertTrue(0 < stats['mean_ms'] <= stats['max_ms'])
+        http.reset_stats()
+        self.assertEqual(http.get_stats(), {})
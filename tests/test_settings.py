@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import override_settings
+
+from allauth_api.account.rest_framework.authentication import BasicLogin, TokenLogin
+from allauth_api.settings import AllAuthAPISettings, DEFAULTS, IMPORT_STRINGS, allauth_api_settings
+
+
+def make_settings(**user_settings):
+    return AllAuthAPISettings(user_settings, DEFAULTS, IMPORT_STRINGS)
+
+
+class SettingsTest(SimpleTestCase):
+
+    def test_snapshot(self):
+        api_settings = make_settings(DRF_LOGIN_TYPE='token')
+        self.assertEqual(api_settings.DRF_LOGIN_TYPE, 'token')
+        self.assertIs(api_settings.DRF_LOGIN_CLASSES['basic'], BasicLogin)
+        self.assertIsInstance(api_settings.login_handlers['token'], TokenLogin)
+        self.assertIs(api_settings.login_handlers['token'], api_settings.login_handlers['token'])
+        self.assertEqual(getattr(api_settings, 'IMAGE_KEY_TEMPLATE', 'default'), 'default')
+
+        with self.assertRaises(AttributeError):
+            api_settings.snapshot.DRF_LOGIN_TYPE = 'basic'
+        with self.assertRaises(TypeError):
+            api_settings.LOGIN_THROTTLE_RATES['ip'] = (1, 1)
+
+    def test_validation(self):
+        with self.assertRaises(ImportError):
+            make_settings(DRF_LOGIN_CLASSES={'basic': 'allauth_api.missing.Login'}).snapshot
+        with self.assertRaises(ImproperlyConfigured):
+            make_settings(DRF_LOGIN_CLASSES={'basic': 'allauth_api.settings.DEFAULTS'}).snapshot
+        with self.assertRaises(ImproperlyConfigured):
+            make_settings(PASSWORD_HASHING_EXECUTOR='greenlet').snapshot
+        with self.assertRaises(ImproperlyConfigured):
+            make_settings(LOGIN_THROTTLE_RATES={'username': (5, 60)}).snapshot
+        with self.assertRaises(ImproperlyConfigured):
+            make_settings(LOGIN_THROTTLE_RATES={'ip': (5, -60)}).snapshot
+
+    def test_failed_refresh_keeps_settings(self):
+        api_settings = make_settings(DRF_LOGIN_TYPE='token')
+        snapshot = api_settings.snapshot
+        with self.assertRaises(ImproperlyConfigured):
+            api_settings.refresh({'PASSWORD_HASHING_EXECUTOR': 'greenlet'})
+        self.assertIs(api_settings.snapshot, snapshot)
+
+        api_settings.refresh({})
+        self.assertIsNot(api_settings.snapshot, snapshot)
+        self.assertEqual(api_settings.DRF_LOGIN_TYPE, DEFAULTS['DRF_LOGIN_TYPE'])
+
+    def test_setting_changed(self):
+        with override_settings(ALLAUTH_API={'DRF_LOGIN_TYPE': 'token'}):
+            self.assertEqual(allauth_api_settings.DRF_LOGIN_TYPE, 'token')
+        self.assertEqual(allauth_api_settings.DRF_LOGIN_TYPE, DEFAULTS['DRF_LOGIN_TYPE'])
+
+
+class LoginDispatchTest(TestCase):
+
+    def test_invalid_login_type(self):
+        response = self.client.post("/login/", {"username": "johndoe", "password": "testpassword",
+                                                "login_type": "carrier_pigeon"})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+import json
+import time
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from allauth.utils import get_user_model
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory
+
+from allauth_api.account.rest_framework.authentication import SignedTokenAuthentication
+from allauth_api.account.rest_framework.utils import SignedTokenGenerator, InvalidSignedToken
+from allauth_api.account.verification import get_cache
+
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+User = get_user_model()
+PASSWORD = "secrets!"
+
+
+class SignedTokenTest(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create(username='johndoe', email='johndoe@example.com')
+        self.user.set_password(PASSWORD)
+        self.user.save()
+
+    def login(self):
+        response = self.client.post("/login/", {"username": "johndoe", "password": PASSWORD,
+                                                "login_type": "signed_token"})
+        self.assertEqual(response.status_code, 200)
+        # only use the token, not the session
+        self.client.logout()
+        return json.loads(response.content.decode())
+
+    def test_login_logout(self):
+        data = self.login()
+        self.assertTrue(data['expires'] > time.time())
+        auth = {'HTTP_AUTHORIZATION': 'Bearer ' + data['token']}
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('account_api_user_id'), **auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content.decode(), json.dumps({"id": self.user.pk}))
+
+        other = self.login()
+
+        response = self.client.post("/logout/", {"login_type": "signed_token"}, **auth)
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(reverse('account_api_user_id'), **auth)
+        self.assertEqual(response.status_code, 401)
+
+        # other tokens are still valid
+        response = self.client.get(reverse('account_api_user_id'), HTTP_AUTHORIZATION='Bearer ' + other['token'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_revoke_all(self):
+        generator = SignedTokenGenerator()
+        tokens = [generator.get_token(self.user).key for i in range(2)]
+        generator.revoke_all_tokens(self.user)
+        for token in tokens:
+            self.assertRaises(InvalidSignedToken, generator.verify, token)
+
+        # Logging in again right away, within the same second
+        token = generator.get_token(self.user).key
+        self.assertEqual(generator.verify(token)['uid'], self.user.pk)
+
+    def test_other_bearer_tokens(self):
+        authentication = SignedTokenAuthentication()
+        factory = APIRequestFactory()
+        # e.g. an OAuth2 access token, for the next authentication class
+        for key in ('an-oauth2-access-token', 'header.payload.signature'):
+            request = factory.get('/', HTTP_AUTHORIZATION='Bearer ' + key)
+            self.assertIsNone(authentication.authenticate(request))
+
+        token = SignedTokenGenerator().get_token(self.user).key
+        kid, payload, signature = token.split('.')
+        request = factory.get('/', HTTP_AUTHORIZATION='Bearer %s.%s.%s' % (kid, payload, signature[:-4]))
+        self.assertRaises(AuthenticationFailed, authentication.authenticate, request)
+
+    def test_tampering_and_expiry(self):
+        generator = SignedTokenGenerator()
+        token = generator.get_token(self.user).key
+        self.assertEqual(generator.verify(token)['uid'], self.user.pk)
+
+        kid, payload, signature = token.split('.')
+        other = generator.get_token(User.objects.create(username='janedoe')).key
+        self.assertRaises(InvalidSignedToken, generator.verify, '.'.join([kid, other.split('.')[1], signature]))
+        self.assertRaises(InvalidSignedToken, generator.verify, 'unknown.%s.%s' % (payload, signature))
+        self.assertRaises(InvalidSignedToken, generator.verify, 'garbage')
+
+        with mock.patch('time.time', return_value=time.time() + 3601):
+            self.assertRaises(InvalidSignedToken, generator.verify, token)
+
+    def test_key_rotation(self):
+        with override_api_settings(SIGNED_TOKEN_KEYS={'k1': 'first secret'}, SIGNED_TOKEN_KEY_ID='k1'):
+            old_token = SignedTokenGenerator().get_token(self.user).key
+        self.assertTrue(old_token.startswith('k1.'))
+
+        with override_api_settings(SIGNED_TOKEN_KEYS={'k1': 'first secret', 'k2': 'second secret'},
+                                   SIGNED_TOKEN_KEY_ID='k2'):
+            generator = SignedTokenGenerator()
+            new_token = generator.get_token(self.user).key
+            self.assertTrue(new_token.startswith('k2.'))
+            self.assertEqual(generator.verify(old_token)['uid'], self.user.pk)
+            self.assertEqual(generator.verify(new_token)['uid'], self.user.pk)
+
+        with override_api_settings(SIGNED_TOKEN_KEYS={'k2': 'second secret'}, SIGNED_TOKEN_KEY_ID='k2'):
+            self.assertRaises(InvalidSignedToken, SignedTokenGenerator().verify, old_token)
@@ -0,0 +1,351 @@
+from __future__ import absolute_import
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.test import TestCase
+
+from allauth.socialaccount.models import SocialAccount, SocialApp
+
+from allauth_api.account import throttling
+from allauth_api.account.verification import get_cache
+from allauth_api.socialaccount import http
+from allauth_api.socialaccount.providers import registry
+from allauth_api.socialaccount.providers.base import InvalidToken, SingleFlight
+
+from tests.provider_server import FakeProviderServer
+from tests.utils import override_api_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+APP_ID = '1234'
+APP_SECRET = 'app-secret'
+FB_UID = '10001'
+VALID_TOKEN = 'valid-token'
+
+
+class FacebookTestMixin(object):
+    """
+    Runs a fake Graph API and points the facebook provider at it
+    """
+    token_expires_in = 3600
+
+    def setUp(self):
+        get_cache().clear()
+        throttling.reset()
+        self.server = FakeProviderServer({
+            '/debug_token': self.debug_token,
+            '/me': self.me,
+            '/me/picture': self.picture,
+        }).start()
+        self.settings_override = override_api_settings(PROVIDER_SETTINGS={'facebook': {'GRAPH_URL': self.server.url}})
+        self.settings_override.__enter__()
+        app = SocialApp.objects.create(provider='facebook', name='Facebook', client_id=APP_ID, secret=APP_SECRET)
+        app.sites.add(Site.objects.get_current())
+        self.user = User.objects.create(username='fbuser', email='fbuser@example.com')
+        SocialAccount.objects.create(user=self.user, provider='facebook', uid=FB_UID)
+        self.provider = registry.by_id('facebook')
+
+    def tearDown(self):
+        self.settings_override.__exit__(None, None, None)
+        self.server.stop()
+        http.reset()
+
+    def debug_token(self, query):
+        if query['input_token'] != VALID_TOKEN:
+            return 200, {'data': {'is_valid': False, 'app_id': APP_ID}}
+        return 200, {'data': {'is_valid': True, 'app_id': APP_ID, 'user_id': FB_UID,
+                              'expires_at': int(time.time()) + self.token_expires_in}}
+
+    def me(self, query):
+        if query['access_token'] != VALID_TOKEN:
+            return 400, {'error': {'message': 'Invalid OAuth access token.'}}
+        return 200, {'id': FB_UID, 'name': 'FB User', 'email': 'fbuser@example.com'}
+
+    def picture(self, query):
+        return 200, {'data': {'url': 'https://example.com/fbuser.jpg'}}
+
+    def social_login(self, token=VALID_TOKEN, **data):
+        self.client.logout()
+        data.update({'login_type': 'social_basic', 'provider': 'facebook'})
+        if token:
+            data['access_token'] = token
+        return self.client.post('/login/', data)
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def make_signed_request(payload, secret=APP_SECRET):
+    payload = dict({'algorithm': 'HMAC-SHA256', 'issued_at': int(time.time())}, **payload)
+    encoded_payload = b64encode(json.dumps(payload).encode())
+    signature = hmac.new(secret.encode(), encoded_payload.encode(), hashlib.sha256).digest()
+    return '%s.%s' % (b64encode(signature), encoded_payload)
+
+
+class FacebookLoginTest(FacebookTestMixin, TestCase):
+
+    def test_login(self):
+        response = self.social_login()
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.client.session['_auth_user_id'], str(self.user.pk))
+
+    def test_invalid_token(self):
+        response = self.social_login('forged-token')
+        self.assertEqual(response.status_code, 401)
+        # Failures aren't cached
+        self.social_login('forged-token')
+        self.assertEqual(self.server.hits['/debug_token'], 2)
+
+    def test_unconnected_account(self):
+        SocialAccount.objects.all().delete()
+        response = self.social_login()
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(json.loads(response.content.decode())['signup_required'])
+
+    def test_unknown_provider(self):
+        response = self.client.post('/login/', {'login_type': 'social_basic', 'provider': 'myspace',
+                                                'access_token': VALID_TOKEN})
+        self.assertEqual(response.status_code, 401)
+
+    def test_provider_unavailable(self):
+        self.server.routes['/debug_token'] = lambda query: (500, {})
+        response = self.social_login()
+        self.assertEqual(response.status_code, 503)
+
+
+class TokenVerificationCacheTest(FacebookTestMixin, TestCase):
+
+    def test_verification_is_cached(self):
+        for i in range(3):
+            self.assertEqual(self.social_login().status_code, 200)
+        self.assertEqual(self.server.hits['/debug_token'], 1)
+        self.assertEqual(self.server.hits['/me'], 1)
+
+        identity = self.provider.verify_token(None, VALID_TOKEN)
+        self.assertEqual(identity.uid, FB_UID)
+        self.assertEqual(identity.profile['name'], 'FB User')
+        self.assertEqual(identity.profile['picture'], 'https://example.com/fbuser.jpg')
+
+    def test_timeout_bounded_by_token_expiry(self):
+        self.token_expires_in = 30
+        identity = self.provider.verify_token(None, VALID_TOKEN)
+        self.assertTrue(25 <= self.provider.get_cache_timeout(identity) <= 30)
+
+        with override_api_settings(SOCIAL_TOKEN_CACHE_TIMEOUT=10):
+            self.assertEqual(self.provider.get_cache_timeout(identity), 10)
+
+    def test_expired_tokens_are_not_cached(self):
+        self.token_expires_in = -10
+        self.provider.verify_token(None, VALID_TOKEN)
+        self.provider.verify_token(None, VALID_TOKEN)
+        self.assertEqual(self.server.hits['/debug_token'], 2)
+
+    def test_concurrent_verifications_share_one_call(self):
+        debug_token = self.debug_token
+
+        def slow_debug_token(query):
+            time.sleep(0.2)
+            return debug_token(query)
+
+        self.server.routes['/debug_token'] = slow_debug_token
+        # The app is looked up in the test's transaction
+        app = SocialApp.objects.get(provider='facebook')
+        self.provider.get_app = lambda request: app
+
+        results = []
+
+        def verify():
+            results.append(self.provider.verify_token(None, VALID_TOKEN))
+
+        threads = [threading.Thread(target=verify) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        del self.provider.get_app
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual(set(identity.uid for identity in results), set([FB_UID]))
+        self.assertEqual(self.server.hits['/debug_token'], 1)
+
+
+class SignedRequestTest(FacebookTestMixin, TestCase):
+
+    def test_login(self):
+        response = self.social_login(None, signed_request=make_signed_request({'user_id': FB_UID}))
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.client.session['_auth_user_id'], str(self.user.pk))
+        self.assertEqual(sum(self.server.hits.values()), 0)
+
+    def test_rejected(self):
+        signed_requests = [
+            make_signed_request({'user_id': FB_UID}, secret='other-secret'),
+            make_signed_request({'user_id': FB_UID, 'algorithm': 'none'}),
+            make_signed_request({'user_id': FB_UID, 'issued_at': int(time.time()) - 3600}),
+            make_signed_request({}),
+            'not.a-signed-request',
+            'garbage',
+        ]
+        for signed_request in signed_requests:
+            response = self.social_login(None, signed_request=signed_request)
+            self.assertEqual(response.status_code, 401, signed_request)
+
+        # Tampering with the payload breaks the signature
+        signature, payload = make_signed_request({'user_id': '99999'}).split('.')
+        forged = '%s.%s' % (make_signed_request({'user_id': FB_UID}).split('.')[0], payload)
+        self.assertEqual(self.social_login(None, signed_request=forged).status_code, 401)
+
+        with override_api_settings(PROVIDER_SETTINGS={'facebook': {'GRAPH_URL': self.server.url,
+                                                                   'SIGNED_REQUEST_MAX_AGE': None}}):
+            response = self.social_login(None, signed_request=signed_requests[2])
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(self.server.hits.values()), 0)
+
+    def test_falls_back_to_access_token(self):
+        expired = make_signed_request({'user_id': FB_UID, 'issued_at': int(time.time()) - 3600})
+        response = self.social_login(signed_request=expired)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.hits['/debug_token'], 1)
+
+    def test_unconnected_account(self):
+        SocialAccount.objects.all().delete()
+        signed_request = make_signed_request({'user_id': FB_UID})
+        response = self.social_login(None, signed_request=signed_request)
+        self.assertEqual(response.status_code, 401)
+        data = json.loads(response.content.decode())
+        self.assertNotIn('signup_required', data)
+        self.assertIn('access_token', data['detail'])
+
+        # The profile is fetched with the access token
+        response = self.social_login(signed_request=signed_request)
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(json.loads(response.content.decode())['signup_required'])
+        self.assertEqual(self.server.hits['/me'], 1)
+        sociallogin = self.client.session['socialaccount_sociallogin']
+        self.assertEqual(sociallogin['account']['extra_data']['email'], 'fbuser@example.com')
+
+        response = self.social_login(signed_request=make_signed_request({'user_id': '99999'}))
+        self.assertEqual(response.status_code, 401)
+        self.assertNotIn('signup_required', json.loads(response.content.decode()))
+
+
+class SocialSignupTest(FacebookTestMixin, TestCase):
+
+    def setUp(self):
+        super(SocialSignupTest, self).setUp()
+        SocialAccount.objects.all().delete()
+        self.user.delete()
+
+    def register(self, **data):
+        data.update({'username': 'newfbuser', 'email': 'fbuser@example.com'})
+        return self.client.post('/social/register/', data)
+
+    def assert_registered(self, response):
+        self.assertEqual(response.status_code, 201, response.content)
+        account = SocialAccount.objects.get(provider='facebook', uid=FB_UID)
+        self.assertEqual(account.user.username, 'newfbuser')
+        self.assertEqual(account.extra_data['name'], 'FB User')
+
+    def test_session_state(self):
+        response = self.social_login()
+        self.assertEqual(response.status_code, 401)
+        data = json.loads(response.content.decode())
+        self.assertTrue(data['signup_required'])
+        self.assertNotIn('signup_token', data)
+        self.assertIn('socialaccount_sociallogin', self.client.session)
+
+        self.assert_registered(self.register())
+        self.assertNotIn('socialaccount_sociallogin', self.client.session)
+
+    def test_token_state(self):
+        with override_api_settings(SOCIAL_SIGNUP_STATE='token'):
+            response = self.social_login()
+            self.assertEqual(response.status_code, 401)
+            token = json.loads(response.content.decode())['signup_token']
+            self.assertNotIn('socialaccount_sociallogin', self.client.session)
+
+            self.client.logout()
+            self.assertEqual(self.register().status_code, 400)
+            self.assertEqual(self.register(signup_token=token[:-2]).status_code, 400)
+            with override_api_settings(SOCIAL_SIGNUP_TOKEN_MAX_AGE=-1):
+                response = self.register(signup_token=token)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('expired', json.loads(response.content.decode())['detail'])
+
+            self.assert_registered(self.register(signup_token=token))
+
+            # Used already
+            self.client.logout()
+            response = self.register(signup_token=token)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('already connected', json.loads(response.content.decode())['detail'])
+
+    def test_closed_for_the_pending_login(self):
+        with override_api_settings(SOCIAL_SIGNUP_STATE='token'):
+            token = json.loads(self.social_login().content.decode())['signup_token']
+            self.client.logout()
+            with mock.patch('allauth.socialaccount.adapter.DefaultSocialAccountAdapter.is_open_for_signup',
+                            return_value=False) as is_open_for_signup:
+                response = self.register(signup_token=token)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(json.loads(response.content.decode())['detail'], "Registration is closed")
+        sociallogin = is_open_for_signup.call_args[0][1]
+        self.assertEqual(sociallogin.account.uid, FB_UID)
+        self.assertFalse(User.objects.filter(username='newfbuser').exists())
+
+    def test_username_taken_in_another_case(self):
+        with override_api_settings(CASE_INSENSITIVE_IDS=True, NORMALIZED_IDS=True):
+            User.objects.create(username='NewFbUser', email='other@example.com')
+            self.social_login()
+            response = self.register()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('username', json.loads(response.content.decode()))
+        self.assertFalse(User.objects.filter(username='newfbuser').exists())
+        self.assertFalse(SocialAccount.objects.exists())
+
+
+class SingleFlightTest(TestCase):
+
+    def test_errors_are_shared(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        errors = []
+
+        def fail():
+            calls.append(1)
+            started.set()
+            release.wait()
+            raise InvalidToken("rejected")
+
+        def run():
+            try:
+                flight.run('key', fail)
+            except InvalidToken as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=run)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=run)
+        follower.start()
+        # Let the follower start waiting
+        time.sleep(0.2)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(flight.calls, {})
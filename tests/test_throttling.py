@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from allauth_api.account import throttling
+from allauth_api.account.throttling import LoginThrottle
+from allauth_api.account.verification import get_cache
+from allauth_api.settings import DEFAULTS
+
+from tests.utils import override_api_settings
+
+PASSWORD = "testpassword"
+RATES = {'ip': (10, 60), 'identifier_ip': (3, 60)}
+
+
+class BaseThrottleTest(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        throttling.reset()
+        self.settings_override = override_api_settings(LOGIN_THROTTLE_RATES=RATES, LOGIN_THROTTLE_LOCKOUT=30,
+                                                       LOGIN_THROTTLE_MAX_LOCKOUT=100)
+        self.settings_override.__enter__()
+
+    def tearDown(self):
+        self.settings_override.__exit__(None, None, None)
+        get_cache().clear()
+        throttling.reset()
+
+
+class LoginThrottleViewTest(BaseThrottleTest):
+
+    def setUp(self):
+        super(LoginThrottleViewTest, self).setUp()
+        user = User.objects.create(username="johndoe", email="johndoe@example.com")
+        user.set_password(PASSWORD)
+        user.save()
+
+    def login(self, password, username="johndoe"):
+        return self.client.post("/login/", {"username": username, "password": password, "login_type": "basic"})
+
+    def test_lockout(self):
+        for i in range(3):
+            self.assertEqual(self.login("invalidpassword").status_code, 401)
+
+        # Rejected before the user is even looked up
+        with self.assertNumQueries(0):
+            response = self.login(PASSWORD)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+
+        # Other users are not affected
+        self.assertEqual(self.login("invalidpassword", username="janedoe").status_code, 401)
+        # Nor is the user logging in from elsewhere
+        response = self.client.post("/login/", {"username": "johndoe", "password": PASSWORD, "login_type": "basic"},
+                                    REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 200)
+
+    def test_disabled_by_default(self):
+        with override_api_settings(LOGIN_THROTTLE_RATES=DEFAULTS['LOGIN_THROTTLE_RATES']):
+            for i in range(20):
+                self.assertEqual(self.login("invalidpassword").status_code, 401)
+            self.assertEqual(self.login(PASSWORD).status_code, 200)
+
+    def test_identifier_scope_is_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            with override_api_settings(LOGIN_THROTTLE_RATES={'identifier': (5, 60)}):
+                pass
+
+    def test_success_resets_counters(self):
+        for i in range(2):
+            self.assertEqual(self.login("invalidpassword").status_code, 401)
+        self.assertEqual(self.login(PASSWORD).status_code, 200)
+        self.client.logout()
+        for i in range(2):
+            self.assertEqual(self.login("invalidpassword").status_code, 401)
+        self.assertEqual(self.login(PASSWORD).status_code, 200)
+
+    def test_ip_lockout(self):
+        for i in range(10):
+            self.assertEqual(self.login("invalidpassword", username="user%d" % i).status_code, 401)
+        self.assertEqual(self.login(PASSWORD).status_code, 429)
+
+    def test_logout_is_not_throttled(self):
+        for i in range(3):
+            self.login("invalidpassword")
+        response = self.client.post("/logout/", {"login_type": "basic"})
+        self.assertEqual(response.status_code, 401)
+
+
+class LoginThrottleTest(BaseThrottleTest):
+
+    def test_lockout_escalates(self):
+        throttle = LoginThrottle("JohnDoe", "127.0.0.1")
+        now = 1000.0
+        for i in range(3):
+            self.assertEqual(throttle.check(now), 0)
+            throttle.failure(now)
+        self.assertEqual(throttle.check(now), 30)
+
+        now += 31
+        self.assertEqual(throttle.check(now), 0)
+        for i in range(3):
+            throttle.failure(now)
+        self.assertEqual(throttle.check(now), 60)
+
+        now += 61
+        for i in range(3):
+            throttle.failure(now)
+        self.assertEqual(throttle.check(now), 100)
+
+        throttle.success(now)
+        self.assertEqual(LoginThrottle("johndoe", "127.0.0.2").check(now), 0)
+
+    def test_sliding_window(self):
+        throttle = LoginThrottle("johndoe", "127.0.0.1")
+        # Two failures at the end of one window still count early in the next one
+        throttle.failure(1199.0)
+        throttle.failure(1199.0)
+        throttle.failure(1200.0)
+        self.assertGreater(throttle.check(1200.0), 0)
+
+    def test_local_tier(self):
+        throttle = LoginThrottle("johndoe", "127.0.0.1")
+        for i in range(3):
+            throttle.failure(1000.0)
+        get_cache().clear()
+        # Still rejected by the in-process table
+        self.assertEqual(throttle.check(1000.0), 30)
+        throttling.reset()
+        self.assertEqual(throttle.check(1000.0), 0)
+
+    def test_disabled(self):
+        with override_api_settings(LOGIN_THROTTLE_RATES={}):
+            throttle = LoginThrottle("johndoe", "127.0.0.1")
+            for i in range(20):
+                throttle.failure()
+            self.assertEqual(throttle.check(), 0)
@@ -1,10 +1,11 @@
 from django.conf.urls import url, include
-from views import EmailRequiredView
+from views import EmailRequiredView, UserIdView
 
 urlpatterns = [
     url(r'^', include('allauth_api.urls')),
     url(r'^test', include('allauth.urls')),
-    url(r'^email_required/$', EmailRequiredView.as_view(), name='account_api_email_required')
+    url(r'^email_required/$', EmailRequiredView.as_view(), name='account_api_email_required'),
+    url(r'^user_id/$', UserIdView.as_view(), name='account_api_user_id'),
 ]
 
 try:
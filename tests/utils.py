@@ -0,0 +1,18 @@
+from contextlib import contextmanager
+
+from allauth_api.settings import allauth_api_settings
+
+
+@contextmanager
+def override_api_settings(**overrides):
+    """
+    Temporarily overrides ALLAUTH_API settings
+    """
+    old_settings = allauth_api_settings.user_settings
+    new_settings = dict(old_settings)
+    new_settings.update(overrides)
+    allauth_api_settings.refresh(new_settings)
+    try:
+        yield
+    finally:
+        allauth_api_settings.refresh(old_settings)
@@ -2,9 +2,17 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.status import HTTP_200_OK
 from allauth_api.account.rest_framework.permissions import EmailVerified
+from allauth_api.account.rest_framework.authentication import SignedTokenAuthentication
 
 class EmailRequiredView(APIView):
     permission_classes = [EmailVerified,]
 
     def get(self, request):
         return Response("OK", HTTP_200_OK)
+
+
+class UserIdView(APIView):
+    authentication_classes = [SignedTokenAuthentication, ]
+
+    def get(self, request):
+        return Response({"id": request.user.pk}, HTTP_200_OK)